@@ -1,41 +1,408 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import FileResponse
-import os, shutil
-from modes.upscale import process_upscale
-from modes.face_restore import process_face_restore
-from modes.illustration import process_illustration
-from modes.poster import process_poster
-from modes.utils import clear_temp
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import Depends, FastAPI, UploadFile, File, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import json, os, logging
+from modes.upscale import process_upscale_bytes, get_upscaler, loaded_backends, resolve_model
+from modes.face_restore import process_face_restore_bytes, get_face_restorer
+from modes.illustration import process_illustration_bytes
+from modes.poster import process_poster_bytes
+from modes.batch import (
+    BATCH_MAX_BYTES,
+    BatchError,
+    BatchItem,
+    expand_uploads,
+    manifest,
+    multipart_boundary,
+    name_outputs,
+    process_batch,
+    stream_multipart,
+    stream_zip
+)
+from modes.executor import ExecutorBusy, get_executor
+from modes.cache import ResultCache, get_result_cache
+from modes.encoding import EncodeOptions, default_options, extension_for, sniff_media_type
+from modes.metrics import counter_family, gauge_family, register_stats, render_metrics
+from modes.precision import resolve_precision
+from modes.registry import get_registry
+from modes.shared_weights import memory_report, process_memory
+from modes.preflight import MAX_INPUT_BYTES, PreflightError, probe_bytes
+from modes.utils import FileUtils
+from api.jobs import DONE, FAILED, JobManager, QueueFull
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
+# Прогрев моделей при старте воркера (PRELOAD_MODELS=0 - ленивая загрузка)
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "1") == "1"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PRELOAD_MODELS:
+        for warmup in (get_upscaler, get_face_restorer):
+            try:
+                await warmup()
+            except Exception as e:
+                # Не валим старт: модель догрузится при первом запросе
+                logger.error(f"Ошибка прогрева моделей: {e}")
+        # При SHARED_WEIGHTS веса воркеров - в общей памяти, в уникальную не входят
+        logger.info(f"Воркер {os.getpid()}: {memory_report()}")
+
+    app.state.jobs = JobManager.from_env(run_job)
+    await app.state.jobs.start()
+    yield
+    await app.state.jobs.stop()
+    get_executor().shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
+
+def _runtime_metrics():
+    """Состояние воркера на момент опроса /metrics"""
+    executor = get_executor().stats()
+    yield gauge_family(
+        "magic_executor_running", "Выполняющиеся вызовы пула по режимам",
+        {(mode, ): s["running"] for mode, s in executor.items()}, ["mode"]
+    )
+    yield gauge_family(
+        "magic_executor_waiting", "Вызовы пула, ждущие слота режима",
+        {(mode, ): s["pending"] - s["running"] for mode, s in executor.items()}, ["mode"]
+    )
+
+    registry = get_registry()
+    memory = registry.memory_bytes()
+    yield gauge_family("magic_models_loaded", "Загруженные модели", {(): len(memory)}, [])
+    yield gauge_family(
+        "magic_model_memory_bytes", "Память весов модели",
+        {(name, ): size for name, size in memory.items()}, ["model"]
+    )
+    yield gauge_family(
+        "magic_model_shared_bytes", "Веса модели в общей памяти воркеров",
+        {(name, ): size for name, size in registry.shared_bytes.items()}, ["model"]
+    )
+    yield gauge_family(
+        "magic_inference_backend", "Бэкенд инференса модели апскейла (1 - используется)",
+        {(name, backend): 1 for name, backend in loaded_backends().items()}, ["model", "backend"]
+    )
+    yield gauge_family(
+        "magic_worker_memory_bytes", "Память воркера: uss - уникальная, shared - общая, pss, rss",
+        {(kind, ): size for kind, size in process_memory().items()}, ["kind"]
+    )
+
+    cache = get_result_cache().stats()
+    yield counter_family(
+        "magic_cache_lookups", "Обращения к кешу результатов",
+        {(kind, ): cache[kind] for kind in ("hits", "disk_hits", "misses")}, ["result"]
+    )
+    yield counter_family("magic_cache_evictions", "Вытеснения из кеша", {(): cache["evictions"]}, [])
+    yield gauge_family("magic_cache_memory_bytes", "Размер кеша в памяти", {(): cache["memory_bytes"]}, [])
+    yield gauge_family("magic_cache_hit_rate", "Доля попаданий в кеш", {(): cache["hit_rate"]}, [])
+
+    jobs = getattr(app.state, "jobs", None)
+    if jobs is not None:
+        yield gauge_family("magic_jobs_queued", "Задания в очереди /jobs", {(): jobs.stats()["queued"]}, [])
+
+register_stats(_runtime_metrics)
+
+# Режимы работают целиком в памяти: байты загрузки -> байты JPEG
 MODES = {
-    "upscale": process_upscale,
-    "face_restore": process_face_restore,
-    "illustration": process_illustration,
-    "poster": process_poster
+    "upscale": process_upscale_bytes,
+    "face_restore": process_face_restore_bytes,
+    "illustration": process_illustration_bytes,
+    "poster": process_poster_bytes
 }
 
+def _cache_params(encoding: Optional[EncodeOptions], precision: Optional[str]) -> dict:
+    """Параметры ключа кеша: кодирование и точность сети (разные точности - разные результаты)"""
+    return {"encoding": (encoding or default_options()).cache_tag(), "precision": precision}
+
+async def run_mode(
+    mode: str,
+    data: bytes,
+    model: Optional[str] = None,
+    encoding: Optional[EncodeOptions] = None,
+    precision: Optional[str] = None
+) -> Optional[bytes]:
+    """Обработка изображения режимом с кешем результатов"""
+    # Повторная отправка того же изображения отдаётся из кеша
+    cache = get_result_cache()
+    cache_key = ResultCache.make_key(
+        FileUtils.hash_bytes(data), mode, model or "auto", _cache_params(encoding, precision)
+    )
+    result = await cache.aget(cache_key)
+
+    if result is None:
+        # Принудительная модель и точность есть только у апскейла
+        kwargs = {"encoding": encoding}
+        if model:
+            kwargs["model"] = model
+        if precision:
+            kwargs["precision"] = precision
+        result = await MODES[mode](data, **kwargs)
+        if result is not None:
+            await cache.aput(cache_key, result)
+
+    return result
+
+async def run_job(
+    mode: str,
+    data: bytes,
+    model: Optional[str] = None,
+    encoding: Optional[dict] = None,
+    precision: Optional[str] = None
+) -> Optional[bytes]:
+    """Обработка задания /jobs: параметры хранятся с заданием в JSON"""
+    return await run_mode(mode, data, model, EncodeOptions(**encoding) if encoding else None, precision)
+
+async def run_batch(
+    mode: str,
+    items: List[BatchItem],
+    model: Optional[str] = None,
+    encoding: Optional[EncodeOptions] = None,
+    precision: Optional[str] = None
+) -> List[BatchItem]:
+    """Пакетная обработка: результаты из кеша, остальное - одним заданием режима"""
+    cache = get_result_cache()
+    params = _cache_params(encoding, precision)
+    keys = {}
+    for item in items:
+        if item.data is None:
+            continue
+        keys[id(item)] = ResultCache.make_key(FileUtils.hash_bytes(item.data), mode, model or "auto", params)
+        item.result = await cache.aget(keys[id(item)])
+
+    await process_batch(mode, items, model, encoding, precision)
+
+    for item in items:
+        if item.ok and id(item) in keys:
+            await cache.aput(keys[id(item)], item.result)
+    return items
+
+class EncodingParams:
+    """Параметры кодирования результата из query-строки"""
+
+    def __init__(
+        self,
+        format: Optional[str] = Query(None, description="jpeg, png или webp"),
+        quality: Optional[int] = Query(None, ge=1, le=100),
+        progressive: Optional[bool] = None,
+        optimize: Optional[bool] = None,
+        subsampling: Optional[str] = Query(None, description="4:4:4, 4:2:2 или 4:2:0"),
+        max_mb: Optional[float] = Query(None, gt=0, description="Подобрать качество под лимит, МБ")
+    ):
+        self.params = {
+            "format": format,
+            "quality": quality,
+            "progressive": progressive,
+            "optimize": optimize,
+            "subsampling": subsampling,
+            "max_mb": max_mb
+        }
+
+    def options(self) -> Optional[EncodeOptions]:
+        """
+        Raises:
+            ValueError: если формат или субдискретизация недопустимы
+        """
+        if all(value is None for value in self.params.values()):
+            return None
+        return EncodeOptions.from_params(**self.params)
+
 @app.post("/process/{mode}")
-async def process_image(mode: str, file: UploadFile = File(...)):
+async def process_image(
+    mode: str,
+    file: UploadFile = File(...),
+    model: Optional[str] = None,
+    precision: Optional[str] = Query(None, description="fp32, bf16 или int8 (только upscale)"),
+    encoding_params: EncodingParams = Depends()
+):
     if mode not in MODES:
         return {"error": f"❌ Неверный режим: {mode}"}
 
-    input_path, output_path = "input.jpg", "output.jpg"
-    with open(input_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # model: anime, photo или имя модели Real-ESRGAN (только для upscale)
+    try:
+        model = resolve_model(model) if mode == "upscale" else None
+        precision = resolve_precision(precision) if mode == "upscale" else None
+        encoding = encoding_params.options()
+    except ValueError as e:
+        return JSONResponse(status_code=422, content={"error": f"❌ {e}"})
+
+    # Очередь режима заполнена - отказываем до чтения загрузки
+    if get_executor().is_saturated(mode):
+        return _busy_response(ExecutorBusy(mode))
+
+    data, error = await _read_upload(file)
+    if error is not None:
+        return error
 
     try:
-        await MODES[mode](input_path, output_path)
+        result = await run_mode(mode, data, model, encoding, precision)
+    except ExecutorBusy as e:
+        return _busy_response(e)
     except Exception as e:
-        clear_temp([input_path, output_path])
         return {"error": f"⚠️ Ошибка: {str(e)}"}
 
-    if os.path.exists(output_path):
-        response = FileResponse(output_path, media_type="image/jpeg", filename="enhanced.jpg")
-        clear_temp([input_path, output_path])
-        return response
-    return {"error": "⚠️ Файл результата не найден"}
+    if result is None:
+        return {"error": "⚠️ Не удалось обработать изображение"}
+
+    return _image_response(result)
+
+@app.post("/batch/{mode}")
+async def process_batch_images(
+    mode: str,
+    files: List[UploadFile] = File(...),
+    model: Optional[str] = None,
+    precision: Optional[str] = Query(None, description="fp32, bf16 или int8 (только upscale)"),
+    output: str = Query("zip", description="zip или multipart"),
+    encoding_params: EncodingParams = Depends()
+):
+    """Несколько изображений (или zip-архив) за один запрос; ответ - поток zip или multipart"""
+    if mode not in MODES:
+        return JSONResponse(status_code=404, content={"error": f"❌ Неверный режим: {mode}"})
+    if output not in ("zip", "multipart"):
+        return JSONResponse(status_code=422, content={"error": f"❌ Неверный формат ответа: {output}"})
+
+    try:
+        model = resolve_model(model) if mode == "upscale" else None
+        precision = resolve_precision(precision) if mode == "upscale" else None
+        encoding = encoding_params.options()
+    except ValueError as e:
+        return JSONResponse(status_code=422, content={"error": f"❌ {e}"})
+
+    # Пакет занимает один слот режима - проверяем до чтения загрузок
+    if get_executor().is_saturated(mode):
+        return _busy_response(ExecutorBusy(mode))
+
+    # Zip может быть больше одного изображения, поэтому до чтения
+    # проверяется только суммарный лимит пакета
+    if sum(file.size or 0 for file in files) > BATCH_MAX_BYTES:
+        return JSONResponse(status_code=413, content={"error": "❌ Пакет слишком большой"})
+    uploads = [(file.filename or "image", await file.read()) for file in files]
+
+    try:
+        items = expand_uploads(uploads)
+        del uploads
+        await run_batch(mode, items, model, encoding, precision)
+    except BatchError as e:
+        return JSONResponse(status_code=e.status, content={"error": f"❌ {e}"})
+    except ExecutorBusy as e:
+        return _busy_response(e)
+
+    if not any(item.ok for item in items):
+        return JSONResponse(
+            status_code=422,
+            content={"error": "⚠️ Не удалось обработать ни одно изображение", **json.loads(manifest(items))}
+        )
+
+    name_outputs(items, encoding)
+    if output == "multipart":
+        boundary = multipart_boundary()
+        media_type = (encoding or default_options()).media_type
+        return StreamingResponse(
+            stream_multipart(items, boundary, media_type),
+            media_type=f"multipart/mixed; boundary={boundary}"
+        )
+    return StreamingResponse(
+        stream_zip(items),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="enhanced.zip"'}
+    )
+
+@app.post("/jobs/{mode}", status_code=202)
+async def submit_job(
+    mode: str,
+    file: UploadFile = File(...),
+    model: Optional[str] = None,
+    precision: Optional[str] = Query(None, description="fp32, bf16 или int8 (только upscale)"),
+    encoding_params: EncodingParams = Depends()
+):
+    if mode not in MODES:
+        return JSONResponse(status_code=404, content={"error": f"❌ Неверный режим: {mode}"})
+
+    try:
+        model = resolve_model(model) if mode == "upscale" else None
+        precision = resolve_precision(precision) if mode == "upscale" else None
+        encoding = encoding_params.options()
+    except ValueError as e:
+        return JSONResponse(status_code=422, content={"error": f"❌ {e}"})
+
+    data, error = await _read_upload(file)
+    if error is not None:
+        return error
+
+    try:
+        job = await app.state.jobs.submit(
+            mode, data,
+            model=model,
+            encoding=encoding.as_dict() if encoding else None,
+            precision=precision
+        )
+    except QueueFull as e:
+        return _busy_response(e)
+
+    return {"job_id": job["id"], "status": job["status"]}
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await app.state.jobs.store.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "❌ Задание не найдено"})
+    return job
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = await app.state.jobs.store.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "❌ Задание не найдено"})
+
+    if job["status"] == FAILED:
+        return JSONResponse(status_code=500, content={"error": f"⚠️ Ошибка: {job['error']}"})
+
+    if job["status"] != DONE:
+        return JSONResponse(status_code=409, content=job)
+
+    result = await app.state.jobs.store.get_result(job_id)
+    if result is None:
+        return JSONResponse(status_code=404, content={"error": "⚠️ Результат не найден"})
+    return _image_response(result)
+
+async def _read_upload(file: UploadFile):
+    """Чтение загрузки с проверкой заголовка изображения до декодирования"""
+    if file.size is not None and file.size > MAX_INPUT_BYTES:
+        return None, _preflight_response(PreflightError("Файл слишком большой", status=413))
+
+    data = await file.read()
+    try:
+        probe_bytes(data)
+    except PreflightError as e:
+        return None, _preflight_response(e)
+    return data, None
+
+def _preflight_response(error: PreflightError) -> JSONResponse:
+    return JSONResponse(status_code=error.status, content={"error": f"❌ {error}"})
+
+def _image_response(result: bytes) -> Response:
+    # Формат определяется по самим байтам: результат мог прийти из кеша или задания
+    media_type = sniff_media_type(result)
+    return Response(
+        content=result,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="enhanced{extension_for(media_type)}"'}
+    )
+
+def _busy_response(error) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"error": f"⏳ {error}"},
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return get_result_cache().stats()
+
+@app.get("/metrics")
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
 
 @app.get("/ping")
 async def ping():
@@ -0,0 +1,473 @@
+"""
+Асинхронные задания для долгих режимов
+
+POST /jobs/{mode} сразу возвращает id задания, обработка идёт во
+внутреннем пуле воркеров, а статус и результат забираются отдельными
+запросами. Соединение не держится открытым на время инференса.
+
+Задание сообщает текущую стадию (queue, decode, inference, encode и т.д.,
+см. modes.metrics.report_stage) и долю её готовности: для инференса
+тайлами - доля готовых тайлов, для стадий без измеримого хода - null.
+
+Хранилище заданий подключаемое:
+- MemoryJobStore: в памяти процесса (один воркер uvicorn)
+- SQLiteJobStore: общий файл SQLite, статус и результат видны всем
+  воркерам uvicorn на машине. Входные данные тоже хранятся в базе:
+  задания, оставшиеся в очереди при перезапуске воркера, при старте
+  ставятся в очередь снова. Задания в работе, которые не обновлялись
+  дольше аренды (воркер упал посреди обработки), тоже возвращаются в очередь
+
+Настройка через переменные окружения:
+- JOB_STORE: memory или sqlite
+- JOB_DB_PATH: путь к файлу SQLite
+- JOB_WORKERS: число параллельно выполняемых заданий
+- JOB_QUEUE_LIMIT: сколько заданий может ждать в очереди
+- JOB_TTL: сколько секунд хранить завершённые задания
+- JOB_LEASE: через сколько секунд без обновлений задание в работе
+  считается брошенным
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from modes.executor import ExecutorBusy
+from modes.metrics import watch_stages
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class QueueFull(Exception):
+    """Очередь заданий заполнена"""
+
+    def __init__(self, retry_after: int = 10):
+        super().__init__("Очередь заданий заполнена, повторите позже")
+        self.retry_after = retry_after
+
+
+class JobStore(ABC):
+    """Базовый интерфейс хранилища заданий"""
+
+    @abstractmethod
+    async def create(self, job: Dict[str, Any], data: bytes, options: Dict[str, Any]) -> None:
+        """Новое задание вместе с входными данными и параметрами runner"""
+
+    @abstractmethod
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def get_input(self, job_id: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+        """Входные данные и параметры задания (None - задания нет или они уже удалены)"""
+
+    @abstractmethod
+    async def claim(self, job_id: str) -> bool:
+        """
+        Перевод задания из очереди в работу
+
+        Returns:
+            bool: False, если задание уже взял другой воркер (или его нет)
+        """
+
+    @abstractmethod
+    async def pending(self) -> List[str]:
+        """Id заданий в статусе queued, от старых к новым"""
+
+    @abstractmethod
+    async def recover(self, older_than: float) -> int:
+        """Возврат в очередь заданий в работе, не обновлявшихся с older_than"""
+
+    @abstractmethod
+    async def update(self, job_id: str, **fields) -> None:
+        ...
+
+    @abstractmethod
+    async def set_result(self, job_id: str, result: bytes) -> None:
+        """Сохранение результата (входные данные больше не нужны и удаляются)"""
+
+    @abstractmethod
+    async def get_result(self, job_id: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    async def prune(self, older_than: float) -> int:
+        """Удаление заданий, обновлённых раньше older_than"""
+
+
+class MemoryJobStore(JobStore):
+    """Хранилище заданий в памяти процесса"""
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._inputs: Dict[str, Tuple[bytes, Dict[str, Any]]] = {}
+        self._results: Dict[str, bytes] = {}
+
+    async def create(self, job: Dict[str, Any], data: bytes, options: Dict[str, Any]) -> None:
+        self._jobs[job["id"]] = dict(job)
+        self._inputs[job["id"]] = (data, dict(options))
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        return dict(job) if job else None
+
+    async def get_input(self, job_id: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+        return self._inputs.get(job_id)
+
+    async def claim(self, job_id: str) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or job["status"] != QUEUED:
+            return False
+        job.update(status=RUNNING, updated_at=time.time())
+        return True
+
+    async def pending(self) -> List[str]:
+        queued = [job for job in self._jobs.values() if job["status"] == QUEUED]
+        return [job["id"] for job in sorted(queued, key=lambda job: job["created_at"])]
+
+    async def recover(self, older_than: float) -> int:
+        stale = [
+            job for job in self._jobs.values()
+            if job["status"] == RUNNING and job["updated_at"] < older_than
+        ]
+        for job in stale:
+            job.update(status=QUEUED, stage=None, progress=None, updated_at=time.time())
+        return len(stale)
+
+    async def update(self, job_id: str, **fields) -> None:
+        if job_id in self._jobs:
+            self._jobs[job_id].update(fields, updated_at=time.time())
+
+    async def set_result(self, job_id: str, result: bytes) -> None:
+        self._results[job_id] = result
+        self._inputs.pop(job_id, None)
+
+    async def get_result(self, job_id: str) -> Optional[bytes]:
+        return self._results.get(job_id)
+
+    async def prune(self, older_than: float) -> int:
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["status"] in (DONE, FAILED) and job["updated_at"] < older_than
+        ]
+        for job_id in expired:
+            self._jobs.pop(job_id, None)
+            self._inputs.pop(job_id, None)
+            self._results.pop(job_id, None)
+        return len(expired)
+
+
+class SQLiteJobStore(JobStore):
+    """Хранилище заданий в SQLite (общее для воркеров на одной машине)"""
+
+    FIELDS = ("id", "mode", "status", "stage", "progress", "error", "created_at", "updated_at")
+    # Колонки, добавленные после первой версии таблицы
+    MIGRATIONS = {"stage": "TEXT", "input": "BLOB", "options": "TEXT"}
+
+    def __init__(self, path: str = "jobs.db"):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, mode TEXT, status TEXT, stage TEXT, progress REAL, "
+                "error TEXT, created_at REAL, updated_at REAL, input BLOB, options TEXT, result BLOB)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in self.MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Отдельное соединение на поток: запросы выполняются через to_thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, query: str, params: tuple = ()) -> list:
+        conn = self._connect()
+        with conn:
+            return conn.execute(query, params).fetchall()
+
+    def _execute_count(self, query: str, params: tuple = ()) -> int:
+        conn = self._connect()
+        with conn:
+            return conn.execute(query, params).rowcount
+
+    async def create(self, job: Dict[str, Any], data: bytes, options: Dict[str, Any]) -> None:
+        columns = (*self.FIELDS, "input", "options")
+        await asyncio.to_thread(
+            self._execute,
+            f"INSERT INTO jobs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            (*(job.get(field) for field in self.FIELDS), data, json.dumps(options))
+        )
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        rows = await asyncio.to_thread(
+            self._execute,
+            f"SELECT {', '.join(self.FIELDS)} FROM jobs WHERE id = ?",
+            (job_id,)
+        )
+        return dict(zip(self.FIELDS, rows[0])) if rows else None
+
+    async def get_input(self, job_id: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT input, options FROM jobs WHERE id = ?", (job_id,)
+        )
+        if not rows or rows[0][0] is None:
+            return None
+        data, options = rows[0]
+        return data, json.loads(options or "{}")
+
+    async def claim(self, job_id: str) -> bool:
+        # Условный UPDATE атомарен: из нескольких воркеров задание возьмёт один
+        claimed = await asyncio.to_thread(
+            self._execute_count,
+            "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+            (RUNNING, time.time(), job_id, QUEUED)
+        )
+        return claimed == 1
+
+    async def pending(self) -> List[str]:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,)
+        )
+        return [row[0] for row in rows]
+
+    async def recover(self, older_than: float) -> int:
+        return await asyncio.to_thread(
+            self._execute_count,
+            "UPDATE jobs SET status = ?, stage = NULL, progress = NULL, updated_at = ? "
+            "WHERE status = ? AND updated_at < ?",
+            (QUEUED, time.time(), RUNNING, older_than)
+        )
+
+    async def update(self, job_id: str, **fields) -> None:
+        fields = {k: v for k, v in fields.items() if k in self.FIELDS and k != "id"}
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        await asyncio.to_thread(
+            self._execute,
+            f"UPDATE jobs SET {assignments} WHERE id = ?",
+            (*fields.values(), job_id)
+        )
+
+    async def set_result(self, job_id: str, result: bytes) -> None:
+        await asyncio.to_thread(
+            self._execute, "UPDATE jobs SET result = ?, input = NULL WHERE id = ?", (result, job_id)
+        )
+
+    async def get_result(self, job_id: str) -> Optional[bytes]:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT result FROM jobs WHERE id = ?", (job_id,)
+        )
+        return rows[0][0] if rows and rows[0][0] is not None else None
+
+    async def prune(self, older_than: float) -> int:
+        return await asyncio.to_thread(
+            self._execute_count,
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (DONE, FAILED, older_than)
+        )
+
+
+def create_job_store() -> JobStore:
+    """Создание хранилища по переменным окружения"""
+    if os.getenv("JOB_STORE", "memory") == "sqlite":
+        return SQLiteJobStore(os.getenv("JOB_DB_PATH", "jobs.db"))
+    return MemoryJobStore()
+
+
+class _StageReporter:
+    """
+    Стадии задания из потоков пула -> хранилище
+
+    Вызывается из любого потока; обновления собираются в цикле событий и
+    пишутся одной задачей по очереди, промежуточные значения схлопываются.
+    """
+
+    def __init__(self, store: JobStore, job_id: str):
+        self.store = store
+        self.job_id = job_id
+        self._loop = asyncio.get_running_loop()
+        self._latest: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __call__(self, stage: str, progress: Optional[float]) -> None:
+        self._loop.call_soon_threadsafe(self._set, stage, progress)
+
+    def _set(self, stage: str, progress: Optional[float]) -> None:
+        self._latest = {"stage": stage, "progress": progress}
+        if self._task is None or self._task.done():
+            self._task = self._loop.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while self._latest is not None:
+            fields, self._latest = self._latest, None
+            try:
+                await self.store.update(self.job_id, **fields)
+            except Exception as e:
+                logger.warning(f"Ошибка обновления стадии задания {self.job_id}: {e}")
+
+    async def close(self) -> None:
+        """Дожидается записи последней стадии"""
+        if self._task is not None:
+            await self._task
+
+
+class JobManager:
+    """Очередь заданий и пул воркеров внутри процесса"""
+
+    def __init__(
+        self,
+        runner: Callable[..., Awaitable[Optional[bytes]]],
+        store: Optional[JobStore] = None,
+        workers: int = 2,
+        queue_limit: int = 32,
+        ttl: int = 3600,
+        lease: int = 600
+    ):
+        """
+        Args:
+            runner: Корутина обработки (режим, байты, **options) -> байты результата
+            store: Хранилище заданий
+            workers: Число параллельно выполняемых заданий
+            queue_limit: Максимум ожидающих заданий
+            ttl: Время хранения завершённых заданий, сек
+            lease: Сколько секунд задание в работе может не обновляться,
+                прежде чем при старте его вернут в очередь
+        """
+        self.runner = runner
+        self.store = store or MemoryJobStore()
+        self.workers = workers
+        self.ttl = ttl
+        self.lease = lease
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=queue_limit)
+        self._tasks = []
+
+    @classmethod
+    def from_env(cls, runner: Callable[..., Awaitable[Optional[bytes]]]) -> "JobManager":
+        return cls(
+            runner,
+            store=create_job_store(),
+            workers=int(os.getenv("JOB_WORKERS", "2")),
+            queue_limit=int(os.getenv("JOB_QUEUE_LIMIT", "32")),
+            ttl=int(os.getenv("JOB_TTL", "3600")),
+            lease=int(os.getenv("JOB_LEASE", "600"))
+        )
+
+    async def start(self) -> None:
+        """Запуск воркеров и возврат в очередь заданий, не взятых или брошенных до перезапуска"""
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+        # Задание в работе обновляется при каждой стадии; не обновлявшееся
+        # дольше аренды осталось от упавшего воркера. Входные данные ещё
+        # в хранилище - задание выполняется заново
+        recovered = await self.store.recover(time.time() - self.lease)
+        if recovered:
+            logger.info(f"Возврат в очередь брошенных заданий: {recovered}")
+        pending = await self.store.pending()
+        if pending:
+            logger.info(f"Возврат в очередь заданий после перезапуска: {len(pending)}")
+            # Очередь ограничена - догружаем в фоне по мере освобождения мест
+            self._tasks.append(asyncio.create_task(self._requeue(pending)))
+
+    async def _requeue(self, job_ids: List[str]) -> None:
+        for job_id in job_ids:
+            await self._queue.put(job_id)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self._queue.qsize(), "workers": self.workers}
+
+    async def submit(self, mode: str, data: bytes, **options) -> Dict[str, Any]:
+        """
+        Постановка задания в очередь
+
+        Args:
+            mode: Режим обработки
+            data: Байты изображения
+            options: Параметры для runner (JSON-сериализуемые - хранятся вместе с заданием)
+
+        Raises:
+            QueueFull: если очередь заполнена
+        """
+        if self._queue.full():
+            raise QueueFull()
+
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "mode": mode,
+            "status": QUEUED,
+            "stage": None,
+            "progress": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        await self.store.create(job, data, options)
+        self._queue.put_nowait(job["id"])
+        return job
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                # После перезапуска одно задание могут вернуть в очередь несколько воркеров
+                if await self.store.claim(job_id):
+                    await self._run(job_id)
+            except Exception as e:
+                logger.error(f"Ошибка задания {job_id}: {e}")
+                await self.store.update(job_id, status=FAILED, error=str(e))
+            finally:
+                self._queue.task_done()
+
+            try:
+                await self.store.prune(time.time() - self.ttl)
+            except Exception as e:
+                logger.warning(f"Ошибка очистки заданий: {e}")
+
+    async def _run(self, job_id: str) -> None:
+        job = await self.store.get(job_id)
+        stored = await self.store.get_input(job_id)
+        if job is None or stored is None:
+            raise RuntimeError("Входные данные задания не найдены")
+        data, options = stored
+
+        reporter = _StageReporter(self.store, job_id)
+        try:
+            with watch_stages(reporter):
+                while True:
+                    try:
+                        result = await self.runner(job["mode"], data, **options)
+                        break
+                    except ExecutorBusy as e:
+                        # Пул режима занят синхронными запросами - ждём, а не падаем
+                        reporter("queue", None)
+                        await asyncio.sleep(e.retry_after)
+        finally:
+            await reporter.close()
+
+        if result is None:
+            await self.store.update(job_id, status=FAILED, error="Не удалось обработать изображение")
+            return
+
+        await self.store.set_result(job_id, result)
+        await self.store.update(job_id, status=DONE, stage=None, progress=1.0)
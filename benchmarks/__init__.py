@@ -0,0 +1,5 @@
+"""
+Бенчмарки режимов обработки
+
+Запуск: python -m benchmarks.run --help
+"""
@@ -0,0 +1,180 @@
+"""
+Бенчмарк бэкендов инференса апскейла: eager, TorchScript, ONNX Runtime
+
+Для каждой модели Real-ESRGAN и каждого бэкенда:
+- время сборки (экспорт при первом запуске и загрузка) и был ли экспорт
+  уже в кеше COMPILED_DIR
+- время апскейла через тайловый движок (p50/p95 в мс) и ускорение
+  относительно eager
+- расхождение с eager на тех же изображениях: PSNR
+
+В конце - самый быстрый бэкенд по каждой модели среди совпадающих с eager
+(тот же выбор делает INFERENCE_BACKEND=auto, см. modes/backends.py).
+
+Примеры:
+    python -m benchmarks.backends
+    python -m benchmarks.backends --images samples/*.jpg --repeats 5
+    python -m benchmarks.backends --standin --sizes 128,256 --backends eager,onnx
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import torch
+
+from benchmarks.precision import _references, _timed_enhance
+from benchmarks.run import peak_rss_mb, percentiles
+from benchmarks.standin import has_real_weights, install_standin_models
+from modes import shared_weights
+from modes.backends import BACKEND_MIN_PSNR, BACKENDS, EAGER, build, export_path, onnx_available
+from modes.precision import psnr
+from modes.tiling import TileEngine
+import modes.backends as backends_mode
+import modes.upscale as upscale_mode
+
+
+def bench_model(args, upscaler, model_name: str, references) -> List[Dict[str, Any]]:
+    results = []
+    eager = upscaler._eager_model(model_name)
+    scale = upscaler.engines[model_name].scale
+    fingerprint = shared_weights.fingerprint(eager.state_dict())
+    baseline: Dict[str, Any] = {}
+
+    for backend in args.backends:
+        cached = backend == EAGER or os.path.exists(export_path(model_name, fingerprint, backend))
+        start = time.perf_counter()
+        try:
+            model = build(eager, model_name, backend, fingerprint)
+        except Exception as e:
+            entry = {"model": model_name, "backend": backend, "error": str(e)}
+            results.append(entry)
+            print(json.dumps(entry, ensure_ascii=False))
+            continue
+        build_seconds = time.perf_counter() - start
+        engine = TileEngine(model, scale)
+
+        for name, img in references:
+            entry: Dict[str, Any] = {
+                "model": model_name,
+                "backend": backend,
+                "image": name,
+                "size": list(img.shape[1::-1]),
+                "build_ms": round(build_seconds * 1000, 1),
+                "export_cached": cached
+            }
+            try:
+                result, samples = _timed_enhance(engine, img, args.repeats)
+                entry["inference"] = percentiles(samples)
+                if backend == EAGER:
+                    baseline[name] = (result, entry["inference"]["p50"])
+                elif name in baseline:
+                    reference, reference_p50 = baseline[name]
+                    entry["speedup"] = round(reference_p50 / entry["inference"]["p50"], 2)
+                    entry["psnr_db"] = round(psnr(reference, result), 2)
+            except Exception as e:
+                entry["error"] = str(e)
+            entry["peak_rss_mb"] = peak_rss_mb()
+            results.append(entry)
+            print(json.dumps(entry, ensure_ascii=False))
+    return results
+
+
+def fastest(results: List[Dict[str, Any]]) -> Dict[str, str]:
+    """Самый быстрый бэкенд каждой модели по сумме p50 (расходящиеся с eager не считаются)"""
+    totals: Dict[str, Dict[str, float]] = {}
+    failed = set()
+    for entry in results:
+        key = (entry["model"], entry["backend"])
+        if "error" in entry or entry.get("psnr_db", float("inf")) < BACKEND_MIN_PSNR:
+            failed.add(key)
+            continue
+        model_totals = totals.setdefault(entry["model"], {})
+        model_totals[entry["backend"]] = model_totals.get(entry["backend"], 0.0) + entry["inference"]["p50"]
+
+    choice = {}
+    for model_name, model_totals in totals.items():
+        valid = {b: t for b, t in model_totals.items() if (model_name, b) not in failed}
+        choice[model_name] = min(valid, key=valid.get) if valid else EAGER
+    return choice
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Сравнение бэкендов инференса eager / torchscript / onnx")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help="Бэкенды через запятую (eager замеряется всегда - это эталон)")
+    parser.add_argument("--images", nargs="*", default=[], help="Эталонные изображения")
+    parser.add_argument("--sizes", type=_ints, default=[128, 256],
+                        help="Длинная сторона синтетических изображений, px")
+    parser.add_argument("--models", default=",".join(upscale_mode.MODELS), help="Модели через запятую")
+    parser.add_argument("--repeats", type=int, default=3, help="Повторов на замер")
+    parser.add_argument("--standin", action="store_true",
+                        help="Всегда использовать модели-заменители")
+    parser.add_argument("--output", default=None, help="Путь к JSON с результатами")
+    args = parser.parse_args(argv)
+    requested = [b for b in args.backends.split(",") if b in BACKENDS]
+    args.backends = [EAGER] + [b for b in requested if b != EAGER]
+    args.models = [m for m in args.models.split(",") if m in upscale_mode.MODELS]
+    return args
+
+
+async def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+
+    # Бэкенды собираются здесь явно - общий апскейлер остаётся на eager
+    backends_mode.INFERENCE_BACKEND = EAGER
+
+    standin = args.standin or not has_real_weights()
+    if standin:
+        install_standin_models()
+    upscaler = await upscale_mode.get_upscaler()
+
+    onnxruntime_version = None
+    if onnx_available():
+        import onnxruntime
+        onnxruntime_version = onnxruntime.__version__
+
+    report: Dict[str, Any] = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "torch": torch.__version__,
+            "onnxruntime": onnxruntime_version,
+            "torch_threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "standin_models": standin,
+            "args": vars(args)
+        },
+        "results": []
+    }
+
+    references = _references(args)
+    for model_name in args.models:
+        report["results"].extend(bench_model(args, upscaler, model_name, references))
+    report["fastest"] = fastest(report["results"])
+    report["peak_rss_mb"] = peak_rss_mb()
+    print(f"Самые быстрые бэкенды: {json.dumps(report['fastest'], ensure_ascii=False)}")
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"backends-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output}")
+    return report
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+"""
+Синтетические изображения для бенчмарков
+
+Два типа, чтобы срабатывали обе ветки выбора модели апскейла:
+- photo: плавные градиенты, размытые пятна и шум (фото-подобное)
+- anime: яркие заливки с тёмными контурами (аниме-подобное)
+"""
+
+import cv2
+import numpy as np
+
+
+def make_photo(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Фото-подобное изображение BGR"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([
+        80 + 60 * np.sin(x / (width / 3.1) + rng.uniform(0, 6)),
+        90 + 50 * np.cos(y / (height / 2.3) + rng.uniform(0, 6)),
+        100 + 40 * np.sin((x + y) / (width / 1.7))
+    ], axis=-1)
+
+    blobs = np.zeros_like(base)
+    for _ in range(12):
+        center = (int(rng.uniform(0, width)), int(rng.uniform(0, height)))
+        radius = int(rng.uniform(0.03, 0.15) * min(width, height)) + 1
+        color = rng.uniform(0, 90, 3).tolist()
+        cv2.circle(blobs, center, radius, color, -1)
+    blobs = cv2.GaussianBlur(blobs, (0, 0), sigmaX=max(min(width, height) / 60, 1))
+
+    noise = rng.normal(0, 8, base.shape)
+    return np.clip(base + blobs + noise, 0, 255).astype(np.uint8)
+
+
+def make_anime(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Аниме-подобное изображение BGR: насыщенные заливки и контуры"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), (230, 220, 250), dtype=np.uint8)
+    thickness = max(min(width, height) // 200, 1)
+
+    for _ in range(10):
+        center = (int(rng.uniform(0, width)), int(rng.uniform(0, height)))
+        axes = (
+            int(rng.uniform(0.05, 0.25) * width) + 1,
+            int(rng.uniform(0.05, 0.25) * height) + 1
+        )
+        hue = int(rng.uniform(0, 180))
+        color = cv2.cvtColor(np.uint8([[[hue, 220, 240]]]), cv2.COLOR_HSV2BGR)[0, 0].tolist()
+        angle = float(rng.uniform(0, 180))
+        cv2.ellipse(img, center, axes, angle, 0, 360, color, -1)
+        cv2.ellipse(img, center, axes, angle, 0, 360, (20, 20, 20), thickness)
+
+    return img
+
+
+def make_image(kind: str, long_side: int, seed: int = 0) -> np.ndarray:
+    """
+    Изображение заданного типа с длинной стороной long_side (пропорции 4:3)
+
+    Args:
+        kind: photo или anime
+        long_side: Длинная сторона в пикселях
+        seed: Зерно генератора
+    """
+    width, height = long_side, max(long_side * 3 // 4, 1)
+    if kind == "anime":
+        return make_anime(width, height, seed)
+    return make_photo(width, height, seed)
+
+
+def encode(img: np.ndarray, ext: str = ".jpg") -> bytes:
+    success, buffer = cv2.imencode(ext, img)
+    if not success:
+        raise ValueError("Ошибка кодирования изображения")
+    return buffer.tobytes()
@@ -0,0 +1,163 @@
+"""
+Бенчмарк точности инференса апскейла: fp32, bf16, int8
+
+Для каждой модели Real-ESRGAN и каждой точности:
+- время сборки варианта (копия весов, калибровка int8)
+- время инференса (p50/p95 в мс) и ускорение относительно fp32
+- расхождение с fp32 на тех же изображениях: PSNR и SSIM
+
+Эталонные изображения - файлы из --images, без них синтетические фото и
+аниме. Варианты, отклонённые проверкой точности при сборке (см.
+modes/precision.py), отмечаются "applied": false - они совпадают с fp32.
+
+Примеры:
+    python -m benchmarks.precision
+    python -m benchmarks.precision --images samples/*.jpg --repeats 5
+    python -m benchmarks.precision --standin --sizes 128,256
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import torch
+
+from benchmarks.images import make_image
+from benchmarks.run import KINDS, peak_rss_mb, percentiles
+from benchmarks.standin import has_real_weights, install_standin_models
+from modes.precision import FP32, PRECISIONS, bf16_supported, psnr, ssim
+import modes.upscale as upscale_mode
+
+
+def _references(args) -> List[Tuple[str, np.ndarray]]:
+    """Эталонные изображения: (имя, BGR)"""
+    if args.images:
+        references = []
+        for path in args.images:
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is None:
+                print(f"Пропущено (не изображение): {path}")
+                continue
+            references.append((os.path.basename(path), img))
+        return references
+    return [(f"{kind}-{size}", make_image(kind, size)) for size in args.sizes for kind in KINDS]
+
+
+def _timed_enhance(engine, img: np.ndarray, repeats: int) -> Tuple[np.ndarray, List[float]]:
+    samples = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = engine.enhance(img, outscale=engine.scale)
+        samples.append(time.perf_counter() - start)
+    return result, samples
+
+
+def bench_model(args, upscaler, model_name: str, references) -> List[Dict[str, Any]]:
+    results = []
+    base = upscaler.engines[model_name]
+    baseline: Dict[str, Tuple[np.ndarray, float]] = {}
+
+    for precision in args.precisions:
+        start = time.perf_counter()
+        engine = upscaler._engine(model_name, precision)
+        build_seconds = time.perf_counter() - start
+
+        for name, img in references:
+            entry: Dict[str, Any] = {
+                "model": model_name,
+                "precision": precision,
+                "applied": precision == FP32 or engine is not base,
+                "image": name,
+                "size": list(img.shape[1::-1]),
+                "build_ms": round(build_seconds * 1000, 1)
+            }
+            try:
+                result, samples = _timed_enhance(engine, img, args.repeats)
+                entry["inference"] = percentiles(samples)
+                if precision == FP32:
+                    baseline[name] = (result, entry["inference"]["p50"])
+                elif name in baseline:
+                    reference, reference_p50 = baseline[name]
+                    entry["speedup"] = round(reference_p50 / entry["inference"]["p50"], 2)
+                    entry["psnr_db"] = round(psnr(reference, result), 2)
+                    entry["ssim"] = round(ssim(reference, result), 4)
+            except Exception as e:
+                entry["error"] = str(e)
+            entry["peak_rss_mb"] = peak_rss_mb()
+            results.append(entry)
+            print(json.dumps(entry, ensure_ascii=False))
+    return results
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Сравнение точности и скорости fp32 / bf16 / int8")
+    parser.add_argument("--precisions", default=",".join(PRECISIONS),
+                        help="Точности через запятую (fp32 замеряется всегда - это эталон)")
+    parser.add_argument("--images", nargs="*", default=[], help="Эталонные изображения")
+    parser.add_argument("--sizes", type=_ints, default=[128, 256],
+                        help="Длинная сторона синтетических изображений, px")
+    parser.add_argument("--models", default=",".join(upscale_mode.MODELS), help="Модели через запятую")
+    parser.add_argument("--repeats", type=int, default=3, help="Повторов на замер")
+    parser.add_argument("--standin", action="store_true",
+                        help="Всегда использовать модели-заменители")
+    parser.add_argument("--output", default=None, help="Путь к JSON с результатами")
+    args = parser.parse_args(argv)
+    requested = [p for p in args.precisions.split(",") if p in PRECISIONS]
+    args.precisions = [FP32] + [p for p in requested if p != FP32]
+    args.models = [m for m in args.models.split(",") if m in upscale_mode.MODELS]
+    return args
+
+
+async def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+
+    standin = args.standin or not has_real_weights()
+    if standin:
+        install_standin_models()
+    upscaler = await upscale_mode.get_upscaler()
+
+    report: Dict[str, Any] = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "bf16_supported": bf16_supported(),
+            "quantized_engine": torch.backends.quantized.engine,
+            "standin_models": standin,
+            "args": vars(args)
+        },
+        "results": []
+    }
+
+    references = _references(args)
+    for model_name in args.models:
+        report["results"].extend(bench_model(args, upscaler, model_name, references))
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"precision-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output}")
+    return report
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,302 @@
+"""
+Бенчмарк режимов обработки
+
+Три замера:
+- stages: время стадий каждого режима (decode, select, inference, encode)
+  на синтетических фото- и аниме-изображениях разного размера
+- tiles: апскейл при разных tile_size / tile_pad
+- concurrency: запросы к FastAPI-приложению через in-process ASGI клиент
+  при разном числе параллельных клиентов
+
+Результат - JSON с p50/p95/p99 (мс), пропускной способностью и пиковым RSS,
+чтобы сравнивать прогоны между собой. Без весов в weights/ используются
+крошечные модели-заменители (только CPU).
+
+Примеры:
+    python -m benchmarks.run
+    python -m benchmarks.run --sizes 256,512,1024,2048,3840 --repeats 5
+    python -m benchmarks.run --standin --skip concurrency --output bench.json
+"""
+
+import os
+
+# До импорта api: без прогрева моделей при старте и без кеша результатов,
+# иначе повторные запросы к одному изображению мерят кеш, а не режим
+os.environ.setdefault("PRELOAD_MODELS", "0")
+os.environ.setdefault("RESULT_CACHE_MB", "0")
+
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import numpy as np
+import torch
+
+from benchmarks.images import encode, make_image
+from benchmarks.standin import has_real_weights, install_standin_models
+from modes.illustration import IllustrationProcessor
+from modes.poster import PosterProcessor
+from modes.utils import ImageUtils
+import modes.face_restore as face_restore_mode
+import modes.upscale as upscale_mode
+
+MODES = ("upscale", "face_restore", "illustration", "poster")
+KINDS = ("photo", "anime")
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """p50/p95/p99 и среднее в миллисекундах"""
+    if not samples:
+        return {}
+    ms = np.asarray(samples) * 1000.0
+    return {
+        "p50": round(float(np.percentile(ms, 50)), 3),
+        "p95": round(float(np.percentile(ms, 95)), 3),
+        "p99": round(float(np.percentile(ms, 99)), 3),
+        "mean": round(float(ms.mean()), 3),
+        "n": len(samples)
+    }
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса с момента запуска (Linux: ru_maxrss в КБ)"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _timed(stages: Dict[str, List[float]], name: str, func: Callable, *args) -> Any:
+    start = time.perf_counter()
+    result = func(*args)
+    stages[name].append(time.perf_counter() - start)
+    return result
+
+
+def _run_once(
+    mode: str,
+    data: bytes,
+    upscaler,
+    restorer,
+    stages: Dict[str, List[float]],
+    tile_size: Optional[int] = None,
+    tile_pad: int = 10
+) -> Optional[str]:
+    """Один прогон режима по стадиям; возвращает выбранную модель"""
+    start = time.perf_counter()
+    model_name = None
+
+    ok, img = _timed(stages, "decode", ImageUtils.decode_bytes, data)
+    if not ok:
+        raise ValueError("Не удалось декодировать изображение")
+
+    if mode == "upscale":
+        model_name, _ = _timed(stages, "select", upscaler._select_model, img)
+        engine = upscaler.engines[model_name]
+        result = _timed(
+            stages, "inference",
+            lambda: engine.enhance(img, outscale=4, tile_size=tile_size, tile_pad=tile_pad)
+        )
+    elif mode == "face_restore":
+        result, _ = _timed(stages, "inference", restorer._restore_sync, img, 0.5, 2)
+    elif mode == "illustration":
+        result = _timed(
+            stages, "inference", IllustrationProcessor()._stylize_sync, img, "fantasy", 0.8
+        )
+    else:
+        result = _timed(stages, "inference", PosterProcessor()._apply_poster_effect, img)
+
+    _timed(stages, "encode", ImageUtils.encode_bytes, result)
+    stages["total"].append(time.perf_counter() - start)
+    return model_name
+
+
+def bench_stages(args, upscaler, restorer) -> List[Dict[str, Any]]:
+    results = []
+    for mode in args.modes:
+        for size in args.sizes:
+            for kind in KINDS:
+                data = encode(make_image(kind, size))
+                stages: Dict[str, List[float]] = defaultdict(list)
+                entry: Dict[str, Any] = {"mode": mode, "size": size, "kind": kind}
+                try:
+                    for _ in range(args.repeats):
+                        entry["model"] = _run_once(mode, data, upscaler, restorer, stages)
+                    entry["stages"] = {name: percentiles(v) for name, v in stages.items()}
+                except Exception as e:
+                    entry["error"] = str(e)
+                entry["peak_rss_mb"] = peak_rss_mb()
+                results.append(entry)
+                _report(entry)
+    return results
+
+
+def bench_tiles(args, upscaler) -> List[Dict[str, Any]]:
+    results = []
+    for size in args.tile_image_sizes:
+        data = encode(make_image("photo", size))
+        for tile_size in args.tile_sizes:
+            for tile_pad in args.tile_pads:
+                stages: Dict[str, List[float]] = defaultdict(list)
+                entry: Dict[str, Any] = {
+                    "size": size,
+                    "tile_size": tile_size,
+                    "tile_pad": tile_pad
+                }
+                try:
+                    for _ in range(args.repeats):
+                        _run_once("upscale", data, upscaler, None, stages, tile_size, tile_pad)
+                    entry["inference"] = percentiles(stages["inference"])
+                    entry["total"] = percentiles(stages["total"])
+                except Exception as e:
+                    entry["error"] = str(e)
+                entry["peak_rss_mb"] = peak_rss_mb()
+                results.append(entry)
+                _report(entry)
+    return results
+
+
+async def _client_worker(
+    client: httpx.AsyncClient,
+    mode: str,
+    payloads: List[bytes],
+    latencies: List[float],
+    statuses: Dict[str, int]
+) -> None:
+    for data in payloads:
+        start = time.perf_counter()
+        response = await client.post(
+            f"/process/{mode}", files={"file": ("bench.jpg", data, "image/jpeg")}
+        )
+        latencies.append(time.perf_counter() - start)
+        if response.status_code == 200 and not response.headers.get("content-type", "").startswith("image/"):
+            # Режим вернул JSON с ошибкой
+            statuses["error"] += 1
+        else:
+            statuses[str(response.status_code)] += 1
+
+
+async def bench_concurrency(args) -> List[Dict[str, Any]]:
+    from api.api import app
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for mode in args.modes:
+            for level in args.concurrency:
+                # Разные изображения на каждый запрос - кеш и батчинг не искажают замер
+                payloads = [
+                    encode(make_image(KINDS[i % 2], args.concurrency_size, seed=i))
+                    for i in range(level * args.requests)
+                ]
+                latencies: List[float] = []
+                statuses: Dict[str, int] = defaultdict(int)
+
+                start = time.perf_counter()
+                await asyncio.gather(*[
+                    _client_worker(client, mode, payloads[i::level], latencies, statuses)
+                    for i in range(level)
+                ])
+                wall = time.perf_counter() - start
+
+                entry = {
+                    "mode": mode,
+                    "concurrency": level,
+                    "size": args.concurrency_size,
+                    "requests": len(payloads),
+                    "latency": percentiles(latencies),
+                    "throughput_rps": round(statuses.get("200", 0) / wall, 3),
+                    "statuses": dict(statuses),
+                    "peak_rss_mb": peak_rss_mb()
+                }
+                results.append(entry)
+                _report(entry)
+    return results
+
+
+def _report(entry: Dict[str, Any]) -> None:
+    print(json.dumps(entry, ensure_ascii=False))
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк режимов обработки изображений")
+    parser.add_argument("--modes", default=",".join(MODES), help="Режимы через запятую")
+    parser.add_argument("--sizes", type=_ints, default=[256, 512, 1024],
+                        help="Длинная сторона изображений, px (до 3840 для 4K)")
+    parser.add_argument("--repeats", type=int, default=3, help="Повторов на замер")
+    parser.add_argument("--tile-image-sizes", type=_ints, default=[1024],
+                        help="Размеры изображений для перебора тайлов")
+    parser.add_argument("--tile-sizes", type=_ints, default=[0, 128, 256, 400],
+                        help="tile_size для перебора (0 - без тайлов)")
+    parser.add_argument("--tile-pads", type=_ints, default=[10, 32], help="tile_pad для перебора")
+    parser.add_argument("--concurrency", type=_ints, default=[1, 2, 4, 8],
+                        help="Число параллельных клиентов")
+    parser.add_argument("--concurrency-size", type=int, default=256,
+                        help="Длинная сторона изображений для замера параллельности")
+    parser.add_argument("--requests", type=int, default=4, help="Запросов на одного клиента")
+    parser.add_argument("--skip", default="", help="Пропустить замеры: stages,tiles,concurrency")
+    parser.add_argument("--standin", action="store_true",
+                        help="Всегда использовать модели-заменители")
+    parser.add_argument("--output", default=None, help="Путь к JSON с результатами")
+    args = parser.parse_args(argv)
+    args.modes = [m for m in args.modes.split(",") if m in MODES]
+    args.skip = set(filter(None, args.skip.split(",")))
+    return args
+
+
+async def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+
+    standin = args.standin or not has_real_weights()
+    if standin:
+        install_standin_models()
+    upscaler = await upscale_mode.get_upscaler()
+    try:
+        restorer = await face_restore_mode.get_face_restorer()
+    except RuntimeError:
+        install_standin_models()
+        upscaler = await upscale_mode.get_upscaler()
+        restorer = await face_restore_mode.get_face_restorer()
+        standin = True
+
+    report: Dict[str, Any] = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "standin_models": standin,
+            "args": {k: sorted(v) if isinstance(v, set) else v for k, v in vars(args).items()}
+        }
+    }
+
+    if "stages" not in args.skip:
+        report["stages"] = bench_stages(args, upscaler, restorer)
+    if "tiles" not in args.skip:
+        report["tiles"] = bench_tiles(args, upscaler)
+    if "concurrency" not in args.skip:
+        report["concurrency"] = await bench_concurrency(args)
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"bench-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output}")
+    return report
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
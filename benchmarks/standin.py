@@ -0,0 +1,82 @@
+"""
+Крошечные модели-заменители для бенчмарков без весов
+
+Когда в weights/ нет настоящих весов, режимы получают маленькие сети с
+тем же интерфейсом: так можно мерить обвязку (декодирование, тайлинг,
+кодирование, очереди) на CPU без скачивания моделей.
+"""
+
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from torch import nn
+
+import modes.face_restore as face_restore_mode
+import modes.upscale as upscale_mode
+from modes.tiling import TileEngine
+
+
+class TinyUpscaleNet(nn.Module):
+    """Conv + PixelShuffle: тот же вход/выход, что у RRDBNet x4"""
+
+    def __init__(self, scale: int = 4, num_feat: int = 16):
+        super().__init__()
+        self.body = nn.Sequential(
+            nn.Conv2d(3, num_feat, 3, padding=1),
+            nn.LeakyReLU(0.2, inplace=True),
+            nn.Conv2d(num_feat, 3 * scale * scale, 3, padding=1),
+            nn.PixelShuffle(scale)
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.body(x)
+
+
+class TinyFaceNet(nn.Module):
+    """Заменитель GFPGAN: батч лиц 512x512 -> (батч лиц, промежуточные выходы)"""
+
+    def __init__(self, num_feat: int = 16):
+        super().__init__()
+        self.body = TinyUpscaleNet(scale=1, num_feat=num_feat)
+
+    def forward(self, x: torch.Tensor, return_rgb: bool = False, **kwargs):
+        return torch.tanh(self.body(x)), []
+
+
+class CenterFaceDetector:
+    """Заменитель RetinaFace: одно лицо в центре изображения"""
+
+    def detect_faces(self, image: np.ndarray, conf_threshold: float = 0.8) -> np.ndarray:
+        height, width = image.shape[:2]
+        side = min(height, width) / 2
+        points = face_restore_mode.FACE_TEMPLATE / face_restore_mode.FACE_SIZE * side
+        points = points + [(width - side) / 2, (height - side) / 2]
+        box = [(width - side) / 2, (height - side) / 2, (width + side) / 2, (height + side) / 2, 0.99]
+        return np.array([box + points.ravel().tolist()], dtype=np.float32)
+
+
+def has_real_weights(models_dir: str = "weights") -> bool:
+    """Есть ли на диске веса всех моделей апскейла"""
+    return all(
+        os.path.exists(os.path.join(models_dir, f"{name}.pth"))
+        for name in upscale_mode.MODELS
+    )
+
+
+def install_standin_models() -> None:
+    """Подмена общих апскейлера и восстановителя лиц заменителями"""
+    upscaler = upscale_mode.ImageUpscaler()
+    for name, config in upscale_mode.MODELS.items():
+        net = TinyUpscaleNet(config["scale"]).eval()
+        upscaler.engines[name] = TileEngine(net, config["scale"])
+    upscale_mode._shared_upscaler = upscaler
+
+    restorer = face_restore_mode.FaceRestorer()
+    restorer.model = SimpleNamespace(
+        gfpgan=TinyFaceNet().eval(),
+        face_helper=SimpleNamespace(face_det=CenterFaceDetector(), face_parse=None),
+        device=torch.device("cpu")
+    )
+    face_restore_mode._shared_restorer = restorer
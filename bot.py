@@ -1,10 +1,16 @@
 import os
+import json
 import logging
-import httpx
-from io import BytesIO
+import tempfile
 from enum import Enum
 import asyncio
-from telegram import Update, ReplyKeyboardMarkup
+import time
+import zipfile
+from contextlib import ExitStack
+from typing import Callable
+import cv2
+from telegram import InputMediaDocument, InputMediaPhoto, Message, Update, ReplyKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -13,6 +19,22 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
+from modes.cache import ResultCache, get_result_cache
+from modes.encoding import EncodeOptions, SUBSAMPLING, encode
+from modes.metrics import (
+    PROVIDER_SECONDS,
+    count_error,
+    counter_family,
+    gauge_family,
+    register_stats,
+    stage_timer,
+    start_exporter,
+    track_job,
+)
+from modes.preflight import PreflightError, plan_upscale, probe_file
+from modes.utils import FileUtils, ImageUtils
+from providers import ProviderClient, ProviderError, ProviderRouter
+from scheduler import FairScheduler, SchedulerFull
 
 # Логгирование
 logging.basicConfig(
@@ -20,10 +42,13 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# URL файлов Telegram содержат токен бота - не пишем запросы httpx в лог
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Конфигурация
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 MAX_SIZE = 5 * 1024 * 1024  # 5MB
+PHOTO_LIMIT = 10 * 1024 * 1024  # больше - отправляем документом
 
 API_KEYS = {
     'UPSCALE_MEDIA': os.getenv('UPSCALE_API_KEY'),
@@ -31,27 +56,81 @@ API_KEYS = {
     'LETS_ENHANCE': os.getenv('LETS_ENHANCE_API_KEY')
 }
 
+# Свой FastAPI-сервер с режимами modes/ (api/api.py)
+API_ENDPOINT = (os.getenv('API_ENDPOINT') or '').rstrip('/')
+# 1 - через /jobs/{mode} с опросом статуса вместо долгого /process/{mode}
+BACKEND_USE_JOBS = os.getenv('BACKEND_USE_JOBS', '0') == '1'
+BACKEND_POLL_INTERVAL = float(os.getenv('BACKEND_POLL_INTERVAL', '2'))
+# Сколько ждать задание /jobs, секунд; дольше - ошибка сервиса и переход к следующему
+BACKEND_JOB_TIMEOUT = float(os.getenv('BACKEND_JOB_TIMEOUT', '600'))
+# Порт экспортера метрик Prometheus (0 - выключен)
+BOT_METRICS_PORT = int(os.getenv('BOT_METRICS_PORT', '0'))
+# Сколько ждать остальные фото альбома после первого, секунд
+ALBUM_WAIT = float(os.getenv('ALBUM_WAIT', '1.5'))
+# Больше фото в одной группе сообщений Telegram не принимает
+MEDIA_GROUP_LIMIT = 10
+# Мгновенный предпросмотр (интерполяция на месте), пока идёт улучшение
+BOT_PREVIEW = os.getenv('BOT_PREVIEW', '1') == '1'
+# Длинная сторона предпросмотра: Telegram всё равно показывает фото не больше 1280
+PREVIEW_SIDE = int(os.getenv('PREVIEW_SIDE', '1280'))
+PREVIEW_QUALITY = int(os.getenv('PREVIEW_QUALITY', '80'))
+# Как часто обновлять сообщение о ходе обработки, секунд (лимиты Telegram на правки)
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '3'))
+
 # Состояния
 CHOOSING_API, PROCESSING = range(2)
 
+# Кнопка автоматического выбора сервиса
+AUTO_CHOICE = "🤖 Авто (самый быстрый)"
+
+
+def _local_service(name: str, mode: str, enhancer: bool = False) -> dict:
+    """
+    Режим своего сервера
+
+    enhancer - режим взаимозаменяем с внешними API улучшения и участвует
+    в автовыборе и переключении при сбоях
+    """
+    return {
+        'name': name,
+        'url': f"{API_ENDPOINT}/process/{mode}",
+        'probe_url': f"{API_ENDPOINT}/ping",
+        'headers': lambda _: {},
+        'files_param': "file",
+        'mode': mode,
+        'local': True,
+        'enhancer': enhancer
+    }
+
+
+# Внешние API принимают только POST: GET к тому же адресу у живого сервиса - 405
+EXTERNAL_PROBE_STATUSES = (405,)
+
 
 class ApiService(Enum):
+    LOCAL_UPSCALE = _local_service('Апскейл на сервере', 'upscale', enhancer=True)
+    LOCAL_FACE_RESTORE = _local_service('Лица на сервере', 'face_restore')
+    LOCAL_ILLUSTRATION = _local_service('Иллюстрация на сервере', 'illustration')
+    LOCAL_POSTER = _local_service('Постер на сервере', 'poster')
     UPSCALE_MEDIA = {
         'name': 'Upscale Media',
-        'url': 'https://api.upscale.media/v1/image',
+        'probe_statuses': EXTERNAL_PROBE_STATUSES,
+        'url': os.getenv('UPSCALE_MEDIA_URL', 'https://api.upscale.media/v1/image'),
         'headers': lambda key: {"Authorization": f"Bearer {key}"},
         'files_param': "image"
     }
     DEEP_IMAGE = {
         'name': 'Deep Image AI',
-        'url': 'https://api.deep-image.ai/process',
+        'probe_statuses': EXTERNAL_PROBE_STATUSES,
+        'url': os.getenv('DEEP_IMAGE_URL', 'https://api.deep-image.ai/process'),
         'headers': lambda _: {},
         'files_param': "image",
         'data': {"mode": "quality"}
     }
     LETS_ENHANCE = {
-        'name': 'Let's Enhance',
-        'url': 'https://api.letsenhance.io/enhance',
+        'name': "Let's Enhance",
+        'probe_statuses': EXTERNAL_PROBE_STATUSES,
+        'url': os.getenv('LETS_ENHANCE_URL', 'https://api.letsenhance.io/enhance'),
         'headers': lambda key: {"Authorization": f"Bearer {key}"},
         'files_param': "image"
     }
@@ -59,43 +138,522 @@ class ApiService(Enum):
 
 class ImageProcessor:
     def __init__(self):
-        self.client = httpx.AsyncClient(timeout=30.0)
+        self.client = ProviderClient.from_env()
+        self.router = ProviderRouter.from_env(probe=self._probe)
         self.current_api = None
 
-    async def enhance_image(self, image_bytes: bytes, api_service: ApiService) -> BytesIO | None:
-        self.current_api = api_service
+    @staticmethod
+    def available_services() -> list[ApiService]:
+        return [
+            service for service in ApiService
+            if (API_ENDPOINT if service.value.get('local') else API_KEYS.get(service.name))
+        ]
+
+    async def _probe(self, name: str) -> bool:
+        config = ApiService[name].value
+        return await self.client.probe(
+            config.get('probe_url', config['url']),
+            config['headers'](API_KEYS.get(name)),
+            config.get('probe_statuses', ())
+        )
+
+    def _candidates(self, api_service: ApiService | None) -> list[ApiService]:
+        """Сервисы в порядке попыток: выбранный, затем здоровые замены"""
+        enhancers = [
+            service for service in self.available_services()
+            if service.value.get('enhancer', True)
+        ]
+        ranked = [
+            ApiService[name] for name in self.router.rank(service.name for service in enhancers)
+        ]
+        # Свой сервер дешевле платных API - первый выбор, пока он здоров
+        ranked.sort(key=lambda service: not service.value.get('local', False))
+
+        if api_service is None:
+            return ranked
+        if not api_service.value.get('enhancer', True):
+            return [api_service]
+        return [api_service] + [service for service in ranked if service is not api_service]
+
+    async def download_photo(self, photo_file, dest_path: str) -> None:
+        """Потоковая загрузка фото из Telegram в файл (без копии в памяти)"""
+        if str(photo_file.file_path).startswith("http"):
+            await self.client.download(photo_file.file_path, dest_path, "Telegram")
+        else:
+            # Локальный Bot API сервер отдаёт путь к файлу
+            await photo_file.download_to_drive(dest_path)
+
+    def _call(
+        self,
+        api_service: ApiService,
+        source_path: str,
+        dest_path: str,
+        on_progress: Callable[[str, str | None, float | None], None] | None = None
+    ):
+        """
+        Корутина-фабрика запроса к одному сервису
+
+        Исходник читается из файла блоками, ответ пишется во временный файл
+        сервиса; при хеджировании у каждого запроса свои дескрипторы.
+        """
         config = api_service.value
+        part_path = f"{dest_path}.{api_service.name}.part"
+
+        async def call():
+            try:
+                with open(source_path, "rb") as f:
+                    if config.get('local') and BACKEND_USE_JOBS:
+                        request = lambda: self._run_job(config, f, part_path, on_progress)
+                    else:
+                        request = lambda: self.client.post_to_file(
+                            config['name'],
+                            config['url'],
+                            part_path,
+                            files={config['files_param']: ("photo.jpg", f)},
+                            data=config.get('data', {}),
+                            headers=config['headers'](API_KEYS.get(api_service.name)),
+                            accept="image/" if config.get('local') else None
+                        )
+                    started = time.perf_counter()
+                    outcome = "error"
+                    try:
+                        await self.router.track(api_service.name, request)
+                        outcome = "ok"
+                    finally:
+                        PROVIDER_SECONDS.labels(api_service.name, outcome).observe(
+                            time.perf_counter() - started
+                        )
+                return part_path
+            except BaseException:
+                FileUtils.safe_remove([part_path])
+                raise
+
+        return call
+
+    async def _run_job(
+        self, config: dict, f, part_path: str, on_progress: Callable[[str, str | None, float | None], None] | None = None
+    ) -> int:
+        """
+        Обработка через /jobs своего сервера: постановка, опрос, загрузка результата
+
+        on_progress получает статус, стадию и долю её готовности при каждом опросе
 
-        if not API_KEYS.get(api_service.name):
+        Raises:
+            ProviderError: задание не выполнено или не завершилось за BACKEND_JOB_TIMEOUT
+        """
+        body = await self.client.post(
+            config['name'],
+            f"{API_ENDPOINT}/jobs/{config['mode']}",
+            files={config['files_param']: ("photo.jpg", f)}
+        )
+        job_id = json.loads(body)['job_id']
+
+        deadline = time.monotonic() + BACKEND_JOB_TIMEOUT
+        while True:
+            if time.monotonic() >= deadline:
+                raise ProviderError(config['name'], f"задание не завершилось за {BACKEND_JOB_TIMEOUT:.0f} с")
+            await asyncio.sleep(BACKEND_POLL_INTERVAL)
+            job = json.loads(await self.client.get(config['name'], f"{API_ENDPOINT}/jobs/{job_id}"))
+            if job['status'] == 'failed':
+                raise ProviderError(config['name'], job.get('error') or "задание не выполнено")
+            if job['status'] == 'done':
+                break
+            if on_progress is not None:
+                on_progress(job['status'], job.get('stage'), job.get('progress'))
+
+        return await self.client.download(
+            f"{API_ENDPOINT}/jobs/{job_id}/result", part_path, config['name'], accept="image/"
+        )
+
+    async def enhance_image(
+        self,
+        source_path: str,
+        dest_path: str,
+        api_service: ApiService | None = None,
+        on_progress: Callable[[str, str | None, float | None], None] | None = None
+    ) -> ApiService | None:
+        """
+        Улучшение через выбранный сервис
+
+        Args:
+            source_path: Файл исходного изображения
+            dest_path: Куда записать результат
+            api_service: Сервис; None - авто, самый быстрый здоровый сервис
+            on_progress: Статус, стадия и доля её готовности у задания своего сервера (/jobs)
+
+        Returns:
+            Сервис, который вернул результат, или None; при включённом
+            хеджировании ответить может другой сервис с ключом
+        """
+        if api_service is not None and api_service not in self.available_services():
             logger.error(f"No API key for {api_service.name}")
             return None
 
+        services = self._candidates(api_service)
+        if not services:
+            logger.error("No healthy API services")
+            return None
+        self.current_api = services[0]
+
+        # Повторная отправка той же фотографии не тратит вызов API
+        cache = get_result_cache()
+        cache_key = await self._cache_key(source_path, api_service)
+        cached = await self._cached_result(cache, cache_key, dest_path)
+        if cached is not None:
+            return cached
+
+        # Явно выбранный внешний сервис без хеджирования не подменяется другим;
+        # в режиме авто и для своего сервера при ошибке запрос переходит
+        # к следующему здоровому сервису
+        if (api_service is not None and not api_service.value.get('local')
+                and self.client.hedge_after <= 0):
+            services = services[:1]
+
         try:
-            files = {config['files_param']: ("photo.jpg", image_bytes)}
-            data = config.get('data', {})
-
-            response = await self.client.post(
-                config['url'],
-                files=files,
-                data=data,
-                headers=config['headers'](API_KEYS[api_service.name])
-            )
+            name, part_path = await self.client.hedge([
+                (service.value['name'], self._call(service, source_path, dest_path, on_progress))
+                for service in services
+            ])
+        except ProviderError as e:
+            logger.error(f"{services[0].name} API error: {e}")
+            return None
+
+        os.replace(part_path, dest_path)
+        used = next(service for service in services if service.value['name'] == name)
+        await self._store_result(cache, cache_key, dest_path, used)
+        return used
 
-            if response.status_code == 200:
-                return BytesIO(response.content)
+    @staticmethod
+    async def _cache_key(source_path: str, api_service: ApiService | None) -> str:
+        # В режиме авто ключ не зависит от того, какой сервис сейчас первый
+        # в рейтинге: результат любого сервиса подходит для повторной отправки
+        return ResultCache.make_key(
+            await asyncio.to_thread(FileUtils.hash_file, source_path),
+            "enhance",
+            api_service.name if api_service else "auto",
+            api_service.value.get('data', {}) if api_service else {}
+        )
 
-            logger.error(f"{api_service.name} API error: {response.status_code}")
+    @staticmethod
+    async def _cached_result(cache: ResultCache, key: str, dest_path: str) -> ApiService | None:
+        """Результат из кеша в dest_path; возвращает сервис, который его получил"""
+        name = await cache.aget(f"{key}:service")
+        if name is None or name.decode() not in ApiService.__members__:
+            return None
+        cached = await cache.aget(key)
+        if cached is None:
+            return None
+        with open(dest_path, "wb") as f:
+            f.write(cached)
+        return ApiService[name.decode()]
 
-        except Exception as e:
-            logger.error(f"{api_service.name} connection error: {e}")
+    @staticmethod
+    async def _store_result(cache: ResultCache, key: str, dest_path: str, service: ApiService) -> None:
+        """Сохранение результата вместе с именем сервиса, который его получил"""
+        await cache.aput_file(key, dest_path)
+        await cache.aput(f"{key}:service", service.name.encode())
 
-        return None
+    async def enhance_album(
+        self, sources: list[str], dests: list[str], api_service: ApiService | None = None
+    ) -> list[ApiService | None]:
+        """
+        Улучшение нескольких фото
+
+        Свой сервер получает все фото одним запросом /batch/{mode}: они
+        обрабатываются вместе на одной прогретой модели. Внешние API
+        принимают по одному фото - запросы к ним идут параллельно. Фото,
+        которые не удалось обработать пакетом, повторяются по одному через
+        enhance_image (с переключением на другие сервисы).
+
+        Returns:
+            Сервис, вернувший результат, для каждого фото (None - не удалось)
+        """
+        services = self._candidates(api_service) if (
+            api_service is None or api_service in self.available_services()
+        ) else []
+        used: list[ApiService | None] = [None] * len(sources)
+
+        if services and services[0].value.get('local'):
+            service = services[0]
+            cache = get_result_cache()
+            keys = [await self._cache_key(source, api_service) for source in sources]
+            missing = []
+            for i, key in enumerate(keys):
+                used[i] = await self._cached_result(cache, key, dests[i])
+                if used[i] is None:
+                    missing.append(i)
+
+            try:
+                done = await self._run_batch(
+                    service, [sources[i] for i in missing], [dests[i] for i in missing]
+                ) if missing else []
+            except ProviderError as e:
+                # Сервер недоступен - по одному фото, с переключением на другие сервисы
+                logger.error(f"{service.name} batch error: {e}")
+            else:
+                for i, ok in zip(missing, done):
+                    if ok:
+                        used[i] = service
+                        await self._store_result(cache, keys[i], dests[i], service)
+
+        # Фото, не обработанные пакетом, идут тем же путём, что и одиночные:
+        # с переключением на другие сервисы при ошибке
+        results = await asyncio.gather(*[
+            self.enhance_image(source, dest, api_service)
+            for source, dest, ok in zip(sources, dests, used) if ok is None
+        ])
+        pending = iter(results)
+        return [ok if ok is not None else next(pending) for ok in used]
+
+    async def _run_batch(self, api_service: ApiService, sources: list[str], dests: list[str]) -> list[bool]:
+        """Один запрос /batch/{mode} своего сервера; ответ - zip с manifest.json"""
+        config = api_service.value
+        part_path = f"{dests[0]}.batch.part"
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with ExitStack() as stack:
+                files = [
+                    ("files", (f"{i}.jpg", stack.enter_context(open(source, "rb"))))
+                    for i, source in enumerate(sources)
+                ]
+                await self.router.track(api_service.name, lambda: self.client.post_to_file(
+                    config['name'],
+                    f"{API_ENDPOINT}/batch/{config['mode']}",
+                    part_path,
+                    files=files,
+                    accept="application/zip"
+                ))
+            try:
+                done = await asyncio.to_thread(_unpack_batch, part_path, dests)
+            except (zipfile.BadZipFile, KeyError, ValueError) as e:
+                raise ProviderError(config['name'], f"некорректный ответ /batch: {e!r}")
+            outcome = "ok"
+            return done
+        finally:
+            PROVIDER_SECONDS.labels(api_service.name, outcome).observe(time.perf_counter() - started)
+            FileUtils.safe_remove([part_path])
+
+    def stats_text(self) -> str:
+        stats = self.router.stats()
+        lines = ["📊 Состояние сервисов:"]
+        for service in self.available_services():
+            item = stats.get(service.name)
+            if not item:
+                lines.append(f"• {service.value['name']}: нет данных")
+                continue
+            latency = f"{item['latency_ewma']:.1f} с" if item['latency_ewma'] is not None else "—"
+            state = {"closed": "✅", "half_open": "🟡", "open": "⛔"}[item['state']]
+            lines.append(
+                f"{state} {service.value['name']}: {latency}, "
+                f"ошибки {item['error_rate_ewma']:.0%}, "
+                f"запросов {item['requests']} (неудачных {item['failures']})"
+            )
+        candidates = self._candidates(None)
+        if candidates:
+            lines.append(f"\nАвто сейчас выберет: {candidates[0].value['name']}")
+        return "\n".join(lines)
 
     async def close(self):
-        await self.client.aclose()
+        await self.router.close()
+        await self.client.close()
+
+
+def _unpack_batch(zip_path: str, dests: list[str]) -> list[bool]:
+    """Результаты из zip ответа /batch в порядке манифеста"""
+    with zipfile.ZipFile(zip_path) as archive:
+        items = json.loads(archive.read("manifest.json"))['items']
+        done = []
+        for item, dest in zip(items, dests):
+            if item['file']:
+                with open(dest, "wb") as f:
+                    f.write(archive.read(item['file']))
+            else:
+                logger.warning(f"Фото {item['name']} не обработано: {item['error']}")
+            done.append(bool(item['file']))
+    return done + [False] * (len(dests) - len(done))
 
 
 processor = ImageProcessor()
+scheduler = FairScheduler.from_env()
+
+# По умолчанию результат перекодируется в JPEG не больше лимита фото:
+# Telegram всё равно пережимает фото, а загрузка меньшего файла быстрее
+DEFAULT_ENCODING = EncodeOptions.from_params(format="jpeg", max_mb=PHOTO_LIMIT / (1024 * 1024))
+# Параметры кодирования пользователей (/format); None - файл как вернул сервис
+user_encodings: dict[int, EncodeOptions | None] = {}
+
+
+def parse_format_args(args: list[str]) -> EncodeOptions | None:
+    """
+    Разбор аргументов /format, например: webp 80 5mb, jpeg 444, original
+
+    Raises:
+        ValueError: если аргумент не распознан
+    """
+    params = {}
+    for arg in (a.lower() for a in args):
+        if arg == "original":
+            return None
+        if arg in ("jpeg", "jpg", "png", "webp"):
+            params["format"] = arg
+        elif arg in ("444", "422", "420"):
+            params["subsampling"] = ":".join(arg)
+        elif arg.isdigit():
+            params["quality"] = int(arg)
+        elif arg.endswith("mb"):
+            try:
+                params["max_mb"] = float(arg[:-2].replace(",", "."))
+            except ValueError:
+                raise ValueError(f"Непонятный лимит размера: {arg}")
+        elif arg in SUBSAMPLING:
+            params["subsampling"] = arg
+        elif arg in ("progressive", "baseline"):
+            params["progressive"] = arg == "progressive"
+        else:
+            raise ValueError(f"Непонятный параметр: {arg}")
+    return EncodeOptions.from_params(base=DEFAULT_ENCODING, **params)
+
+
+def describe_encoding(options: EncodeOptions | None) -> str:
+    if options is None:
+        return "как вернул сервис (без перекодирования)"
+    text = options.format.upper()
+    if options.lossy:
+        text += f", качество {options.quality}"
+    if options.format == "jpeg":
+        text += f", {options.subsampling}, {'progressive' if options.progressive else 'baseline'}"
+    if options.max_bytes:
+        text += f", не больше {options.max_bytes / (1024 * 1024):g} МБ"
+    return text
+
+
+def reencode_file(path: str, options: EncodeOptions) -> str | None:
+    """Перекодирование результата сервиса (блокирующее); путь к новому файлу или None"""
+    ok, image = ImageUtils.read_image(path)
+    if not ok:
+        return None
+    encoded = encode(image, options)
+    if encoded.scale < 1:
+        logger.info(f"Результат уменьшен в {1 / encoded.scale:.2f} раза под лимит {options.max_bytes} байт")
+    out_path = f"{os.path.splitext(path)[0]}{options.ext}"
+    with open(out_path, "wb") as f:
+        f.write(encoded.data)
+    return out_path
+
+
+def make_preview(source_path: str, preview_path: str) -> bool:
+    """
+    Быстрый предпросмотр результата (блокирующее, десятки миллисекунд)
+
+    Исходник увеличивается интерполяцией до размера будущего результата
+    (не больше PREVIEW_SIDE) и слегка повышается резкость.
+    """
+    ok, image = ImageUtils.read_image(source_path)
+    if not ok:
+        return False
+    height, width = image.shape[:2]
+    target_w, target_h = plan_upscale(width, height).target
+    factor = min(1.0, PREVIEW_SIDE / max(target_w, target_h))
+    size = (max(int(target_w * factor), 1), max(int(target_h * factor), 1))
+
+    interpolation = cv2.INTER_CUBIC if size[0] > width else cv2.INTER_AREA
+    preview = cv2.resize(image, size, interpolation=interpolation)
+    blurred = cv2.GaussianBlur(preview, (0, 0), 1.0)
+    preview = cv2.addWeighted(preview, 1.5, blurred, -0.5, 0)
+
+    options = EncodeOptions.from_params(format="jpeg", quality=PREVIEW_QUALITY, progressive=False, max_mb=0)
+    with open(preview_path, "wb") as f:
+        f.write(encode(preview, options).data)
+    return True
+
+
+class ProgressMessage:
+    """Сообщение о ходе обработки: статус задания сервера и прошедшее время"""
+
+    STATUSES = {'queued': "в очереди сервера", 'running': "обработка"}
+    STAGES = {
+        'queue': "ожидание модели",
+        'decode': "чтение",
+        'select': "выбор модели",
+        'detect': "поиск лиц",
+        'background': "фон",
+        'inference': "нейросеть",
+        'paste': "вставка лиц",
+        'encode': "сохранение"
+    }
+
+    def __init__(self, msg, text: str, interval: float = PROGRESS_INTERVAL):
+        self.msg = msg
+        self.text = text
+        self.interval = interval
+        self.status: str | None = None
+        self.stage: str | None = None
+        self.progress: float | None = None
+        self.started = time.monotonic()
+        self._shown: str | None = None
+
+    def update(self, status: str, stage: str | None, progress: float | None) -> None:
+        """Новое состояние задания (показывается при следующем обновлении)"""
+        self.status = status
+        self.stage = stage
+        self.progress = progress
+
+    def render(self) -> str:
+        parts = [f"{int(time.monotonic() - self.started)} с"]
+        if self.status is not None:
+            # Доля готовности есть только у стадий с измеримым ходом (тайлы инференса)
+            state = self.STAGES.get(self.stage, self.stage) if self.stage else None
+            state = state or self.STATUSES.get(self.status, self.status)
+            if self.progress is not None:
+                state = f"{state} {self.progress:.0%}"
+            parts.insert(0, state)
+        return f"{self.text} ({', '.join(parts)})"
+
+    async def run(self) -> None:
+        """Периодическое обновление сообщения до отмены"""
+        while True:
+            await asyncio.sleep(self.interval)
+            text = self.render()
+            if text == self._shown:
+                continue
+            try:
+                await self.msg.edit_text(text)
+                self._shown = text
+            except TelegramError as e:
+                # Ограничение частоты правок или удалённое сообщение - не повод прерывать задание
+                logger.debug(f"Progress update skipped: {e}")
+
+
+def _bot_metrics():
+    """Очередь заданий, состояние сервисов и кеш на момент опроса"""
+    queue = scheduler.stats()
+    yield gauge_family("magic_in_flight_jobs", "Задания бота в работе", {(): queue['in_flight']}, [])
+    yield gauge_family("magic_queued_jobs", "Задания бота в очереди", {(): queue['queued']}, [])
+    yield gauge_family(
+        "magic_users_waiting", "Пользователи с заданиями в очереди", {(): queue['users_waiting']}, []
+    )
+
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    health = processor.router.stats()
+    yield gauge_family(
+        "magic_provider_circuit", "Состояние сервиса: 0 - работает, 1 - пробный запрос, 2 - отключён",
+        {(name, ): states[item['state']] for name, item in health.items()}, ["provider"]
+    )
+    yield gauge_family(
+        "magic_provider_latency_ewma_seconds", "Сглаженное время ответа сервиса",
+        {(name, ): item['latency_ewma'] for name, item in health.items() if item['latency_ewma'] is not None},
+        ["provider"]
+    )
+
+    cache = get_result_cache().stats()
+    yield counter_family(
+        "magic_cache_lookups", "Обращения к кешу результатов",
+        {(kind, ): cache[kind] for kind in ("hits", "disk_hits", "misses")}, ["result"]
+    )
+
+
+register_stats(_bot_metrics)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -104,82 +662,422 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🌟 Добро пожаловать в Image Enhancer Bot!\n\n"
         "Я могу улучшить качество ваших фотографий с помощью разных нейросетевых API.\n\n"
         "Отправьте мне фотографию, и я предложу варианты улучшения.\n"
-        "Поддерживаются JPG/PNG до 5MB.\n\n"
-        "Примерное время обработки: 10-30 секунд"
+        "Альбом (до 10 фото) обрабатывается целиком, одним заданием.\n"
+        "Поддерживаются JPG/PNG до 5MB.\n"
+        "Формат результата (JPEG/PNG/WebP, качество, лимит размера): /format\n\n"
+        "Примерное время обработки: 10-30 секунд, предпросмотр приходит сразу"
     )
     return CHOOSING_API
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
+        if update.message.media_group_id:
+            return await handle_album_photo(update, context)
+
         photo = update.message.photo[-1]
         if photo.file_size > MAX_SIZE:
             await update.message.reply_text("⚠️ Файл слишком большой (максимум 5MB)")
             return ConversationHandler.END
 
+        # Лишние задания отклоняем до выбора сервиса и скачивания фото
+        try:
+            scheduler.check(update.effective_user.id)
+        except SchedulerFull as e:
+            await update.message.reply_text(f"⏳ {e}")
+            return ConversationHandler.END
+
+        context.user_data.pop('album', None)
         context.user_data['photo'] = photo
         context.user_data['photo_file'] = await photo.get_file()
 
-        buttons = [
-            [f"{service.value['name']} ({service.name})"] for service in ApiService
-            if API_KEYS.get(service.name)
-        ]
+        return await ask_service(update, "🔍 Выберите сервис для улучшения качества:")
 
-        if not buttons:
-            await update.message.reply_text("❌ Нет доступных API сервисов")
-            return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Error processing photo: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка")
+        return ConversationHandler.END
 
-        reply_markup = ReplyKeyboardMarkup(
-            buttons, resize_keyboard=True, one_time_keyboard=True
-        )
 
-        await update.message.reply_text(
-            "🔍 Выберите сервис для улучшения качества:",
-            reply_markup=reply_markup
-        )
+async def ask_service(update: Update, text: str):
+    """Клавиатура выбора сервиса"""
+    buttons = [
+        [f"{service.value['name']} ({service.name})"]
+        for service in processor.available_services()
+    ]
+
+    if not buttons:
+        await update.message.reply_text("❌ Нет доступных API сервисов")
+        return ConversationHandler.END
+
+    if len(buttons) > 1:
+        buttons.insert(0, [AUTO_CHOICE])
+
+    reply_markup = ReplyKeyboardMarkup(
+        buttons, resize_keyboard=True, one_time_keyboard=True
+    )
+
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    return PROCESSING
+
+
+async def handle_album_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Фото из альбома (группы сообщений)
+
+    Telegram присылает каждое фото альбома отдельным сообщением с общим
+    media_group_id. Фото собираются в user_data; первое сообщение ждёт
+    ALBUM_WAIT секунд остальные и один раз предлагает выбрать сервис -
+    весь альбом обрабатывается одним заданием.
+    """
+    group_id = update.message.media_group_id
+    album = context.user_data.get('album')
+    first = album is None or album['id'] != group_id
+    if first:
+        context.user_data.pop('photo', None)
+        album = {'id': group_id, 'photos': [], 'skipped': 0}
+        context.user_data['album'] = album
 
+    photo = update.message.photo[-1]
+    if photo.file_size > MAX_SIZE:
+        album['skipped'] += 1
+    else:
+        album['photos'].append(photo)
+
+    if not first:
         return PROCESSING
 
-    except Exception as e:
-        logger.error(f"Error processing photo: {e}")
-        await update.message.reply_text("⚠️ Произошла ошибка")
+    await asyncio.sleep(ALBUM_WAIT)
+
+    try:
+        scheduler.check(update.effective_user.id)
+    except SchedulerFull as e:
+        context.user_data.pop('album', None)
+        await update.message.reply_text(f"⏳ {e}")
         return ConversationHandler.END
 
+    if not album['photos']:
+        context.user_data.pop('album', None)
+        await update.message.reply_text("⚠️ Все фото альбома слишком большие (максимум 5MB)")
+        return ConversationHandler.END
+
+    text = f"🖼 Альбом: {len(album['photos'])} фото"
+    if album['skipped']:
+        text += f" (пропущено слишком больших: {album['skipped']})"
+    return await ask_service(update, f"{text}\n🔍 Выберите сервис для улучшения качества:")
+
+
+async def run_enhance_job(update: Update, photo_file, selected_api: ApiService | None, msg):
+    """
+    Скачивание, обработка и ответ - выполняется, когда подошла очередь
+
+    Для сервисов улучшения ответ двухфазный: сразу после скачивания
+    приходит предпросмотр, а готовый результат заменяет его в том же
+    сообщении. Предпросмотр строится параллельно с обработкой и её не
+    задерживает.
+    """
+    temp_files = []
+    service_name = selected_api.value['name'] if selected_api else "автовыбора"
+    enhance = None
+    preview_msg = None
+    try:
+        with track_job("bot"):
+            text = f"🔄 Обработка с помощью {service_name}..."
+            await msg.edit_text(text)
+
+            # Исходник и результат живут во временных файлах, а не в памяти
+            source_fd, source_path = tempfile.mkstemp(suffix=".jpg", prefix="bot-src-")
+            result_fd, result_path = tempfile.mkstemp(suffix=".jpg", prefix="bot-out-")
+            os.close(source_fd)
+            os.close(result_fd)
+            temp_files.extend([source_path, result_path])
+
+            with stage_timer("bot", "download"):
+                await processor.download_photo(photo_file, source_path)
+
+            # Заголовок проверяется до отправки в сервисы: битые файлы и
+            # бомбы декомпрессии не тратят ни вызов API, ни инференс
+            try:
+                await asyncio.to_thread(probe_file, source_path)
+            except PreflightError as e:
+                count_error("bot", "preflight")
+                await msg.edit_text(f"⚠️ {e}")
+                return
+
+            progress = ProgressMessage(msg, text)
+            with stage_timer("bot", "enhance"):
+                enhance = asyncio.create_task(
+                    processor.enhance_image(source_path, result_path, selected_api, progress.update)
+                )
+                if BOT_PREVIEW and (selected_api is None or selected_api.value.get('enhancer', True)):
+                    preview_msg = await send_preview(update, source_path, temp_files, enhance)
+
+                ticker = asyncio.create_task(progress.run())
+                try:
+                    used_api = await enhance
+                finally:
+                    ticker.cancel()
+
+            if used_api:
+                with stage_timer("bot", "encode"):
+                    send_path, ext = await prepare_result(update, result_path, temp_files)
+
+                caption = f"✅ Готово! Обработано с помощью {used_api.value['name']}"
+                with stage_timer("bot", "send"):
+                    preview_msg = await send_result(update, send_path, ext, caption, preview_msg)
+            else:
+                count_error("bot", "enhance")
+                await update.message.reply_text(
+                    f"❌ Не удалось обработать с помощью {service_name}"
+                )
+
+            await msg.delete()
+
+    finally:
+        if enhance is not None and not enhance.done():
+            enhance.cancel()
+        if preview_msg is not None:
+            # Предпросмотр без готового результата вводил бы в заблуждение
+            await _delete_quietly(preview_msg)
+        FileUtils.safe_remove(temp_files)
+
+
+async def send_preview(update: Update, source_path: str, temp_files: list[str], enhance) -> Message | None:
+    """
+    Предпросмотр, пока работает задание enhance
+
+    Не отправляется, если результат уже готов (например, из кеша). Ошибки
+    предпросмотра не влияют на обработку.
+    """
+    try:
+        with stage_timer("bot", "preview"):
+            fd, preview_path = tempfile.mkstemp(suffix=".jpg", prefix="bot-preview-")
+            os.close(fd)
+            temp_files.append(preview_path)
+            if not await asyncio.to_thread(make_preview, source_path, preview_path) or enhance.done():
+                return None
+            with open(preview_path, "rb") as f:
+                return await update.message.reply_photo(
+                    photo=f, caption="👀 Предпросмотр. Результат в полном качестве заменит его здесь"
+                )
+    except Exception as e:
+        logger.warning(f"Preview failed: {e}")
+        return None
+
+
+async def send_result(
+    update: Update, send_path: str, ext: str, caption: str, preview_msg: Message | None
+) -> Message | None:
+    """
+    Отправка результата: фото заменяет предпросмотр в том же сообщении,
+    документ приходит отдельно (предпросмотр затем удаляется)
+
+    Returns:
+        Предпросмотр, который осталось удалить, или None
+    """
+    with open(send_path, "rb") as f:
+        # PNG и WebP - документом, иначе Telegram пережмёт их в JPEG
+        if ext == ".jpg" and os.path.getsize(send_path) <= PHOTO_LIMIT:
+            if preview_msg is not None:
+                try:
+                    await preview_msg.edit_media(InputMediaPhoto(media=f, caption=caption))
+                    return None
+                except TelegramError as e:
+                    logger.warning(f"Preview replacement failed, sending new photo: {e}")
+                    f.seek(0)
+            await update.message.reply_photo(photo=f, caption=caption)
+        else:
+            await update.message.reply_document(
+                document=f, filename=f"enhanced{ext}", caption=caption
+            )
+    return preview_msg
+
+
+async def _delete_quietly(message: Message) -> None:
+    try:
+        await message.delete()
+    except TelegramError as e:
+        logger.debug(f"Message not deleted: {e}")
+
+
+async def prepare_result(update: Update, result_path: str, temp_files: list[str]) -> tuple[str, str]:
+    """Перекодирование результата в формат пользователя; (путь для отправки, расширение)"""
+    encoding = user_encodings.get(update.effective_user.id, DEFAULT_ENCODING)
+    if encoding is None:
+        return result_path, ".jpg"
+
+    # Перекодирование - вне event loop, чтобы не задерживать другие апдейты
+    encoded_path = await asyncio.to_thread(reencode_file, result_path, encoding)
+    if encoded_path is None:
+        return result_path, ".jpg"
+    if encoded_path != result_path:
+        temp_files.append(encoded_path)
+    return encoded_path, encoding.ext
+
+
+async def run_album_job(update: Update, photos: list, selected_api: ApiService | None, msg):
+    """Альбом целиком: параллельная загрузка, одна пакетная обработка, ответ альбомом"""
+    temp_files = []
+    service_name = selected_api.value['name'] if selected_api else "автовыбора"
+    try:
+        with track_job("bot_album"):
+            await msg.edit_text(f"🔄 Обработка {len(photos)} фото с помощью {service_name}...")
+
+            sources, results = [], []
+            for _ in photos:
+                for paths, prefix in ((sources, "bot-src-"), (results, "bot-out-")):
+                    fd, path = tempfile.mkstemp(suffix=".jpg", prefix=prefix)
+                    os.close(fd)
+                    paths.append(path)
+            temp_files.extend(sources + results)
+
+            with stage_timer("bot_album", "download"):
+                files = await asyncio.gather(*[photo.get_file() for photo in photos])
+                await asyncio.gather(*[
+                    processor.download_photo(photo_file, path) for photo_file, path in zip(files, sources)
+                ])
+
+            # Битые фото отсеиваются до обработки, остальной альбом продолжает работу
+            checks = await asyncio.gather(
+                *[asyncio.to_thread(probe_file, path) for path in sources], return_exceptions=True
+            )
+            valid = [i for i, check in enumerate(checks) if not isinstance(check, PreflightError)]
+            for check in checks:
+                if isinstance(check, BaseException) and not isinstance(check, PreflightError):
+                    raise check
+            if len(valid) < len(photos):
+                count_error("bot_album", "preflight")
+            if not valid:
+                await msg.edit_text("⚠️ Ни одно фото альбома не прошло проверку")
+                return
+
+            with stage_timer("bot_album", "enhance"):
+                used = await processor.enhance_album(
+                    [sources[i] for i in valid], [results[i] for i in valid], selected_api
+                )
+
+            done = [(results[i], api) for i, api in zip(valid, used) if api is not None]
+            if not done:
+                count_error("bot_album", "enhance")
+                await update.message.reply_text(f"❌ Не удалось обработать с помощью {service_name}")
+                await msg.delete()
+                return
+
+            with stage_timer("bot_album", "encode"):
+                prepared = await asyncio.gather(*[
+                    prepare_result(update, path, temp_files) for path, _ in done
+                ])
+
+            names = sorted({api.value['name'] for _, api in done})
+            caption = f"✅ Готово! Обработано {len(done)} из {len(photos)} с помощью {', '.join(names)}"
+            with stage_timer("bot_album", "send"):
+                await send_album(update, prepared, caption)
+
+            await msg.delete()
+
+    finally:
+        FileUtils.safe_remove(temp_files)
+
+
+async def send_album(update: Update, prepared: list[tuple[str, str]], caption: str):
+    """
+    Ответ группой сообщений
+
+    Фото и документы в одной группе Telegram не смешивает: если хоть один
+    результат нельзя отправить фото (PNG, WebP, больше лимита), вся группа
+    уходит документами.
+    """
+    as_photos = all(
+        ext == ".jpg" and os.path.getsize(path) <= PHOTO_LIMIT for path, ext in prepared
+    )
+    for start in range(0, len(prepared), MEDIA_GROUP_LIMIT):
+        chunk = prepared[start:start + MEDIA_GROUP_LIMIT]
+        with ExitStack() as stack:
+            handles = [stack.enter_context(open(path, "rb")) for path, _ in chunk]
+            text = caption if start == 0 else None
+            if len(chunk) == 1:
+                (_, ext), f = chunk[0], handles[0]
+                if as_photos:
+                    await update.message.reply_photo(photo=f, caption=text)
+                else:
+                    await update.message.reply_document(document=f, filename=f"enhanced{ext}", caption=text)
+                continue
+
+            media = [
+                InputMediaPhoto(media=f, caption=text if i == 0 else None) if as_photos
+                else InputMediaDocument(
+                    media=f, filename=f"enhanced-{start + i + 1}{ext}", caption=text if i == 0 else None
+                )
+                for i, ((_, ext), f) in enumerate(zip(chunk, handles))
+            ]
+            await update.message.reply_media_group(media=media)
+
+
+async def schedule_enhance_job(update: Update, job, msg):
+    """Постановка задания (фабрики корутины) в справедливую очередь с сообщениями о позиции"""
+
+    async def on_position(position: int):
+        await msg.edit_text(f"⏳ Вы в очереди: {position}. Обработка начнётся автоматически")
+
+    try:
+        await scheduler.run(update.effective_user.id, job, on_position)
+    except SchedulerFull as e:
+        await msg.edit_text(f"⏳ {e}")
+    except Exception as e:
+        logger.error(f"Error in API processing: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка при обработке")
+
 
 async def process_with_api(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         choice = update.message.text
         selected_api = None
+        auto = choice == AUTO_CHOICE
 
         for api in ApiService:
             if api.value['name'] in choice:
                 selected_api = api
                 break
 
-        if not selected_api:
+        if not selected_api and not auto:
             await update.message.reply_text("❌ Неверный выбор сервиса")
             return ConversationHandler.END
 
-        msg = await update.message.reply_text(
-            f"🔄 Обработка с помощью {selected_api.value['name']}..."
-        )
-
-        photo_file = context.user_data['photo_file']
-        image_bytes = await photo_file.download_as_bytearray()
-
-        enhanced_image = await processor.enhance_image(image_bytes, selected_api)
+        try:
+            scheduler.check(update.effective_user.id)
+        except SchedulerFull as e:
+            await update.message.reply_text(f"⏳ {e}")
+            return ConversationHandler.END
 
-        if enhanced_image:
-            await update.message.reply_photo(
-                photo=enhanced_image,
-                caption=f"✅ Готово! Обработано с помощью {selected_api.value['name']}"
-            )
+        # Размеры известны из Telegram: увеличивать уже большое фото бессмысленно
+        enhancer = selected_api is None or selected_api.value.get('enhancer', True)
+        album = context.user_data.get('album')
+        if album:
+            photos = [
+                photo for photo in album['photos']
+                if not (enhancer and plan_upscale(photo.width, photo.height).skip)
+            ]
+            if not photos:
+                await update.message.reply_text(
+                    "ℹ️ Все фото альбома уже не меньше целевого размера, улучшение не требуется"
+                )
+                return ConversationHandler.END
+            job = lambda: run_album_job(update, photos, selected_api, msg)
         else:
-            await update.message.reply_text(
-                f"❌ Не удалось обработать с помощью {selected_api.value['name']}"
-            )
+            photo = context.user_data['photo']
+            if enhancer and plan_upscale(photo.width, photo.height).skip:
+                await update.message.reply_text(
+                    f"ℹ️ Фото {photo.width}x{photo.height} уже не меньше целевого размера, улучшение не требуется"
+                )
+                return ConversationHandler.END
+            photo_file = context.user_data['photo_file']
+            job = lambda: run_enhance_job(update, photo_file, selected_api, msg)
+
+        msg = await update.message.reply_text("⏳ Задание принято")
 
-        await msg.delete()
+        # Задание ждёт своей очереди вне диалога: пользователь может
+        # сразу отправить следующее фото
+        context.application.create_task(schedule_enhance_job(update, job, msg), update=update)
 
     except Exception as e:
         logger.error(f"Error in API processing: {e}")
@@ -190,6 +1088,33 @@ async def process_with_api(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    queue = scheduler.stats()
+    await update.message.reply_text(
+        f"{processor.stats_text()}\n\n"
+        f"🧵 В работе: {queue['in_flight']}, в очереди: {queue['queued']} "
+        f"(пользователей: {queue['users_waiting']})"
+    )
+
+
+async def set_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if context.args:
+        try:
+            user_encodings[user_id] = parse_format_args(context.args)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+
+    current = user_encodings.get(user_id, DEFAULT_ENCODING)
+    await update.message.reply_text(
+        f"🖼 Формат результата: {describe_encoding(current)}\n\n"
+        "Изменить: /format jpeg|png|webp [качество 1-100] [лимит, например 5mb] "
+        "[444|422|420] [progressive|baseline]\n"
+        "Без перекодирования: /format original"
+    )
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Операция отменена")
     context.user_data.clear()
@@ -199,8 +1124,10 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def main():
     try:
         logger.info("Starting bot...")
+        start_exporter(BOT_METRICS_PORT)
 
-        app = Application.builder().token(TOKEN).build()
+        # Апдейты обрабатываются параллельно, нагрузку ограничивает scheduler
+        app = Application.builder().token(TOKEN).concurrent_updates(True).build()
 
         conv_handler = ConversationHandler(
             entry_points=[
@@ -219,6 +1146,8 @@ async def main():
         )
 
         app.add_handler(conv_handler)
+        app.add_handler(CommandHandler("stats", stats))
+        app.add_handler(CommandHandler("format", set_format))
 
         logger.info("Bot is running...")
         await app.run_polling()
@@ -3,11 +3,13 @@
 
 Содержит:
 - upscale: Апскейл изображений (Real-ESRGAN)
-- face_restore: Восстановление лиц (GFPGAN/CodeFormer)
+- face_restore: Восстановление лиц (GFPGAN)
 - illustration: Стилизация изображений (Stable Diffusion)
 - poster: Генерация постеров (ControlNet)
 """
 
+import asyncio
+import importlib
 import logging
 from typing import Optional
 from datetime import datetime
@@ -17,10 +19,29 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Импорт основных обработчиков
-from .upscale import ImageUpscaler, process_upscale
-from .face_restore import FaceRestorer, process_face_restore
-from .illustration import IllustrationProcessor, process_illustration
-from .poster import PosterProcessor, process_poster
+from .registry import ModelRegistry, get_registry
+from .cache import ResultCache, get_result_cache
+
+# Обработчики импортируются лениво: бот использует лёгкие модули пакета
+# (кеш, утилиты) и не должен тянуть torch/Real-ESRGAN при импорте
+_LAZY_IMPORTS = {
+    'ImageUpscaler': '.upscale',
+    'process_upscale': '.upscale',
+    'get_upscaler': '.upscale',
+    'FaceRestorer': '.face_restore',
+    'process_face_restore': '.face_restore',
+    'get_face_restorer': '.face_restore',
+    'IllustrationProcessor': '.illustration',
+    'process_illustration': '.illustration',
+    'PosterProcessor': '.poster',
+    'process_poster': '.poster'
+}
+
+def __getattr__(name: str):
+    if name in _LAZY_IMPORTS:
+        module = importlib.import_module(_LAZY_IMPORTS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Версия пакета
 __version__ = "1.0.0"
@@ -32,7 +53,13 @@ __all__ = [
     'process_upscale',
     'process_face_restore',
     'process_illustration',
-    'process_poster'
+    'process_poster',
+    'ModelRegistry',
+    'get_registry',
+    'get_upscaler',
+    'get_face_restorer',
+    'ResultCache',
+    'get_result_cache'
 ]
 
 class ImageProcessor:
@@ -45,6 +72,11 @@ class ImageProcessor:
         Args:
             device: Устройство для обработки (cpu/cuda)
         """
+        from .upscale import ImageUpscaler
+        from .face_restore import FaceRestorer
+        from .illustration import IllustrationProcessor
+        from .poster import PosterProcessor
+
         self.upscaler = ImageUpscaler(device=device)
         self.face_restorer = FaceRestorer(device=device)
         self.illustrator = IllustrationProcessor()
@@ -54,10 +86,10 @@ class ImageProcessor:
 
     async def initialize(self):
         """Асинхронная инициализация моделей"""
+        # Веса берутся из общего реестра и грузятся один раз на процесс
         await asyncio.gather(
             self.upscaler.initialize_models(),
-            self.face_restorer.initialize(),
-            self.illustrator.initialize()
+            self.face_restorer.initialize()
         )
         logger.info("Все модели загружены")
 
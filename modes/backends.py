@@ -0,0 +1,378 @@
+"""
+Скомпилированные бэкенды инференса сети апскейла
+
+Сеть Real-ESRGAN может выполняться:
+- eager: как есть, модулем PyTorch (запасной вариант, работает всегда)
+- torchscript: трассировка, torch.jit.freeze (веса становятся константами
+  графа, свёртки сливаются с соседними операциями) и optimize_for_inference
+- onnx: экспорт в ONNX и ONNX Runtime на CPU со своими пулами потоков и
+  полным набором графовых оптимизаций
+
+Экспорт выполняется один раз и хранится в COMPILED_DIR. Имя файла содержит
+отпечаток весов и версию torch, поэтому после замены .pth или обновления
+torch экспорт пересоздаётся сам; одновременно стартующие воркеры
+экспортируют под межпроцессной блокировкой (как общие веса).
+
+При INFERENCE_BACKEND=auto бэкенд берётся из COMPILED_DIR/choices.json -
+выбора для данной сети, числа потоков и процессора. Замер выполняется один
+раз, до старта воркеров:
+
+    python -m modes.backends && uvicorn api.api:app --workers 2
+
+Каждый доступный бэкенд сверяется с eager на тайлах калибровочного набора
+(modes/precision.py) и замеряется, выбирается самый быстрый; бэкенд,
+который не собрался или расходится с eager, пропускается. Воркеры сами не
+замеряют: без записанного выбора работает eager. Подробное сравнение -
+python -m benchmarks.backends.
+
+Память: скомпилированный граф держит свою копию весов в каждом воркере, а
+исходная сеть остаётся в памяти для вариантов пониженной точности (bf16,
+int8). Поэтому при SHARED_WEIGHTS=1 auto означает eager - иначе общая
+копия весов (modes/shared_weights.py) не давала бы экономии; явно заданный
+torchscript или onnx собирается, но с предупреждением о цене в памяти.
+
+Настройка через переменные окружения:
+- INFERENCE_BACKEND: auto, eager, torchscript, onnx
+- COMPILED_DIR: каталог экспортов
+- ORT_INTRA_THREADS: потоков ONNX Runtime внутри операции (0 - как у torch)
+- BACKEND_MIN_PSNR: минимальный PSNR бэкенда относительно eager, дБ
+"""
+
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import platform
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from modes import shared_weights
+from modes.precision import calibration_tiles, psnr
+
+logger = logging.getLogger(__name__)
+
+EAGER, TORCHSCRIPT, ONNX = "eager", "torchscript", "onnx"
+BACKENDS = (EAGER, TORCHSCRIPT, ONNX)
+AUTO = "auto"
+
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", AUTO)
+COMPILED_DIR = os.getenv("COMPILED_DIR", os.path.join("weights", "compiled"))
+ORT_INTRA_THREADS = int(os.getenv("ORT_INTRA_THREADS", "0"))
+# Скомпилированный граф считает в той же fp32 - расхождение только из-за порядка операций
+BACKEND_MIN_PSNR = float(os.getenv("BACKEND_MIN_PSNR", "45"))
+
+# Тайлов в замере и повторов замера при автовыборе
+PROBE_TILES = 4
+PROBE_REPEATS = 3
+
+# Замер бэкендов при auto, если выбор ещё не записан (только python -m modes.backends)
+MEASURE_BACKENDS = False
+
+
+def resolve_backend(backend: Optional[str]) -> str:
+    """
+    Бэкенд по значению настройки
+
+    Raises:
+        ValueError: если бэкенд неизвестен
+    """
+    backend = (backend or AUTO).lower()
+    if backend != AUTO and backend not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд: {backend} (доступны: {AUTO}, {', '.join(BACKENDS)})")
+    return backend
+
+
+def onnx_available() -> bool:
+    return importlib.util.find_spec("onnxruntime") is not None
+
+
+class OrtModule(torch.nn.Module):
+    """Сессия ONNX Runtime с интерфейсом модуля: тензор (N, 3, H, W) -> тензор"""
+
+    def __init__(self, path: str, intra_threads: int = 0):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = intra_threads or torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # run потокобезопасен: одну сессию вызывают все потоки пула
+        array = x.detach().to(torch.float32).contiguous().numpy()
+        return torch.from_numpy(self.session.run(None, {self.input_name: array})[0])
+
+
+def backend_of(model: torch.nn.Module) -> str:
+    """Имя бэкенда, которым выполняется сеть"""
+    if isinstance(model, OrtModule):
+        return ONNX
+    if isinstance(model, torch.jit.ScriptModule):
+        return TORCHSCRIPT
+    return EAGER
+
+
+def export_path(key: str, fingerprint: str, backend: str) -> str:
+    safe_key = re.sub(r"[^\w.-]+", "_", key)
+    torch_version = torch.__version__.split("+")[0]
+    extension = "pt" if backend == TORCHSCRIPT else "onnx"
+    return os.path.join(COMPILED_DIR, f"{safe_key}.{backend}-{fingerprint}-torch{torch_version}.{extension}")
+
+
+def _example() -> torch.Tensor:
+    # Размер кратен 4: RRDBNet x2/x1 сворачивает вход pixel_unshuffle
+    return torch.rand(1, 3, 64, 64)
+
+
+def _export_torchscript(model: torch.nn.Module, path: str) -> None:
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), _example(), check_trace=False)
+        frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, path)
+
+
+def _export_onnx(model: torch.nn.Module, path: str) -> None:
+    axes = {0: "batch", 2: "height", 3: "width"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model.eval(),
+            (_example(),),
+            path,
+            input_names=["input"],
+            output_names=["output"],
+            dynamic_axes={"input": axes, "output": axes},
+            opset_version=17,
+            dynamo=False
+        )
+
+
+_EXPORTERS = {TORCHSCRIPT: _export_torchscript, ONNX: _export_onnx}
+
+
+def export(model: torch.nn.Module, key: str, backend: str, fingerprint: Optional[str] = None) -> str:
+    """
+    Экспорт сети в файл бэкенда (если его ещё нет)
+
+    Args:
+        model: Исходная сеть fp32 на CPU
+        key: Имя сети (часть имени файла)
+        backend: torchscript или onnx
+        fingerprint: Отпечаток весов (None - вычисляется)
+
+    Returns:
+        Путь к файлу экспорта
+    """
+    path = export_path(key, fingerprint or shared_weights.fingerprint(model.state_dict()), backend)
+    if os.path.exists(path):
+        return path
+
+    with shared_weights.export_lock(path):
+        if not os.path.exists(path):
+            logger.info(f"Экспорт {key} в {backend}: {path}")
+            # Запись атомарно: воркеры не увидят недописанный файл
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                _EXPORTERS[backend](model, tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return path
+
+
+def load(path: str, backend: str) -> torch.nn.Module:
+    """Загрузка экспортированной сети"""
+    if backend == ONNX:
+        return OrtModule(path, ORT_INTRA_THREADS)
+    module = torch.jit.load(path, map_location="cpu")
+    # Слияние операций под конкретный CPU (oneDNN) - после загрузки, не в файле
+    return torch.jit.optimize_for_inference(module)
+
+
+def build(model: torch.nn.Module, key: str, backend: str, fingerprint: Optional[str] = None) -> torch.nn.Module:
+    """
+    Сеть в заданном бэкенде (экспорт при первом обращении)
+
+    Raises:
+        RuntimeError: если бэкенд недоступен (нет onnxruntime)
+    """
+    if backend == EAGER:
+        return model
+    if backend == ONNX and not onnx_available():
+        raise RuntimeError("onnxruntime не установлен")
+    return load(export(model, key, backend, fingerprint), backend)
+
+
+def _run(model: torch.nn.Module, tiles: torch.Tensor) -> Tuple[np.ndarray, float]:
+    """Результат uint8 и медианное время прогона тайлов"""
+    samples = []
+    output = None
+    with torch.no_grad():
+        # Первый прогон не считается: JIT-профилирование и разогрев пулов
+        model(tiles)
+        for _ in range(PROBE_REPEATS):
+            start = time.perf_counter()
+            output = model(tiles)
+            samples.append(time.perf_counter() - start)
+    image = output.float().clamp_(0, 1).mul_(255.0).round_().byte().permute(0, 2, 3, 1).numpy()
+    return image, float(np.median(samples))
+
+
+def _choice_key(key: str, fingerprint: str) -> str:
+    """Выбор зависит от сети, версий, числа потоков и процессора"""
+    return f"{key}-{fingerprint}:torch{torch.__version__}:threads{torch.get_num_threads()}:{platform.processor() or platform.machine()}"
+
+
+def _read_choices() -> Dict[str, str]:
+    try:
+        with open(os.path.join(COMPILED_DIR, "choices.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_choice(choice_key: str, backend: str) -> None:
+    path = os.path.join(COMPILED_DIR, "choices.json")
+    choices = _read_choices()
+    choices[choice_key] = backend
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(choices, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def measure(
+    model: torch.nn.Module,
+    key: str,
+    backends: Optional[List[str]] = None
+) -> Dict[str, Dict[str, float]]:
+    """
+    Сборка и замер бэкендов на тайлах калибровочного набора
+
+    Returns:
+        {бэкенд: {"seconds": медиана прогона, "psnr_db": расхождение с eager}};
+        бэкенды, которые не собрались, - {"error": ...}
+    """
+    fingerprint = shared_weights.fingerprint(model.state_dict())
+    tiles = calibration_tiles(PROBE_TILES)
+    reference, eager_seconds = _run(model, tiles)
+    results: Dict[str, Dict[str, float]] = {EAGER: {"seconds": eager_seconds, "psnr_db": float("inf")}}
+
+    for backend in backends or BACKENDS:
+        if backend == EAGER:
+            continue
+        try:
+            output, seconds = _run(build(model, key, backend, fingerprint), tiles)
+            results[backend] = {"seconds": seconds, "psnr_db": psnr(reference, output)}
+        except Exception as e:
+            logger.warning(f"Бэкенд {backend} для {key} недоступен: {e}")
+            results[backend] = {"error": str(e)}
+    return results
+
+
+def _fastest(results: Dict[str, Dict[str, float]]) -> str:
+    """Самый быстрый из бэкендов, совпадающих с eager"""
+    valid = {}
+    for backend, result in results.items():
+        if "error" in result:
+            continue
+        if result["psnr_db"] < BACKEND_MIN_PSNR:
+            logger.warning(f"Бэкенд {backend} отклонён: PSNR {result['psnr_db']:.1f} дБ < {BACKEND_MIN_PSNR} дБ")
+            continue
+        valid[backend] = result["seconds"]
+    return min(valid, key=valid.get) if valid else EAGER
+
+
+def _choose(model: torch.nn.Module, key: str, fingerprint: str) -> str:
+    """Выбор бэкенда из choices.json; при MEASURE_BACKENDS - замер, если выбора нет"""
+    choice_key = _choice_key(key, fingerprint)
+    choice = _read_choices().get(choice_key)
+    if choice is not None or not MEASURE_BACKENDS:
+        return choice or EAGER
+
+    os.makedirs(COMPILED_DIR, exist_ok=True)
+    with shared_weights.export_lock(os.path.join(COMPILED_DIR, "choices.json")):
+        choice = _read_choices().get(choice_key)
+        if choice is None:
+            results = measure(model, key)
+            choice = _fastest(results)
+            summary = ", ".join(
+                f"{name} {result['seconds'] * 1000:.0f} мс" if "error" not in result else f"{name} -"
+                for name, result in results.items()
+            )
+            logger.info(f"Бэкенд {key}: {choice} ({summary})")
+            _write_choice(choice_key, choice)
+    return choice
+
+
+def compile_model(model: torch.nn.Module, key: str, backend: Optional[str] = None) -> torch.nn.Module:
+    """
+    Сеть в выбранном бэкенде с откатом на eager
+
+    Args:
+        model: Исходная сеть fp32 на CPU
+        key: Имя сети (файлы экспорта и запомненный выбор)
+        backend: auto, eager, torchscript или onnx (None - INFERENCE_BACKEND)
+
+    Returns:
+        Скомпилированная сеть или исходная
+    """
+    backend = resolve_backend(backend or INFERENCE_BACKEND)
+    if backend == AUTO and shared_weights.SHARED_WEIGHTS:
+        # Граф держал бы личную копию весов рядом с общей
+        logger.info(f"Бэкенд {key}: eager (SHARED_WEIGHTS=1; для замера auto - SHARED_WEIGHTS=0)")
+        return model
+    if backend == EAGER:
+        return model
+    parameter = next(model.parameters(), None)
+    if parameter is None or parameter.device.type != "cpu":
+        # Экспорт и замер рассчитаны на CPU
+        return model
+
+    fingerprint = shared_weights.fingerprint(model.state_dict())
+    if backend == AUTO:
+        backend = _choose(model, key, fingerprint)
+        if backend == EAGER:
+            return model
+    elif shared_weights.SHARED_WEIGHTS:
+        logger.warning(f"Бэкенд {backend} для {key}: веса графа - личная копия воркера, мимо SHARED_WEIGHTS")
+
+    try:
+        return build(model, key, backend, fingerprint)
+    except Exception as e:
+        logger.error(f"Бэкенд {backend} для {key} недоступен, используется eager: {e}")
+        return model
+
+
+def main() -> int:
+    """Замер бэкендов всех моделей апскейла и запись выбора (до старта воркеров)"""
+    global MEASURE_BACKENDS
+    from modes.upscale import get_upscaler
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    MEASURE_BACKENDS = True
+    if shared_weights.SHARED_WEIGHTS and resolve_backend(INFERENCE_BACKEND) == AUTO:
+        logger.info("SHARED_WEIGHTS=1: при auto воркеры работают на eager, замер не нужен")
+        return 0
+    try:
+        upscaler = asyncio.run(get_upscaler())
+    except Exception as e:
+        # Не мешаем старту воркеров: без выбора они работают на eager
+        logger.error(f"Замер бэкендов не выполнен: {e}")
+        return 0
+    logger.info(f"Бэкенды: {upscaler.backends()}; выбор в {os.path.join(COMPILED_DIR, 'choices.json')}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,346 @@
+"""
+Пакетная обработка: несколько изображений за один запрос
+
+Изображения проверяются по заголовку и декодируются параллельно, затем
+весь пакет уходит в режим одним заданием пула:
+- upscale: тайлы всех изображений идут через одну прогретую модель
+  общими батчами (TileEngine.enhance_many)
+- face_restore: лица всех изображений восстанавливаются общими батчами
+  GFPGAN
+- illustration, poster: изображения обрабатываются подряд в одном задании
+Результаты кодируются параллельно. Ошибка одного изображения не
+останавливает остальные - она попадает в манифест пакета.
+
+На входе можно передать zip-архив с изображениями: он раскрывается по
+оглавлению, размеры распакованных файлов проверяются до чтения.
+Ответ - поток zip или multipart/mixed, оба с manifest.json.
+
+Используется API (POST /batch/{mode}) и ботом (альбомы).
+
+Настройка через переменные окружения:
+- BATCH_MAX_FILES: максимум изображений в пакете
+- BATCH_MAX_MB: максимальный суммарный размер изображений пакета
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+import uuid
+import zipfile
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from modes.encoding import EncodeOptions, default_options
+from modes.executor import get_executor
+from modes.face_restore import get_face_restorer
+from modes.illustration import IllustrationProcessor
+from modes.metrics import count_error, stage_timer, track_job
+from modes.poster import PosterProcessor
+from modes.preflight import MAX_INPUT_BYTES, PreflightError, probe_bytes
+from modes.upscale import get_upscaler
+from modes.utils import ImageUtils
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "16"))
+BATCH_MAX_BYTES = int(float(os.getenv("BATCH_MAX_MB", "64")) * 1024 * 1024)
+
+MANIFEST_NAME = "manifest.json"
+ZIP_MAGIC = b"PK\x03\x04"
+
+
+class BatchError(ValueError):
+    """Пакет отклонён целиком"""
+
+    def __init__(self, message: str, status: int = 422):
+        super().__init__(message)
+        # HTTP-статус для API, как у PreflightError
+        self.status = status
+
+
+class BatchItem:
+    """Изображение пакета: вход, результат или ошибка"""
+
+    def __init__(self, name: str, data: Optional[bytes] = None, error: Optional[str] = None):
+        self.name = name
+        self.data = data
+        self.result: Optional[bytes] = None
+        self.error = error
+        # Имя результата в ответе (задаётся при упаковке)
+        self.output: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.result is not None
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "status": "done" if self.ok else "failed",
+            "file": self.output,
+            "size_bytes": len(self.result) if self.ok else None,
+            "error": self.error
+        }
+
+
+def is_zip(data: bytes) -> bool:
+    return data[:4] == ZIP_MAGIC
+
+
+def _entry_name(name: str) -> str:
+    """Имя файла без каталогов и кавычек (идёт в Content-Disposition и в архив)"""
+    name = os.path.basename(name.replace("\\", "/")) or "image"
+    return name.replace('"', "").replace("\r", "").replace("\n", "")
+
+
+def _expand_zip(name: str, data: bytes, room: int) -> List[BatchItem]:
+    """Изображения из архива; слишком большие файлы - с ошибкой, без чтения"""
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile:
+        return [BatchItem(_entry_name(name), error="Повреждённый zip-архив")]
+
+    items = []
+    with archive:
+        for info in archive.infolist():
+            base = os.path.basename(info.filename)
+            # Каталоги и служебные файлы macOS
+            if info.is_dir() or not base or base.startswith(".") or info.filename.startswith("__MACOSX/"):
+                continue
+            if len(items) >= room:
+                raise BatchError(f"Слишком много изображений (максимум {BATCH_MAX_FILES})", status=413)
+            if info.file_size > MAX_INPUT_BYTES:
+                items.append(BatchItem(
+                    _entry_name(base),
+                    error=f"Файл слишком большой (максимум {MAX_INPUT_BYTES // (1024 * 1024)} МБ)"
+                ))
+                continue
+            try:
+                items.append(BatchItem(_entry_name(base), archive.read(info)))
+            except (zipfile.BadZipFile, NotImplementedError, RuntimeError) as e:
+                # Битый элемент, неизвестное сжатие или шифрование
+                items.append(BatchItem(_entry_name(base), error=f"Не удалось распаковать: {e}"))
+    return items
+
+
+def expand_uploads(files: Sequence[Tuple[str, bytes]]) -> List[BatchItem]:
+    """
+    Элементы пакета из загруженных файлов, zip-архивы раскрываются
+
+    Raises:
+        BatchError: пакет пуст или превышает BATCH_MAX_FILES / BATCH_MAX_BYTES
+    """
+    items: List[BatchItem] = []
+    for name, data in files:
+        room = BATCH_MAX_FILES - len(items)
+        if is_zip(data):
+            items.extend(_expand_zip(name, data, room))
+        elif room <= 0:
+            raise BatchError(f"Слишком много изображений (максимум {BATCH_MAX_FILES})", status=413)
+        else:
+            items.append(BatchItem(_entry_name(name), data))
+
+    if not items:
+        raise BatchError("В пакете нет изображений")
+    if sum(len(item.data or b"") for item in items) > BATCH_MAX_BYTES:
+        raise BatchError(
+            f"Пакет слишком большой (максимум {BATCH_MAX_BYTES // (1024 * 1024)} МБ)", status=413
+        )
+    return items
+
+
+def _decode(item: BatchItem) -> Optional[np.ndarray]:
+    """Проверка заголовка и декодирование одного элемента (блокирующее)"""
+    try:
+        probe_bytes(item.data)
+    except PreflightError as e:
+        item.error = str(e)
+        return None
+    ok, img = ImageUtils.decode_bytes(item.data)
+    if not ok:
+        item.error = "Не удалось декодировать изображение"
+        return None
+    return img
+
+
+def _encode(result: Optional[np.ndarray], encoding: Optional[EncodeOptions]) -> Optional[bytes]:
+    return None if result is None else ImageUtils.encode_bytes(result, ".jpg", encoding)
+
+
+def _map_sync(func: Callable[[np.ndarray], np.ndarray], images: List[np.ndarray]) -> List[Optional[np.ndarray]]:
+    """Обработка изображений подряд в одном задании пула; ошибка - None для изображения"""
+    results = []
+    for img in images:
+        try:
+            results.append(func(img))
+        except Exception as e:
+            logger.error(f"Ошибка обработки изображения пакета: {e}")
+            results.append(None)
+    return results
+
+
+async def _upscale(
+    images: List[np.ndarray], model: Optional[str], precision: Optional[str]
+) -> List[Optional[np.ndarray]]:
+    upscaler = await get_upscaler()
+    return await upscaler.upscale_many(images, model=model, precision=precision)
+
+
+async def _face_restore(
+    images: List[np.ndarray], model: Optional[str], precision: Optional[str]
+) -> List[Optional[np.ndarray]]:
+    restorer = await get_face_restorer()
+    return await restorer.restore_many(images)
+
+
+async def _illustration(
+    images: List[np.ndarray], model: Optional[str], precision: Optional[str]
+) -> List[Optional[np.ndarray]]:
+    processor = IllustrationProcessor()
+    return await get_executor().run(
+        "illustration", _map_sync, lambda img: processor._stylize_sync(img, "fantasy", 0.8), images
+    )
+
+
+async def _poster(
+    images: List[np.ndarray], model: Optional[str], precision: Optional[str]
+) -> List[Optional[np.ndarray]]:
+    return await get_executor().run("poster", _map_sync, PosterProcessor()._apply_poster_effect, images)
+
+
+# Пакетные обработчики режимов: изображения BGR, модель, точность -> результаты (None - ошибка)
+BATCH_RUNNERS: Dict[
+    str, Callable[[List[np.ndarray], Optional[str], Optional[str]], Awaitable[List[Optional[np.ndarray]]]]
+] = {
+    "upscale": _upscale,
+    "face_restore": _face_restore,
+    "illustration": _illustration,
+    "poster": _poster
+}
+
+
+async def process_batch(
+    mode: str,
+    items: List[BatchItem],
+    model: Optional[str] = None,
+    encoding: Optional[EncodeOptions] = None,
+    precision: Optional[str] = None
+) -> List[BatchItem]:
+    """
+    Обработка пакета режимом
+
+    Элементы с уже заданной ошибкой или результатом (например, из кеша)
+    пропускаются. Результаты и ошибки записываются в сами элементы.
+
+    Raises:
+        ExecutorBusy: очередь режима заполнена
+    """
+    pending = [item for item in items if item.error is None and item.result is None]
+    if not pending:
+        return items
+
+    label = f"{mode}_batch"
+    with track_job(label):
+        with stage_timer(label, "decode"):
+            decoded = await asyncio.gather(*[asyncio.to_thread(_decode, item) for item in pending])
+        ready = [(item, img) for item, img in zip(pending, decoded) if img is not None]
+        for item in pending:
+            if item.error is not None:
+                count_error(mode, "decode")
+
+        if ready:
+            try:
+                results = await BATCH_RUNNERS[mode]([img for _, img in ready], model, precision)
+            except RuntimeError as e:
+                # Модель режима не загрузилась - ошибка у всего пакета
+                logger.error(str(e))
+                results = [None] * len(ready)
+
+            with stage_timer(label, "encode"):
+                encoded = await asyncio.gather(*[
+                    asyncio.to_thread(_encode, result, encoding) for result in results
+                ])
+
+            for (item, _), data in zip(ready, encoded):
+                item.result = data
+                if data is None:
+                    item.error = "Не удалось обработать изображение"
+
+        # Входные байты больше не нужны
+        for item in pending:
+            item.data = None
+
+    logger.info(f"Пакет {mode}: {sum(item.ok for item in items)}/{len(items)} изображений")
+    return items
+
+
+def name_outputs(items: List[BatchItem], encoding: Optional[EncodeOptions] = None) -> None:
+    """Уникальные имена результатов: номер в пакете, имя входа, расширение формата"""
+    ext = (encoding or default_options()).ext
+    for index, item in enumerate(items, start=1):
+        if item.ok:
+            item.output = f"{index:03d}-{os.path.splitext(item.name)[0]}{ext}"
+
+
+def manifest(items: List[BatchItem]) -> bytes:
+    return json.dumps(
+        {"items": [item.as_dict() for item in items]}, ensure_ascii=False, indent=2
+    ).encode("utf-8")
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Поток без перемотки для zipfile: записанное забирается порциями"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(items: List[BatchItem]) -> Iterator[bytes]:
+    """
+    Zip-архив результатов по частям, по мере записи элементов
+
+    Результаты уже сжаты (JPEG/PNG/WebP), поэтому ZIP_STORED. Поток без
+    перемотки - размеры пишутся в дескрипторы данных после каждого файла.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for item in items:
+            if item.ok:
+                archive.writestr(item.output, item.result)
+                yield buffer.drain()
+        archive.writestr(MANIFEST_NAME, manifest(items))
+    yield buffer.drain()
+
+
+def multipart_boundary() -> str:
+    return f"batch-{uuid.uuid4().hex}"
+
+
+def stream_multipart(items: List[BatchItem], boundary: str, media_type: str) -> Iterator[bytes]:
+    """multipart/mixed: манифест первой частью, затем результаты"""
+    parts = [(MANIFEST_NAME, manifest(items), "application/json")]
+    parts.extend((item.output, item.result, media_type) for item in items if item.ok)
+
+    for name, data, content_type in parts:
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f'Content-Disposition: attachment; filename="{name}"\r\n'
+            f"Content-Length: {len(data)}\r\n\r\n"
+        ).encode("utf-8") + data + b"\r\n"
+    yield f"--{boundary}--\r\n".encode("utf-8")
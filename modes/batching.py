@@ -0,0 +1,136 @@
+"""
+Микробатчинг запросов к одной модели
+
+Параллельные запросы апскейла к одной и той же сети присылают свои тайлы
+в общий планировщик. Он ждёт не дольше max_wait_ms (или пока не наберётся
+max_batch тайлов), склеивает тайлы в один батч и делает один прямой проход,
+после чего раздаёт результаты обратно вызывающим потокам.
+
+Тайлы разного размера раскладываются по корзинам (размер округляется вверх
+до кратного bucket) и дополняются повтором краевых пикселей, лишнее
+обрезается на выходе. Дополняется каждый тайл не по размеру корзины, даже
+если он в батче один: результат не зависит от того, с какими запросами
+тайл попал в батч (иначе кеш результатов хранил бы случайный вариант).
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Сборщик тайлов нескольких запросов в общий батч"""
+
+    def __init__(
+        self,
+        forward: Callable[[torch.Tensor], torch.Tensor],
+        scale: int,
+        max_batch: int = 8,
+        max_wait_ms: float = 20,
+        bucket: int = 32
+    ):
+        """
+        Args:
+            forward: Прямой проход сети (N, C, H, W) -> (N, C, H*scale, W*scale)
+            scale: Масштаб сети (для обрезки дополненных краёв)
+            max_batch: Максимум тайлов в одном проходе
+            max_wait_ms: Сколько ждать попутчиков после первого тайла
+            bucket: Шаг округления размеров тайлов
+        """
+        self.forward = forward
+        self.scale = scale
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.bucket = bucket
+        self._queue: "queue.Queue[Tuple[torch.Tensor, Future]]" = queue.Queue()
+        self.stats = {"batches": 0, "tiles": 0}
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def infer(self, batch: torch.Tensor) -> torch.Tensor:
+        """
+        Прогон тайлов через общий батч (блокирует вызывающий поток)
+
+        Args:
+            batch: Тайлы одного запроса (N, C, H, W)
+
+        Returns:
+            Результат сети для этих тайлов
+        """
+        future: Future = Future()
+        self._queue.put((batch, future))
+        return future.result()
+
+    def _bucket_shape(self, tensor: torch.Tensor) -> Tuple[int, int]:
+        h, w = tensor.shape[-2:]
+        return (-(-h // self.bucket) * self.bucket, -(-w // self.bucket) * self.bucket)
+
+    def _collect(self) -> List[Tuple[torch.Tensor, Future]]:
+        """Первый запрос ждём без ограничения, попутчиков - до max_wait"""
+        items = [self._queue.get()]
+        tiles = items[0][0].shape[0]
+        deadline = time.monotonic() + self.max_wait
+
+        while tiles < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            items.append(item)
+            tiles += item[0].shape[0]
+
+        return items
+
+    def _loop(self) -> None:
+        while True:
+            items = self._collect()
+
+            buckets: Dict[Tuple[int, int], List[Tuple[torch.Tensor, Future]]] = defaultdict(list)
+            for batch, future in items:
+                buckets[self._bucket_shape(batch)].append((batch, future))
+
+            for shape, group in buckets.items():
+                try:
+                    self._run_group(shape, group)
+                except Exception as e:
+                    logger.error(f"Ошибка батчевого инференса: {e}")
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def _run_group(
+        self,
+        shape: Tuple[int, int],
+        group: List[Tuple[torch.Tensor, Future]]
+    ) -> None:
+        bucket_h, bucket_w = shape
+        padded = []
+        for batch, _ in group:
+            h, w = batch.shape[-2:]
+            if (h, w) != shape:
+                batch = F.pad(batch, (0, bucket_w - w, 0, bucket_h - h), mode="replicate")
+            padded.append(batch)
+
+        with torch.no_grad():
+            output = self.forward(torch.cat(padded))
+        self.stats["batches"] += 1
+        self.stats["tiles"] += output.shape[0]
+
+        offset = 0
+        for batch, future in group:
+            n = batch.shape[0]
+            h, w = batch.shape[-2:]
+            future.set_result(output[offset:offset + n, :, :h * self.scale, :w * self.scale])
+            offset += n
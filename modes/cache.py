@@ -0,0 +1,261 @@
+"""
+Кеш результатов обработки по содержимому
+
+Ключ - хеш входного изображения + режим + модель + параметры, поэтому
+повторная отправка той же фотографии (или повтор после таймаута) отдаётся
+из кеша без повторного инференса.
+
+Два уровня:
+- память: LRU с ограничением по суммарному размеру
+- диск (опционально): каталог с файлами, вытеснение самых старых
+
+Настройка через переменные окружения:
+- RESULT_CACHE_MB: размер кеша в памяти (0 - отключить)
+- RESULT_CACHE_DIR: каталог дискового кеша (не задан - только память)
+- RESULT_CACHE_DISK_MB: размер дискового кеша
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from modes.utils import FileUtils
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """Двухуровневый LRU-кеш результатов"""
+
+    def __init__(
+        self,
+        max_memory_bytes: int = 64 * 1024 * 1024,
+        disk_dir: Optional[str] = None,
+        max_disk_bytes: int = 512 * 1024 * 1024
+    ):
+        """
+        Args:
+            max_memory_bytes: Лимит памяти для результатов
+            disk_dir: Каталог дискового уровня (None - без диска)
+            max_disk_bytes: Лимит дискового уровня
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self.stats_counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> "ResultCache":
+        """Создание кеша по переменным окружения"""
+        return cls(
+            max_memory_bytes=int(os.getenv("RESULT_CACHE_MB", "64")) * 1024 * 1024,
+            disk_dir=os.getenv("RESULT_CACHE_DIR") or None,
+            max_disk_bytes=int(os.getenv("RESULT_CACHE_DISK_MB", "512")) * 1024 * 1024
+        )
+
+    @staticmethod
+    def make_key(
+        digest: str,
+        mode: str,
+        model: str = "auto",
+        params: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        Построение ключа кеша
+
+        Args:
+            digest: Хеш входного изображения
+            mode: Режим обработки (upscale, face_restore, ...)
+            model: Модель или внешний сервис
+            params: Параметры обработки (scale, tile_size, style, ...)
+
+        Returns:
+            Ключ кеша
+        """
+        payload = json.dumps(
+            {"digest": digest, "mode": mode, "model": model, "params": params or {}},
+            sort_keys=True,
+            default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.bin")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Поиск результата: сначала память, затем диск"""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.stats_counters["hits"] += 1
+                return value
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "rb") as f:
+                    value = f.read()
+                os.utime(path)
+            except FileNotFoundError:
+                value = None
+            except Exception as e:
+                logger.warning(f"Ошибка чтения кеша {path}: {e}")
+                value = None
+
+            if value is not None:
+                self._put_memory(key, value)
+                with self._lock:
+                    self.stats_counters["disk_hits"] += 1
+                return value
+
+        with self._lock:
+            self.stats_counters["misses"] += 1
+        return None
+
+    def put(self, key: str, value: bytes) -> None:
+        """Сохранение результата в оба уровня"""
+        self._put_memory(key, value)
+        if self.disk_dir:
+            self._put_disk(key, value)
+
+    def put_file(self, key: str, path: str) -> None:
+        """Сохранение результата из файла (на диск - копированием, без чтения в память)"""
+        size = os.path.getsize(path)
+        if size <= self.max_memory_bytes:
+            with open(path, "rb") as f:
+                self._put_memory(key, f.read())
+        if self.disk_dir:
+            self._put_disk_file(key, path)
+
+    def _put_memory(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_memory_bytes:
+            return
+
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_size -= len(old)
+
+            self._memory[key] = value
+            self._memory_size += len(value)
+
+            while self._memory_size > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+                self.stats_counters["evictions"] += 1
+
+    def _put_disk(self, key: str, value: bytes) -> None:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.part"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except Exception as e:
+            logger.warning(f"Ошибка записи кеша {path}: {e}")
+            FileUtils.safe_remove([tmp_path])
+
+    def _put_disk_file(self, key: str, src: str) -> None:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.part"
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except Exception as e:
+            logger.warning(f"Ошибка записи кеша {path}: {e}")
+            FileUtils.safe_remove([tmp_path])
+
+    def _evict_disk(self) -> None:
+        """Удаление самых давно использованных файлов сверх лимита"""
+        entries = []
+        total = 0
+        with os.scandir(self.disk_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".bin"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        if total <= self.max_disk_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            if FileUtils.safe_remove([path]):
+                total -= size
+                with self._lock:
+                    self.stats_counters["evictions"] += 1
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        """Асинхронный поиск (дисковый уровень читается вне event loop)"""
+        if not self.disk_dir:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, value: bytes) -> None:
+        """Асинхронное сохранение (запись на диск вне event loop)"""
+        if not self.disk_dir:
+            self.put(key, value)
+            return
+        await asyncio.to_thread(self.put, key, value)
+
+    async def aput_file(self, key: str, path: str) -> None:
+        """Асинхронное сохранение результата из файла"""
+        await asyncio.to_thread(self.put_file, key, path)
+
+    def stats(self) -> Dict[str, Any]:
+        """Счётчики попаданий и заполненность кеша"""
+        with self._lock:
+            lookups = (
+                self.stats_counters["hits"]
+                + self.stats_counters["disk_hits"]
+                + self.stats_counters["misses"]
+            )
+            hits = self.stats_counters["hits"] + self.stats_counters["disk_hits"]
+            return {
+                **self.stats_counters,
+                "entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+
+
+# Общий кеш процесса (ленивый синглтон)
+_global_cache: Optional[ResultCache] = None
+_cache_guard = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """Получение кеша результатов текущего процесса"""
+    global _global_cache
+    if _global_cache is None:
+        with _cache_guard:
+            if _global_cache is None:
+                _global_cache = ResultCache.from_env()
+    return _global_cache
@@ -0,0 +1,381 @@
+"""
+Кодирование результатов обработки
+
+Формат и параметры выхода задаёт запрос API (query-параметры) или
+пользователь бота (/format): JPEG, PNG или WebP, качество, прогрессивный
+JPEG, оптимизация таблиц Хаффмана, субдискретизация цветности.
+
+Режим "не больше N МБ" подбирает максимальное качество, при котором
+результат помещается в лимит. Размер файла почти линейно зависит от
+качества в логарифмической шкале, поэтому следующее качество берётся
+интерполяцией между уже закодированными вариантами (обычно 2-4 попытки
+вместо 6-7 у двоичного поиска). Если не помещается даже минимальное
+качество (или формат без потерь), изображение уменьшается.
+
+Кодирование блокирующее: из async-кода его вызывают через
+asyncio.to_thread (ImageUtils.encode_image).
+
+Значения по умолчанию через переменные окружения:
+- OUTPUT_FORMAT: jpeg, png или webp
+- OUTPUT_QUALITY: качество JPEG/WebP (1-100)
+- OUTPUT_PROGRESSIVE, OUTPUT_OPTIMIZE: флаги JPEG (1/0)
+- OUTPUT_SUBSAMPLING: 4:4:4, 4:2:2 или 4:2:0
+- OUTPUT_MAX_MB: лимит размера результата (0 - без лимита)
+"""
+
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    "jpeg": {"ext": ".jpg", "media_type": "image/jpeg", "lossy": True},
+    "png": {"ext": ".png", "media_type": "image/png", "lossy": False},
+    "webp": {"ext": ".webp", "media_type": "image/webp", "lossy": True}
+}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+
+SUBSAMPLING = {
+    "4:4:4": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+    "4:2:2": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+    "4:2:0": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420
+}
+
+# Ниже этого качества артефакты заметнее, чем потеря разрешения
+MIN_QUALITY = 40
+MAX_ATTEMPTS = 8
+MAX_DOWNSCALES = 4
+# Подбор качества сначала идёт на копии примерно такой площади
+PROXY_PIXELS = 1_000_000
+PROXY_TILE = 128
+# Запас при уменьшении: размер падает чуть медленнее площади
+DOWNSCALE_MARGIN = 0.9
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes", "on")
+
+
+class EncodeOptions:
+    """Параметры кодирования результата"""
+
+    def __init__(
+        self,
+        format: str = "jpeg",
+        quality: int = 92,
+        progressive: bool = True,
+        optimize: bool = True,
+        subsampling: str = "4:2:0",
+        max_bytes: int = 0
+    ):
+        """
+        Args:
+            format: jpeg, png или webp
+            quality: Качество JPEG/WebP (1-100)
+            progressive: Прогрессивный JPEG
+            optimize: Оптимизация JPEG / сильное сжатие PNG
+            subsampling: Субдискретизация цветности JPEG
+            max_bytes: Лимит размера результата (0 - без лимита)
+
+        Raises:
+            ValueError: если параметр недопустим
+        """
+        format = FORMAT_ALIASES.get(format.lower(), format.lower())
+        if format not in FORMATS:
+            raise ValueError(f"Неподдерживаемый формат: {format} (jpeg, png, webp)")
+        if not 1 <= quality <= 100:
+            raise ValueError("Качество должно быть от 1 до 100")
+        if subsampling not in SUBSAMPLING:
+            raise ValueError(f"Неподдерживаемая субдискретизация: {subsampling} (4:4:4, 4:2:2, 4:2:0)")
+        if max_bytes < 0:
+            raise ValueError("Лимит размера не может быть отрицательным")
+
+        self.format = format
+        self.quality = quality
+        self.progressive = progressive
+        self.optimize = optimize
+        self.subsampling = subsampling
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_env(cls) -> "EncodeOptions":
+        return cls(
+            format=os.getenv("OUTPUT_FORMAT", "jpeg"),
+            quality=int(os.getenv("OUTPUT_QUALITY", "92")),
+            progressive=_env_flag("OUTPUT_PROGRESSIVE", "1"),
+            optimize=_env_flag("OUTPUT_OPTIMIZE", "1"),
+            subsampling=os.getenv("OUTPUT_SUBSAMPLING", "4:2:0"),
+            max_bytes=int(float(os.getenv("OUTPUT_MAX_MB", "0")) * 1024 * 1024)
+        )
+
+    @classmethod
+    def from_params(
+        cls,
+        format: Optional[str] = None,
+        quality: Optional[int] = None,
+        progressive: Optional[bool] = None,
+        optimize: Optional[bool] = None,
+        subsampling: Optional[str] = None,
+        max_mb: Optional[float] = None,
+        base: Optional["EncodeOptions"] = None
+    ) -> "EncodeOptions":
+        """Параметры запроса поверх значений по умолчанию (None - не задано)"""
+        base = base or default_options()
+        return cls(
+            format=format if format is not None else base.format,
+            quality=quality if quality is not None else base.quality,
+            progressive=progressive if progressive is not None else base.progressive,
+            optimize=optimize if optimize is not None else base.optimize,
+            subsampling=subsampling if subsampling is not None else base.subsampling,
+            max_bytes=int(max_mb * 1024 * 1024) if max_mb is not None else base.max_bytes
+        )
+
+    @classmethod
+    def for_extension(cls, ext: str) -> "EncodeOptions":
+        """Значения по умолчанию с форматом по расширению файла (.jpg, .png, .webp)"""
+        base = default_options()
+        format = FORMAT_ALIASES.get(ext.lower().lstrip("."), ext.lower().lstrip("."))
+        if format not in FORMATS:
+            raise ValueError(f"Неподдерживаемое расширение: {ext}")
+        return cls.from_params(format=format, base=base)
+
+    @property
+    def ext(self) -> str:
+        return FORMATS[self.format]["ext"]
+
+    @property
+    def media_type(self) -> str:
+        return FORMATS[self.format]["media_type"]
+
+    @property
+    def lossy(self) -> bool:
+        return FORMATS[self.format]["lossy"]
+
+    def cache_tag(self) -> str:
+        """Строка для ключа кеша: разные параметры - разные результаты"""
+        return (
+            f"{self.format}:q{self.quality}:p{int(self.progressive)}:o{int(self.optimize)}:"
+            f"{self.subsampling}:max{self.max_bytes}"
+        )
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "format": self.format,
+            "quality": self.quality,
+            "progressive": self.progressive,
+            "optimize": self.optimize,
+            "subsampling": self.subsampling,
+            "max_bytes": self.max_bytes
+        }
+
+
+class EncodedImage:
+    """Результат кодирования"""
+
+    def __init__(self, data: bytes, options: EncodeOptions, quality: int, scale: float, attempts: int):
+        """
+        Args:
+            data: Закодированные байты
+            options: Запрошенные параметры
+            quality: Фактическое качество (при подборе под лимит - меньше запрошенного)
+            scale: Во сколько раз уменьшено изображение, чтобы поместиться в лимит
+            attempts: Сколько раз изображение кодировалось
+        """
+        self.data = data
+        self.options = options
+        self.quality = quality
+        self.scale = scale
+        self.attempts = attempts
+
+    @property
+    def media_type(self) -> str:
+        return self.options.media_type
+
+
+_default_options: Optional[EncodeOptions] = None
+
+
+def default_options() -> EncodeOptions:
+    """Параметры по умолчанию из переменных окружения"""
+    global _default_options
+    if _default_options is None:
+        _default_options = EncodeOptions.from_env()
+    return _default_options
+
+
+def _params(options: EncodeOptions, quality: int) -> List[int]:
+    if options.format == "jpeg":
+        return [
+            cv2.IMWRITE_JPEG_QUALITY, quality,
+            cv2.IMWRITE_JPEG_PROGRESSIVE, int(options.progressive),
+            cv2.IMWRITE_JPEG_OPTIMIZE, int(options.optimize),
+            cv2.IMWRITE_JPEG_SAMPLING_FACTOR, SUBSAMPLING[options.subsampling]
+        ]
+    if options.format == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    return [cv2.IMWRITE_PNG_COMPRESSION, 9 if options.optimize else 3]
+
+
+def _encode_once(image: np.ndarray, options: EncodeOptions, quality: int) -> bytes:
+    success, buffer = cv2.imencode(options.ext, image, _params(options, quality))
+    if not success:
+        raise ValueError(f"Ошибка кодирования в {options.format}")
+    return buffer.tobytes()
+
+
+def _search(
+    image: np.ndarray,
+    options: EncodeOptions,
+    budget: int,
+    high: Tuple[int, int],
+    counter: List[int],
+    hint: Optional[int] = None
+) -> Tuple[Optional[Tuple[bytes, int]], int]:
+    """
+    Максимальное качество, при котором результат не больше budget
+
+    Args:
+        high: (качество, размер) заведомо не помещающегося варианта
+        hint: Ожидаемое качество (из поиска по уменьшенной копии)
+
+    Returns:
+        ((байты, качество) или None, если не помещается даже MIN_QUALITY;
+        размер при нижней проверенной границе)
+    """
+    high_q, high_size = high
+    floor = min(MIN_QUALITY, high_q)
+    low_q = hint if hint is not None and floor <= hint < high_q else floor
+    low = _encode_once(image, options, low_q)
+    counter[0] += 1
+    if len(low) > budget and low_q > floor:
+        # Подсказка оказалась завышенной - она становится верхней границей
+        high_q, high_size = low_q, len(low)
+        low_q = floor
+        low = _encode_once(image, options, low_q)
+        counter[0] += 1
+    if len(low) > budget:
+        return None, len(low)
+    best = (low, low_q)
+
+    # Интерполяция по log(размер) между границами: внизу помещается, вверху нет
+    low_size = len(low)
+    while high_q - low_q > 1 and counter[0] < MAX_ATTEMPTS:
+        if high_size > low_size:
+            ratio = (math.log(budget) - math.log(low_size)) / (math.log(high_size) - math.log(low_size))
+        else:
+            ratio = 0.5
+        quality = low_q + int(ratio * (high_q - low_q))
+        quality = min(max(quality, low_q + 1), high_q - 1)
+
+        data = _encode_once(image, options, quality)
+        counter[0] += 1
+        if len(data) <= budget:
+            best, low_q, low_size = (data, quality), quality, len(data)
+        else:
+            high_q, high_size = quality, len(data)
+    return best, low_size
+
+
+def _mosaic(image: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Мозаика из равномерно расположенных тайлов исходного разрешения
+
+    Уменьшенная копия для оценки размера не годится: усреднение убирает
+    мелкие детали и шум, и копия сжимается заметно лучше оригинала.
+    Тайлы без масштабирования сохраняют статистику пикселей.
+    """
+    height, width = image.shape[:2]
+    grid = int(math.sqrt(PROXY_PIXELS)) // PROXY_TILE
+    if height * width < 2 * PROXY_PIXELS or min(height, width) < grid * PROXY_TILE:
+        return None
+    ys = np.linspace(0, height - PROXY_TILE, grid).astype(int)
+    xs = np.linspace(0, width - PROXY_TILE, grid).astype(int)
+    return np.vstack([
+        np.hstack([image[y:y + PROXY_TILE, x:x + PROXY_TILE] for x in xs])
+        for y in ys
+    ])
+
+
+def _proxy_hint(image: np.ndarray, options: EncodeOptions) -> Optional[int]:
+    """
+    Качество, найденное на мозаике (примерно PROXY_PIXELS пикселей)
+
+    Мозаика кодируется на порядок быстрее полного изображения (WebP 4K -
+    секунды на попытку), а её размер на пиксель близок к полному, поэтому
+    полноразмерный поиск начинается с узкой вилки и уточняет её за 1-2 попытки.
+    """
+    proxy = _mosaic(image)
+    if proxy is None:
+        return None
+    area = proxy.shape[0] * proxy.shape[1] / (image.shape[0] * image.shape[1])
+    budget = int(options.max_bytes * area)
+    first = len(_encode_once(proxy, options, options.quality))
+    if first <= budget:
+        return options.quality
+    fitted, _ = _search(proxy, options, budget, (options.quality, first), [0])
+    return fitted[1] if fitted is not None else None
+
+
+def encode(image: np.ndarray, options: Optional[EncodeOptions] = None) -> EncodedImage:
+    """
+    Кодирование изображения BGR (блокирующее)
+
+    Raises:
+        ValueError: если изображение не удалось закодировать
+    """
+    options = options or default_options()
+    counter = [1]
+    data = _encode_once(image, options, options.quality)
+    if not options.max_bytes or len(data) <= options.max_bytes:
+        return EncodedImage(data, options, options.quality, 1.0, counter[0])
+
+    scale = 1.0
+    current = image
+    for _ in range(MAX_DOWNSCALES + 1):
+        if options.lossy:
+            hint = _proxy_hint(current, options)
+            fitted, smallest = _search(
+                current, options, options.max_bytes, (options.quality, len(data)), counter, hint
+            )
+            if fitted is not None:
+                return EncodedImage(fitted[0], options, fitted[1], scale, counter[0])
+        else:
+            smallest = len(data)
+
+        # Даже минимальное качество не помещается - уменьшаем изображение
+        factor = math.sqrt(options.max_bytes / smallest) * DOWNSCALE_MARGIN
+        scale *= factor
+        height, width = image.shape[:2]
+        current = cv2.resize(
+            image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA
+        )
+        data = _encode_once(current, options, options.quality)
+        counter[0] += 1
+        if len(data) <= options.max_bytes:
+            return EncodedImage(data, options, options.quality, scale, counter[0])
+
+    logger.warning(f"Не удалось уложиться в {options.max_bytes} байт, отдаём {len(data)}")
+    return EncodedImage(data, options, options.quality, scale, counter[0])
+
+
+def sniff_media_type(data: bytes) -> str:
+    """MIME-тип по сигнатуре файла (для результатов из кеша и заданий)"""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def extension_for(media_type: str) -> str:
+    for config in FORMATS.values():
+        if config["media_type"] == media_type:
+            return config["ext"]
+    return ".bin"
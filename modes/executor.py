@@ -0,0 +1,176 @@
+"""
+Общий пул для тяжёлых вычислений режимов
+
+Инференс и обработка OpenCV выполняются в пуле потоков, а не в event loop,
+поэтому /ping и остальные запросы не ждут, пока обрабатывается картинка.
+На каждый режим действует свой лимит параллельности и лимит очереди:
+при переполнении запрос сразу отклоняется с ExecutorBusy.
+
+Настройка через переменные окружения:
+- INFERENCE_WORKERS: размер пула потоков (по умолчанию - число ядер,
+  но не меньше суммы лимитов режимов)
+- MODE_CONCURRENCY: лимиты режимов, например "upscale=1,face_restore=2";
+  по умолчанию "upscale=2" - два апскейла сразу делят общий батч тайлов
+  (см. modes/batching.py)
+- MODE_DEFAULT_CONCURRENCY: лимит для остальных режимов
+- MODE_QUEUE_LIMIT: сколько запросов режима может ждать своей очереди
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional
+
+from modes.metrics import STAGE_SECONDS, report_stage
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorBusy(Exception):
+    """Очередь режима заполнена - запрос нужно повторить позже"""
+
+    def __init__(self, mode: str, retry_after: int = 5):
+        super().__init__(f"Режим {mode} перегружен, повторите позже")
+        self.mode = mode
+        self.retry_after = retry_after
+
+
+def _parse_limits(value: str) -> Dict[str, int]:
+    """Разбор строки вида "upscale=1,face_restore=2" """
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        mode, _, limit = item.partition("=")
+        try:
+            limits[mode.strip()] = max(1, int(limit))
+        except ValueError:
+            logger.warning(f"Некорректный лимит режима: {item}")
+    return limits
+
+
+class InferenceExecutor:
+    """Ограниченный пул выполнения для всех режимов"""
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        concurrency: Optional[Dict[str, int]] = None,
+        default_concurrency: int = 1,
+        queue_limit: int = 8
+    ):
+        """
+        Args:
+            max_workers: Размер пула потоков
+            concurrency: Лимиты параллельности по режимам
+            default_concurrency: Лимит для режимов, не указанных явно
+            queue_limit: Максимум ожидающих запросов на режим
+        """
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        # Потоков не меньше суммы лимитов: при микробатчинге поток запроса
+        # ждёт общий батч и не должен занимать место соседнего запроса
+        self.max_workers = max_workers or max(
+            os.cpu_count() or 1,
+            sum(self.concurrency.values()) + self.default_concurrency
+        )
+        self.queue_limit = queue_limit
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="inference"
+        )
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._pending: Dict[str, int] = {}
+        self._running: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls) -> "InferenceExecutor":
+        """Создание пула по переменным окружения"""
+        workers = os.getenv("INFERENCE_WORKERS")
+        return cls(
+            max_workers=int(workers) if workers else None,
+            concurrency=_parse_limits(os.getenv("MODE_CONCURRENCY", "upscale=2")),
+            default_concurrency=int(os.getenv("MODE_DEFAULT_CONCURRENCY", "1")),
+            queue_limit=int(os.getenv("MODE_QUEUE_LIMIT", "8"))
+        )
+
+    def limit(self, mode: str) -> int:
+        return self.concurrency.get(mode, self.default_concurrency)
+
+    def _semaphore(self, mode: str) -> asyncio.Semaphore:
+        if mode not in self._semaphores:
+            self._semaphores[mode] = asyncio.Semaphore(self.limit(mode))
+        return self._semaphores[mode]
+
+    def is_saturated(self, mode: str) -> bool:
+        """Заполнены ли все слоты и очередь режима"""
+        return self._pending.get(mode, 0) >= self.limit(mode) + self.queue_limit
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Текущая загрузка по режимам"""
+        return {
+            mode: {
+                "pending": self._pending.get(mode, 0),
+                "running": self._running.get(mode, 0),
+                "limit": self.limit(mode)
+            }
+            for mode in set(self._pending) | set(self.concurrency)
+        }
+
+    async def run(self, mode: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Выполнение синхронной функции режима в пуле
+
+        Args:
+            mode: Режим, по которому считаются лимиты
+            func: Синхронная функция (инференс, OpenCV)
+
+        Returns:
+            Результат func
+
+        Raises:
+            ExecutorBusy: если очередь режима заполнена
+        """
+        if self.is_saturated(mode):
+            raise ExecutorBusy(mode)
+
+        self._pending[mode] = self._pending.get(mode, 0) + 1
+        queued_at = time.perf_counter()
+        try:
+            semaphore = self._semaphore(mode)
+            if semaphore.locked():
+                report_stage("queue")
+            async with semaphore:
+                # Ожидание слота режима - отдельная стадия в метриках
+                STAGE_SECONDS.labels(mode, "queue").observe(time.perf_counter() - queued_at)
+                self._running[mode] = self._running.get(mode, 0) + 1
+                try:
+                    loop = asyncio.get_running_loop()
+                    # Контекст вызывающего (слушатель стадий задания) доступен в потоке пула
+                    context = contextvars.copy_context()
+                    return await loop.run_in_executor(self._pool, partial(context.run, func, *args, **kwargs))
+                finally:
+                    self._running[mode] -= 1
+        finally:
+            self._pending[mode] -= 1
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
+
+
+# Общий пул процесса (ленивый синглтон)
+_global_executor: Optional[InferenceExecutor] = None
+_executor_guard = threading.Lock()
+
+
+def get_executor() -> InferenceExecutor:
+    """Получение пула выполнения текущего процесса"""
+    global _global_executor
+    if _global_executor is None:
+        with _executor_guard:
+            if _global_executor is None:
+                _global_executor = InferenceExecutor.from_env()
+    return _global_executor
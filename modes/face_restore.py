@@ -1,33 +1,94 @@
+import asyncio
 import cv2
 import numpy as np
 import os
 import logging
-from typing import Optional, Tuple
+import torch
+from typing import List, Optional, Sequence, Tuple
 from datetime import datetime
+from modes.encoding import EncodeOptions
+from modes.executor import ExecutorBusy, get_executor
+from modes.metrics import count_error, stage_timer, track_job
+from modes.registry import get_registry
 from modes.utils import ImageUtils, ModelLoader, Logger
 
 logger = logging.getLogger(__name__)
 
+# Сколько выровненных лиц проходит через сеть одним батчем
+FACE_BATCH_SIZE = int(os.getenv("FACE_BATCH_SIZE", "8"))
+# Лица ищутся на копии с такой длинной стороной (детектор - самая дорогая часть на фото без лиц)
+FACE_DETECT_SIDE = int(os.getenv("FACE_DETECT_SIDE", "1024"))
+FACE_MAX_FACES = int(os.getenv("FACE_MAX_FACES", "32"))
+# Фон: resize (Lanczos) или realesrgan (общий апскейлер, заметно дольше)
+FACE_BACKGROUND = os.getenv("FACE_BACKGROUND", "resize")
+
+FACE_SIZE = 512
+# Модели, которые умеет собирать ModelLoader.load_model
+SUPPORTED_MODELS = ("GFPGAN",)
+FACE_DET_THRESHOLD = 0.97
+FACE_EYE_DIST_THRESHOLD = 5
+MASK_BORDER = 10
+
+# Шаблон пяти точек лица FFHQ 512x512 (глаза, нос, уголки рта)
+FACE_TEMPLATE = np.array([
+    [192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935],
+    [201.26117, 371.41043], [313.08905, 371.15118]
+], dtype=np.float32) * (FACE_SIZE / 512.0)
+
+# Классы ParseNet, входящие в маску лица (фон, шея, одежда, волосы, шляпа - нет)
+PARSE_FACE_LABELS = np.array(
+    [0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 0, 0, 0], dtype=np.float32
+)
+
+
+def _square_mask() -> np.ndarray:
+    """Квадратная маска с размытым краем, если модели разметки лица нет"""
+    mask = np.zeros((FACE_SIZE, FACE_SIZE), dtype=np.float32)
+    edge = FACE_SIZE // 16
+    mask[edge:-edge, edge:-edge] = 1.0
+    return cv2.GaussianBlur(mask, (2 * edge + 1, 2 * edge + 1), 0)
+
 class FaceRestorer:
-    """Восстановление лиц с использованием GFPGAN/CodeFormer"""
+    """Восстановление лиц с использованием GFPGAN"""
 
     def __init__(self, model_type: str = "GFPGAN", device: str = "cpu"):
+        if model_type not in SUPPORTED_MODELS:
+            raise ValueError(
+                f"Модель {model_type} не поддерживается, доступны: {', '.join(SUPPORTED_MODELS)}"
+            )
         self.utils = ImageUtils()
         self.logger = Logger()
         self.model_type = model_type
         self.device = device
         self.model = None
+        # TileEngine для фона (None - увеличение Lanczos)
+        self.background_engine = None
         self.temp_files = []
 
     async def initialize(self):
         """Асинхронная инициализация модели"""
         try:
             logger.info(f"Инициализация модели {self.model_type}...")
-            
-            if self.model_type == "GFPGAN":
-                self.model = ModelLoader.load_model("GFPGAN", device=self.device)
-            elif self.model_type == "CodeFormer":
-                self.model = ModelLoader.load_model("CodeFormer", device=self.device)
+
+            registry = get_registry()
+            key = f"{self.model_type}:{self.device}"
+            self.model = await registry.aget(
+                key, lambda: ModelLoader.load_model(self.model_type, device=self.device)
+            )
+            # Сети обёртки - отдельные записи: реестр отображает общие веса только у nn.Module
+            helper = self.model.face_helper
+            for name, net in (
+                ("gfpgan", self.model.gfpgan),
+                ("face_det", helper.face_det),
+                ("face_parse", getattr(helper, "face_parse", None))
+            ):
+                if net is not None:
+                    await registry.aget(f"{key}:{name}", lambda net=net: net)
+
+            if FACE_BACKGROUND == "realesrgan":
+                from modes.upscale import STYLE_MODELS, get_upscaler
+                upscaler = await get_upscaler()
+                self.background_engine = upscaler.engines.get(STYLE_MODELS["photo"])
             
             logger.info(f"Модель {self.model_type} готова к работе")
             return True
@@ -54,106 +115,384 @@ class FaceRestorer:
         Returns:
             bool: Успешность операции
         """
-        # Валидация входного файла
-        is_valid, img = await self.utils.validate_image(input_path)
-        if not is_valid:
-            return False
+        with track_job("face_restore"):
+            # Валидация входного файла
+            with stage_timer("face_restore", "decode"):
+                is_valid, img = await self.utils.validate_image(input_path)
+            if not is_valid:
+                count_error("face_restore", "decode")
+                return False
+
+            result = await self.restore_array(img, fidelity, upscale, source=input_path)
+            if result is None:
+                return False
+
+            with stage_timer("face_restore", "encode"):
+                return await self.utils.save_image(result, output_path)
 
+    async def restore_bytes(
+        self,
+        data: bytes,
+        fidelity: float = 0.5,
+        upscale: int = 2,
+        encoding: Optional[EncodeOptions] = None
+    ) -> Optional[bytes]:
+        """
+        Восстановление лица целиком в памяти, без файлов
+
+        Args:
+            data: Закодированное изображение (JPG/PNG)
+            fidelity: Баланс между качеством и естественностью (0.0-1.0)
+            upscale: Масштаб увеличения (1-4)
+            encoding: Параметры кодирования результата (None - по умолчанию)
+
+        Returns:
+            Закодированный результат или None при ошибке
+        """
+        with track_job("face_restore"):
+            with stage_timer("face_restore", "decode"):
+                is_valid, img = await self.utils.decode_image(data)
+            if not is_valid:
+                count_error("face_restore", "decode")
+                return None
+
+            result = await self.restore_array(img, fidelity, upscale)
+            if result is None:
+                return None
+
+            with stage_timer("face_restore", "encode"):
+                return await self.utils.encode_image(result, options=encoding)
+
+    async def restore_array(
+        self,
+        img: np.ndarray,
+        fidelity: float = 0.5,
+        upscale: int = 2,
+        source: str = "memory"
+    ) -> Optional[np.ndarray]:
+        """
+        Восстановление лица на декодированном изображении
+
+        Args:
+            img: Изображение BGR
+            fidelity: Баланс между качеством и естественностью (0.0-1.0)
+            upscale: Масштаб увеличения (1-4)
+            source: Источник изображения для лога
+
+        Returns:
+            Результат или None при ошибке
+        """
         try:
             if not self.model:
                 raise RuntimeError("Модель не инициализирована")
 
             logger.info(f"Начало восстановления лица ({self.model_type})...")
-            
-            # Препроцессинг
-            processed_img = self._preprocess_face(img)
-            
-            # Временная заглушка (реальная интеграция будет здесь)
-            restored = self._mock_restore(processed_img, fidelity, upscale)
-            
-            # Постобработка
-            final_img = self._postprocess_face(restored)
-            
-            # Сохранение результата
-            if not await self.utils.save_image(final_img, output_path):
-                return False
-                
-            self.temp_files.append(output_path)
+
+            # Вся обработка - в общем пуле, вне event loop
+            final_img, faces = await get_executor().run(
+                "face_restore", self._restore_sync, img, fidelity, upscale
+            )
+            logger.info(f"Восстановлено лиц: {faces}")
             
             # Логирование
             self.logger.log_event({
                 "operation": "face_restore",
                 "model": self.model_type,
-                "input": input_path,
-                "output": output_path,
+                "input": source,
                 "params": {
                     "fidelity": fidelity,
                     "upscale": upscale
                 },
+                "faces": faces,
                 "status": "success",
                 "timestamp": datetime.utcnow().isoformat()
             })
             
-            return True
-            
+            return final_img
+
+        except ExecutorBusy:
+            raise
         except Exception as e:
             logger.error(f"Ошибка восстановления лица: {e}")
+            count_error("face_restore", e)
             self.logger.log_event({
                 "operation": "face_restore",
-                "input": input_path,
+                "input": source,
                 "status": "failed",
                 "error": str(e),
                 "timestamp": datetime.utcnow().isoformat()
             })
-            return False
+            return None
 
-    def _preprocess_face(self, img: np.ndarray) -> np.ndarray:
-        """Подготовка изображения лица"""
-        # Обнаружение лица и выравнивание
-        face_img = self._detect_and_align_face(img)
-        # Нормализация
-        return face_img.astype(np.float32) / 255.0
+    async def restore_many(
+        self,
+        images: Sequence[np.ndarray],
+        fidelity: float = 0.5,
+        upscale: int = 2,
+        source: str = "batch"
+    ) -> List[Optional[np.ndarray]]:
+        """
+        Восстановление лиц на нескольких изображениях одним заданием пула
 
-    def _postprocess_face(self, img: np.ndarray) -> np.ndarray:
-        """Финализация обработанного лица"""
-        img = (img * 255).astype(np.uint8)
-        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        Лица всех изображений проходят через сеть общими батчами по
+        FACE_BATCH_SIZE.
 
-    def _detect_and_align_face(self, img: np.ndarray) -> np.ndarray:
-        """Обнаружение и выравнивание лица (заглушка)"""
-        # Здесь будет интеграция с Face Alignment
-        return img[100:300, 100:300]  # Пример обрезки
+        Returns:
+            Результаты в порядке images; при ошибке - список из None
+        """
+        try:
+            if not self.model:
+                raise RuntimeError("Модель не инициализирована")
 
-    def _mock_restore(
-        self,
-        img: np.ndarray,
-        fidelity: float,
+            results = await get_executor().run(
+                "face_restore", self._restore_many_sync, list(images), fidelity, upscale
+            )
+            faces = [count for _, count in results]
+            logger.info(f"Восстановлено лиц на {len(images)} изображениях: {sum(faces)}")
+
+            self.logger.log_event({
+                "operation": "face_restore_batch",
+                "model": self.model_type,
+                "input": source,
+                "images": len(images),
+                "params": {
+                    "fidelity": fidelity,
+                    "upscale": upscale
+                },
+                "faces": faces,
+                "status": "success",
+                "timestamp": datetime.utcnow().isoformat()
+            })
+
+            return [image for image, _ in results]
+
+        except ExecutorBusy:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка пакетного восстановления лиц: {e}")
+            count_error("face_restore", e)
+            self.logger.log_event({
+                "operation": "face_restore_batch",
+                "input": source,
+                "images": len(images),
+                "status": "failed",
+                "error": str(e),
+                "timestamp": datetime.utcnow().isoformat()
+            })
+            return [None] * len(images)
+
+    def _restore_sync(self, img: np.ndarray, fidelity: float, upscale: int) -> Tuple[np.ndarray, int]:
+        """
+        Детекция, выравнивание, батчевое восстановление и вклейка лиц (блокирующая часть)
+
+        Returns:
+            (результат, число восстановленных лиц)
+        """
+        return self._restore_many_sync([img], fidelity, upscale)[0]
+
+    def _restore_many_sync(
+        self, images: List[np.ndarray], fidelity: float, upscale: int
+    ) -> List[Tuple[np.ndarray, int]]:
+        """То же для нескольких изображений: лица всех изображений - в общих батчах"""
+        backgrounds, owners, affines, crops = [], [], [], []
+        for index, img in enumerate(images):
+            if img.ndim == 2:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            elif img.shape[2] == 4:
+                img = img[:, :, :3]
+
+            with stage_timer("face_restore", "detect"):
+                landmarks = self._detect_faces(img)
+            with stage_timer("face_restore", "background"):
+                backgrounds.append(self._upscale_background(img, upscale))
+
+            for points in landmarks:
+                affine = cv2.estimateAffinePartial2D(points, FACE_TEMPLATE, method=cv2.LMEDS)[0]
+                if affine is None or not np.isfinite(affine).all() or abs(np.linalg.det(affine[:, :2])) < 1e-6:
+                    # Вырожденные точки (совпадающие или на одной линии) - лицо
+                    # пропускаем, остальные лица изображения восстанавливаются
+                    logger.warning("Не удалось выровнять лицо по опорным точкам, лицо пропущено")
+                    continue
+                owners.append(index)
+                affines.append(affine)
+                crops.append(
+                    cv2.warpAffine(img, affine, (FACE_SIZE, FACE_SIZE), borderValue=(135, 133, 132))
+                )
+
+        counts = [0] * len(images)
+        if crops:
+            # Без найденных лиц сеть восстановления не запускается
+            with stage_timer("face_restore", "inference"):
+                restored = self._restore_faces(crops, fidelity)
+                masks = self._face_masks(restored)
+            with stage_timer("face_restore", "paste"):
+                for index, face, mask, affine in zip(owners, restored, masks, affines):
+                    self._paste_face(backgrounds[index], face, mask, affine, upscale)
+                    counts[index] += 1
+        return list(zip(backgrounds, counts))
+
+    def _detect_faces(self, img: np.ndarray) -> List[np.ndarray]:
+        """Пять опорных точек каждого лица (глаза, нос, уголки рта) в координатах img"""
+        detector = self.model.face_helper.face_det
+
+        # Детектор работает на уменьшенной копии: лица крупнее порога
+        # по расстоянию между глазами находятся и так, а время - по пикселям
+        height, width = img.shape[:2]
+        scale = min(1.0, FACE_DETECT_SIDE / max(height, width))
+        small = img if scale == 1.0 else cv2.resize(
+            img, (max(1, round(width * scale)), max(1, round(height * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+
+        # RetinaFace хранит масштаб последнего вызова в self
+        with get_registry().inference_lock(f"{self.model_type}:{self.device}:detect"):
+            with torch.no_grad():
+                detections = detector.detect_faces(small, FACE_DET_THRESHOLD)
+
+        landmarks = []
+        for detection in detections[:FACE_MAX_FACES]:
+            points = np.asarray(detection[5:15], dtype=np.float32).reshape(5, 2) / scale
+            # Профили и совсем мелкие лица сеть не улучшает
+            if np.linalg.norm(points[0] - points[1]) < FACE_EYE_DIST_THRESHOLD:
+                continue
+            landmarks.append(points)
+        return landmarks
+
+    def _upscale_background(self, img: np.ndarray, upscale: int) -> np.ndarray:
+        """Фон увеличивается отдельно от лиц"""
+        if upscale <= 1:
+            return img.copy()
+        if self.background_engine is not None:
+            return self.background_engine.enhance(img, outscale=upscale)
+        return cv2.resize(img, None, fx=upscale, fy=upscale, interpolation=cv2.INTER_LANCZOS4)
+
+    def _to_tensor(self, faces: List[np.ndarray]) -> torch.Tensor:
+        """Лица BGR uint8 -> батч RGB в диапазоне [-1, 1]"""
+        batch = np.stack(faces)[..., ::-1].transpose(0, 3, 1, 2)
+        tensor = torch.from_numpy(np.ascontiguousarray(batch)).float()
+        return (tensor / 127.5 - 1.0).to(self.model.device)
+
+    def _restore_faces(self, crops: List[np.ndarray], fidelity: float) -> List[np.ndarray]:
+        """Восстановление выровненных лиц батчами по FACE_BATCH_SIZE"""
+        net = self.model.gfpgan
+        restored = []
+        for start in range(0, len(crops), FACE_BATCH_SIZE):
+            chunk = crops[start:start + FACE_BATCH_SIZE]
+            try:
+                with torch.no_grad():
+                    output = net(self._to_tensor(chunk), return_rgb=False, weight=fidelity)[0]
+                output = ((output.clamp(-1, 1) + 1.0) * 127.5).round().byte()
+                faces = output.permute(0, 2, 3, 1).cpu().numpy()[..., ::-1]
+                restored.extend(np.ascontiguousarray(face) for face in faces)
+            except RuntimeError as e:
+                # Например, нехватка памяти: лица остаются как были
+                logger.warning(f"Ошибка восстановления {len(chunk)} лиц: {e}")
+                restored.extend(chunk)
+        return restored
+
+    def _face_masks(self, faces: List[np.ndarray]) -> List[np.ndarray]:
+        """Мягкие маски лиц (float32 0-1, FACE_SIZE x FACE_SIZE)"""
+        parser = getattr(self.model.face_helper, "face_parse", None)
+        if parser is None:
+            return [_square_mask()] * len(faces)
+
+        masks = []
+        for start in range(0, len(faces), FACE_BATCH_SIZE):
+            chunk = faces[start:start + FACE_BATCH_SIZE]
+            with torch.no_grad():
+                labels = parser(self._to_tensor(chunk))[0].argmax(dim=1).cpu().numpy()
+            for label in labels:
+                mask = PARSE_FACE_LABELS[label]
+                mask = cv2.GaussianBlur(mask, (101, 101), 11)
+                mask = cv2.GaussianBlur(mask, (101, 101), 11)
+                border = MASK_BORDER
+                mask[:border, :] = 0
+                mask[-border:, :] = 0
+                mask[:, :border] = 0
+                mask[:, -border:] = 0
+                masks.append(mask)
+        return masks
+
+    @staticmethod
+    def _paste_face(
+        canvas: np.ndarray,
+        face: np.ndarray,
+        mask: np.ndarray,
+        affine: np.ndarray,
         upscale: int
-    ) -> np.ndarray:
-        """Заглушка для реального восстановления"""
-        # Эмуляция разных моделей
-        if self.model_type == "GFPGAN":
-            result = cv2.detailEnhance(img, sigma_s=10, sigma_r=0.1)
-        else:  # CodeFormer
-            result = cv2.edgePreservingFilter(img, flags=1, sigma_s=60, sigma_r=0.4)
-        
-        # Масштабирование
+    ) -> None:
+        """
+        Вклейка лица в увеличенный фон по мягкой маске
+
+        Обратное преобразование и смешивание считаются только в
+        ограничивающем прямоугольнике лица, а не по всему изображению.
+        """
+        inverse = cv2.invertAffineTransform(affine) * upscale
         if upscale > 1:
-            result = cv2.resize(result, None, fx=upscale, fy=upscale)
-        
-        return result
+            # Сдвиг центра пикселя при увеличении (как в facexlib)
+            inverse[:, 2] += 0.5 * upscale
+
+        corners = np.array(
+            [[0, 0, 1], [FACE_SIZE, 0, 1], [0, FACE_SIZE, 1], [FACE_SIZE, FACE_SIZE, 1]],
+            dtype=np.float64
+        ) @ inverse.T
+        height, width = canvas.shape[:2]
+        x0, y0 = np.maximum(np.floor(corners.min(axis=0)).astype(int), 0)
+        x1 = min(int(np.ceil(corners[:, 0].max())), width)
+        y1 = min(int(np.ceil(corners[:, 1].max())), height)
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        inverse[0, 2] -= x0
+        inverse[1, 2] -= y0
+        size = (x1 - x0, y1 - y0)
+        face_roi = cv2.warpAffine(face, inverse, size).astype(np.float32)
+        mask_roi = cv2.warpAffine(mask, inverse, size)[:, :, None]
+
+        roi = canvas[y0:y1, x0:x1].astype(np.float32)
+        blended = mask_roi * face_roi + (1.0 - mask_roi) * roi
+        canvas[y0:y1, x0:x1] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
 
     async def cleanup(self):
         """Очистка временных файлов"""
         removed = self.utils.safe_remove(self.temp_files)
         logger.info(f"Очищено временных файлов: {removed}/{len(self.temp_files)}")
 
+# Общий восстановитель лиц воркера (ленивый синглтон)
+_shared_restorer: Optional[FaceRestorer] = None
+# Параллельные первые запросы ждут одну инициализацию, а не запускают свою
+_restorer_lock = asyncio.Lock()
+
+async def get_face_restorer() -> FaceRestorer:
+    """Получение прогретого восстановителя лиц, общего для всех запросов"""
+    global _shared_restorer
+    if _shared_restorer is None:
+        async with _restorer_lock:
+            if _shared_restorer is None:
+                restorer = FaceRestorer(model_type="GFPGAN")
+                if not await restorer.initialize():
+                    raise RuntimeError("Модель GFPGAN не загружена")
+                _shared_restorer = restorer
+    return _shared_restorer
+
 # Совместимость с оригинальным интерфейсом
 async def process_face_restore(input_path: str, output_path: str) -> bool:
-    restorer = FaceRestorer(model_type="GFPGAN")
-    if not await restorer.initialize():
+    try:
+        restorer = await get_face_restorer()
+    except RuntimeError as e:
+        logger.error(str(e))
         return False
-        
-    result = await restorer.restore_face(input_path, output_path)
-    await restorer.cleanup()
-    return result
\ No newline at end of file
+
+    return await restorer.restore_face(input_path, output_path)
+
+async def process_face_restore_bytes(
+    data: bytes, encoding: Optional[EncodeOptions] = None
+) -> Optional[bytes]:
+    """Восстановление лица в памяти: байты загрузки -> закодированный результат"""
+    try:
+        restorer = await get_face_restorer()
+    except RuntimeError as e:
+        logger.error(str(e))
+        return None
+
+    return await restorer.restore_bytes(data, encoding=encoding)
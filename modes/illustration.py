@@ -4,6 +4,9 @@ import numpy as np
 from typing import Optional, Tuple
 import logging
 from datetime import datetime
+from modes.encoding import EncodeOptions
+from modes.executor import ExecutorBusy, get_executor
+from modes.metrics import count_error, stage_timer, track_job
 from modes.utils import ImageUtils, Logger  # Используем улучшенные утилиты
 
 # Настройка логирования
@@ -37,53 +40,119 @@ class IllustrationProcessor:
         Returns:
             bool: Успешность операции
         """
-        # Валидация входного файла
-        is_valid, img = await self.utils.validate_image(input_path)
-        if not is_valid:
-            return False
+        with track_job("illustration"):
+            # Валидация входного файла
+            with stage_timer("illustration", "decode"):
+                is_valid, img = await self.utils.validate_image(input_path)
+            if not is_valid:
+                count_error("illustration", "decode")
+                return False
+
+            result = await self.stylize_array(img, style, strength, source=input_path)
+            if result is None:
+                return False
+
+            with stage_timer("illustration", "encode"):
+                return await self.utils.save_image(result, output_path)
+
+    async def stylize_bytes(
+        self,
+        data: bytes,
+        style: str = "fantasy",
+        strength: float = 0.8,
+        encoding: Optional[EncodeOptions] = None
+    ) -> Optional[bytes]:
+        """
+        Стилизация изображения целиком в памяти, без файлов
+
+        Args:
+            data: Закодированное изображение (JPG/PNG)
+            style: Стиль обработки
+            strength: Интенсивность эффекта (0.1-1.0)
+            encoding: Параметры кодирования результата (None - по умолчанию)
+
+        Returns:
+            Закодированный результат или None при ошибке
+        """
+        with track_job("illustration"):
+            with stage_timer("illustration", "decode"):
+                is_valid, img = await self.utils.decode_image(data)
+            if not is_valid:
+                count_error("illustration", "decode")
+                return None
+
+            result = await self.stylize_array(img, style, strength)
+            if result is None:
+                return None
+
+            with stage_timer("illustration", "encode"):
+                return await self.utils.encode_image(result, options=encoding)
+
+    async def stylize_array(
+        self,
+        img: np.ndarray,
+        style: str = "fantasy",
+        strength: float = 0.8,
+        source: str = "memory"
+    ) -> Optional[np.ndarray]:
+        """
+        Стилизация декодированного изображения
 
+        Args:
+            img: Изображение BGR
+            style: Стиль обработки
+            strength: Интенсивность эффекта (0.1-1.0)
+            source: Источник изображения для лога
+
+        Returns:
+            Результат или None при ошибке
+        """
         try:
             logger.info(f"Начало обработки иллюстрации (стиль: {style})...")
-            
-            # Препроцессинг
-            processed_img = self._preprocess_image(img)
-            
-            # Здесь будет реальная интеграция с Stable Diffusion
-            # Временная реализация:
-            stylized = self._apply_style(processed_img, style, strength)
-            
-            # Постобработка
-            final_img = self._postprocess_image(stylized)
-            
-            # Сохранение результата
-            if not await self.utils.save_image(final_img, output_path):
-                return False
-                
-            self.temp_files.append(output_path)
+
+            # Стилизация - в общем пуле, вне event loop
+            final_img = await get_executor().run(
+                "illustration", self._stylize_sync, img, style, strength
+            )
             
             # Логирование
             self.logger.log_event({
                 "operation": "illustration",
-                "input": input_path,
-                "output": output_path,
+                "input": source,
                 "style": style,
                 "strength": strength,
                 "status": "success",
                 "timestamp": datetime.utcnow().isoformat()
             })
             
-            return True
-            
+            return final_img
+
+        except ExecutorBusy:
+            raise
         except Exception as e:
             logger.error(f"Ошибка обработки иллюстрации: {e}")
+            count_error("illustration", e)
             self.logger.log_event({
                 "operation": "illustration",
-                "input": input_path,
+                "input": source,
                 "status": "failed",
                 "error": str(e),
                 "timestamp": datetime.utcnow().isoformat()
             })
-            return False
+            return None
+
+    def _stylize_sync(self, img: np.ndarray, style: str, strength: float) -> np.ndarray:
+        """Пре-, пост-обработка и стилизация (блокирующая часть)"""
+        # Препроцессинг
+        processed_img = self._preprocess_image(img)
+
+        # Здесь будет реальная интеграция с Stable Diffusion
+        # Временная реализация:
+        with stage_timer("illustration", "inference"):
+            stylized = self._apply_style(processed_img, style, strength)
+
+        # Постобработка
+        return self._postprocess_image(stylized)
 
     def _preprocess_image(self, img: np.ndarray) -> np.ndarray:
         """Подготовка изображения для обработки"""
@@ -120,4 +189,11 @@ async def process_illustration(input_path: str, output_path: str) -> bool:
     processor = IllustrationProcessor()
     result = await processor.process_illustration(input_path, output_path)
     await processor.cleanup()
-    return result
\ No newline at end of file
+    return result
+
+async def process_illustration_bytes(
+    data: bytes, encoding: Optional[EncodeOptions] = None
+) -> Optional[bytes]:
+    """Стилизация в памяти: байты загрузки -> закодированный результат"""
+    processor = IllustrationProcessor()
+    return await processor.stylize_bytes(data, encoding=encoding)
@@ -0,0 +1,235 @@
+"""
+Метрики Prometheus для API и бота
+
+Стадии обработки замеряются контекстным менеджером stage_timer, задание
+целиком - track_job (время, число выполняющихся, ошибки по типам).
+Состояние, которое и так хранится в объектах (очереди пула, загруженные
+модели, кеш результатов, очередь заданий), не дублируется счётчиками, а
+читается в момент опроса через register_stats.
+
+Стадии заодно сообщаются слушателю текущего задания (watch_stages):
+так /jobs показывает, на какой стадии задание и сколько тайлов готово.
+Слушатель хранится в contextvars и доходит до потоков пула (executor
+копирует контекст).
+
+API отдаёт метрики на GET /metrics, бот - на отдельном порту
+(BOT_METRICS_PORT). При нескольких воркерах uvicorn нужно задать
+PROMETHEUS_MULTIPROC_DIR (пустой каталог): гистограммы и счётчики всех
+воркеров суммируются, а состояние из register_stats - того воркера,
+который ответил на запрос.
+
+Настройка через переменные окружения:
+- PROMETHEUS_MULTIPROC_DIR: каталог для метрик нескольких процессов
+- BOT_METRICS_PORT: порт экспортера бота (0 - выключен)
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+logger = logging.getLogger(__name__)
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# От миллисекунд декодирования до минут апскейла 4K на CPU
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+
+STAGE_SECONDS = Histogram(
+    "magic_stage_seconds",
+    "Время стадий обработки (decode, select, inference, encode, total, queue ...)",
+    ["mode", "stage"],
+    buckets=STAGE_BUCKETS
+)
+ERRORS = Counter("magic_errors", "Ошибки обработки по типам", ["mode", "type"])
+IN_FLIGHT = Gauge(
+    "magic_in_flight", "Выполняющиеся задания", ["mode"], multiprocess_mode="livesum"
+)
+MODEL_LOADS = Counter("magic_model_loads", "Загрузки моделей в память", ["model"])
+MODEL_LOAD_SECONDS = Histogram(
+    "magic_model_load_seconds", "Время загрузки моделей", ["model"], buckets=STAGE_BUCKETS
+)
+# Бот: запросы к внешним сервисам и своему серверу
+PROVIDER_SECONDS = Histogram(
+    "magic_provider_seconds", "Время запросов бота к сервисам", ["provider", "outcome"],
+    buckets=STAGE_BUCKETS
+)
+
+
+# Слушатель стадий текущего задания: (стадия, доля готовности стадии или None)
+StageListener = Callable[[str, Optional[float]], None]
+_stage_listener: ContextVar[Optional[StageListener]] = ContextVar("stage_listener", default=None)
+
+
+@contextmanager
+def watch_stages(listener: StageListener) -> Iterator[None]:
+    """Стадии, пройденные внутри блока (и в пуле, запущенном из него), сообщаются listener"""
+    token = _stage_listener.set(listener)
+    try:
+        yield
+    finally:
+        _stage_listener.reset(token)
+
+
+def report_stage(stage: str, progress: Optional[float] = None) -> None:
+    """Стадия и доля её готовности для слушателя текущего задания (если он есть)"""
+    listener = _stage_listener.get()
+    if listener is None:
+        return
+    try:
+        listener(stage, progress)
+    except Exception as e:
+        # Слушатель только показывает ход задания - обработку не прерываем
+        logger.warning(f"Ошибка слушателя стадий: {e}")
+
+
+@contextmanager
+def stage_timer(mode: str, stage: str) -> Iterator[None]:
+    """Замер стадии в гистограмму magic_stage_seconds"""
+    report_stage(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(mode, stage).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def track_job(mode: str) -> Iterator[None]:
+    """Задание целиком: стадия total, число выполняющихся и ошибки по типу исключения"""
+    gauge = IN_FLIGHT.labels(mode)
+    gauge.inc()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        count_error(mode, e)
+        raise
+    finally:
+        gauge.dec()
+        STAGE_SECONDS.labels(mode, "total").observe(time.perf_counter() - start)
+
+
+def count_error(mode: str, error: Union[BaseException, str]) -> None:
+    """Ошибка режима: исключение (тип - имя класса) или короткое имя причины"""
+    kind = error if isinstance(error, str) else type(error).__name__
+    ERRORS.labels(mode, kind).inc()
+
+
+def module_memory_bytes(obj: Any, seen: set, depth: int = 3) -> int:
+    """
+    Память параметров и буферов torch-модулей объекта
+
+    Обёртки вроде GFPGANer и TileEngine хранят сети в атрибутах, поэтому
+    модули ищутся на несколько уровней вглубь. Уже посчитанные модули
+    (seen) пропускаются - общая сеть не учитывается дважды.
+    """
+    try:
+        from torch import nn
+    except ImportError:
+        return 0
+
+    if id(obj) in seen or depth < 0:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, nn.Module):
+        tensors = list(obj.parameters()) + list(obj.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    attributes = getattr(obj, "__dict__", None)
+    if not attributes:
+        return 0
+    return sum(
+        module_memory_bytes(value, seen, depth - 1)
+        for value in attributes.values()
+        if isinstance(value, nn.Module) or hasattr(value, "__dict__")
+    )
+
+
+class StatsCollector(Collector):
+    """Метрики, вычисляемые в момент опроса"""
+
+    def __init__(self):
+        self._sources: List[Callable[[], Iterable[Any]]] = []
+        self._lock = threading.Lock()
+
+    def add(self, source: Callable[[], Iterable[Any]]) -> None:
+        with self._lock:
+            self._sources.append(source)
+
+    def collect(self) -> Iterator[Any]:
+        with self._lock:
+            sources = list(self._sources)
+        for source in sources:
+            try:
+                yield from source()
+            except Exception as e:
+                # Ошибка одного источника не ломает весь ответ /metrics
+                logger.warning(f"Ошибка сбора метрик: {e}")
+
+
+_stats_collector = StatsCollector()
+REGISTRY.register(_stats_collector)
+
+
+def register_stats(source: Callable[[], Iterable[Any]]) -> None:
+    """Источник метрик, вычисляемых при опросе (генератор MetricFamily)"""
+    _stats_collector.add(source)
+
+
+def gauge_family(name: str, documentation: str, values: Dict[Tuple[str, ...], float], labels: List[str]):
+    """GaugeMetricFamily из словаря {значения меток: значение}"""
+    family = GaugeMetricFamily(name, documentation, labels=labels)
+    for label_values, value in values.items():
+        family.add_metric(list(label_values), value)
+    return family
+
+
+def counter_family(name: str, documentation: str, values: Dict[Tuple[str, ...], float], labels: List[str]):
+    """CounterMetricFamily из словаря: для счётчиков, которые уже ведёт сам объект"""
+    family = CounterMetricFamily(name, documentation, labels=labels)
+    for label_values, value in values.items():
+        family.add_metric(list(label_values), value)
+    return family
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Текст метрик и Content-Type для ответа /metrics"""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(_stats_collector)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_exporter(port: int) -> bool:
+    """HTTP-экспортер метрик в отдельном потоке (для бота)"""
+    if port <= 0:
+        return False
+    try:
+        start_http_server(port)
+    except OSError as e:
+        logger.error(f"Не удалось запустить экспортер метрик на порту {port}: {e}")
+        return False
+    logger.info(f"Метрики Prometheus: http://0.0.0.0:{port}/metrics")
+    return True
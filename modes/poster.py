@@ -1,10 +1,13 @@
-import os
+import asyncio
 import cv2
 import numpy as np
 from typing import Optional, Tuple
 import logging
 from datetime import datetime
-from modes.utils import FileUtils, Logger  # Используем улучшенные утилиты
+from modes.encoding import EncodeOptions
+from modes.executor import ExecutorBusy, get_executor
+from modes.metrics import count_error, stage_timer, track_job
+from modes.utils import FileUtils, ImageUtils, Logger  # Используем улучшенные утилиты
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -20,31 +23,21 @@ class ImageProcessor:
 
     async def _validate_image(self, img_path: str) -> Tuple[bool, Optional[np.ndarray]]:
         """Валидация входного изображения"""
-        if not os.path.exists(img_path):
-            logger.error(f"Файл не найден: {img_path}")
-            return False, None
-            
-        try:
-            img = cv2.imread(img_path)
-            if img is None:
-                raise ValueError("Не удалось загрузить изображение")
-            return True, img
-        except Exception as e:
-            logger.error(f"Ошибка загрузки изображения: {e}")
-            return False, None
+        return await asyncio.to_thread(ImageUtils.read_image, img_path)
 
     async def _save_result(self, image: np.ndarray, output_path: str) -> bool:
         """Сохранение результата с обработкой ошибок"""
-        try:
-            success = cv2.imwrite(output_path, image)
-            if not success:
-                raise ValueError("Ошибка сохранения изображения")
-            
-            self.temp_files.append(output_path)
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка сохранения: {e}")
-            return False
+        return await asyncio.to_thread(ImageUtils.write_image, image, output_path)
+
+    async def _decode(self, data: bytes) -> Tuple[bool, Optional[np.ndarray]]:
+        """Декодирование входного изображения из памяти"""
+        return await asyncio.to_thread(ImageUtils.decode_bytes, data)
+
+    async def _encode(
+        self, image: np.ndarray, options: Optional[EncodeOptions] = None
+    ) -> Optional[bytes]:
+        """Кодирование результата в памяти (по умолчанию JPEG)"""
+        return await asyncio.to_thread(ImageUtils.encode_bytes, image, ".jpg", options)
 
     async def cleanup(self):
         """Очистка временных файлов"""
@@ -65,49 +58,96 @@ class PosterProcessor(ImageProcessor):
         Returns:
             bool: Успешность операции
         """
-        # Валидация изображения
-        is_valid, img = await self._validate_image(input_path)
-        if not is_valid:
-            return False
+        with track_job("poster"):
+            # Валидация изображения
+            with stage_timer("poster", "decode"):
+                is_valid, img = await self._validate_image(input_path)
+            if not is_valid:
+                count_error("poster", "decode")
+                return False
+
+            modified = await self.poster_array(img, source=input_path)
+            if modified is None:
+                return False
+
+            with stage_timer("poster", "encode"):
+                return await self._save_result(modified, output_path)
 
+    async def poster_bytes(
+        self, data: bytes, encoding: Optional[EncodeOptions] = None
+    ) -> Optional[bytes]:
+        """
+        Генерация постера целиком в памяти, без файлов
+
+        Args:
+            data: Закодированное изображение (JPG/PNG)
+            encoding: Параметры кодирования результата (None - по умолчанию)
+
+        Returns:
+            Закодированный результат или None при ошибке
+        """
+        with track_job("poster"):
+            with stage_timer("poster", "decode"):
+                is_valid, img = await self._decode(data)
+            if not is_valid:
+                count_error("poster", "decode")
+                return None
+
+            modified = await self.poster_array(img)
+            if modified is None:
+                return None
+
+            with stage_timer("poster", "encode"):
+                return await self._encode(modified, encoding)
+
+    async def poster_array(self, img: np.ndarray, source: str = "memory") -> Optional[np.ndarray]:
+        """
+        Генерация постера из декодированного изображения
+
+        Args:
+            img: Изображение BGR
+            source: Источник изображения для лога
+
+        Returns:
+            Результат или None при ошибке
+        """
         try:
             # Здесь будет реальная логика обработки через ControlNet
             logger.info("Начало обработки постера...")
             
             # Заглушка для примера - добавление эффекта постера
-            modified = self._apply_poster_effect(img)
-            
-            # Сохранение результата
-            if not await self._save_result(modified, output_path):
-                return False
+            modified = await get_executor().run("poster", self._apply_poster_effect, img)
                 
             # Логирование
             self.logger.log_event({
                 "operation": "poster_generation",
-                "input": input_path,
-                "output": output_path,
+                "input": source,
                 "status": "success",
                 "processing_time": str(datetime.utcnow())
             })
             
-            return True
-            
+            return modified
+
+        except ExecutorBusy:
+            raise
         except Exception as e:
             logger.error(f"Ошибка обработки постера: {e}")
+            count_error("poster", e)
             self.logger.log_event({
                 "operation": "poster_generation",
-                "input": input_path,
+                "input": source,
                 "status": "failed",
                 "error": str(e)
             })
-            return False
+            return None
 
     def _apply_poster_effect(self, img: np.ndarray) -> np.ndarray:
         """Применение эффекта постера (заглушка)"""
         # Реальная реализация будет использовать ControlNet
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, 100, 200)
-        return cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
+        with stage_timer("poster", "inference"):
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            edges = cv2.Canny(gray, 100, 200)
+            return cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
 
 class IllustrationProcessor(ImageProcessor):
     """Обработчик для стилизации изображений"""
@@ -131,7 +171,7 @@ class IllustrationProcessor(ImageProcessor):
             logger.info("Начало стилизации изображения...")
             
             # Заглушка для примера - здесь будет SD обработка
-            stylized = self._apply_sd_style(img)
+            stylized = await get_executor().run("illustration", self._apply_sd_style, img)
             
             if not await self._save_result(stylized, output_path):
                 return False
@@ -145,7 +185,9 @@ class IllustrationProcessor(ImageProcessor):
             })
             
             return True
-            
+
+        except ExecutorBusy:
+            raise
         except Exception as e:
             logger.error(f"Ошибка стилизации: {e}")
             self.logger.log_event({
@@ -163,6 +205,18 @@ class IllustrationProcessor(ImageProcessor):
         hsv[:,:,1] = hsv[:,:,1]*1.5  # Увеличение насыщенности
         return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
 
+# Адаптер для совместимости с оригинальным интерфейсом
+async def process_poster(input_path: str, output_path: str) -> bool:
+    processor = PosterProcessor()
+    return await processor.process_poster(input_path, output_path)
+
+async def process_poster_bytes(
+    data: bytes, encoding: Optional[EncodeOptions] = None
+) -> Optional[bytes]:
+    """Генерация постера в памяти: байты загрузки -> закодированный результат"""
+    processor = PosterProcessor()
+    return await processor.poster_bytes(data, encoding=encoding)
+
 # Пример использования
 async def main():
     poster_processor = PosterProcessor()
@@ -174,5 +228,4 @@ async def main():
     await ill_processor.cleanup()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""
+Пониженная точность инференса Real-ESRGAN на CPU
+
+Варианты сети апскейла:
+- fp32: исходная сеть (по умолчанию)
+- bf16: копия весов в bfloat16; быстрее только на CPU с AVX512-BF16 / AMX,
+  на остальных bf16 эмулируется и медленнее fp32 - тогда остаётся fp32
+- int8: статическое квантование FX (движок x86) с калибровкой на
+  небольшом наборе тайлов; динамическое квантование не подходит - оно
+  квантует только Linear/LSTM, а RRDBNet состоит из свёрток
+
+Каждый вариант при сборке сверяется с fp32 на отложенных тайлах
+калибровочного набора: если PSNR ниже PRECISION_MIN_PSNR или SSIM ниже
+PRECISION_MIN_SSIM, вариант отбрасывается и используется fp32. Подробное
+сравнение точности и скорости - python -m benchmarks.precision.
+
+Память: вариант - отдельная копия весов рядом с fp32 (fp32 остаётся для
+запросов с precision=fp32). При SHARED_WEIGHTS веса bf16 отображаются из
+общего файла, как и fp32; квантованные веса int8 не отображаются, и
+каждый воркер держит свою копию (около четверти размера fp32).
+
+Калибровочный набор - изображения из QUANT_CALIBRATION_DIR (лучше
+несколько типичных для сервиса фото и рисунков), без них - синтетические
+тайлы.
+
+Настройка через переменные окружения:
+- UPSCALE_PRECISION: точность по умолчанию (fp32, bf16, int8)
+- PRECISION_MIN_PSNR: минимальный PSNR варианта относительно fp32, дБ
+- PRECISION_MIN_SSIM: минимальный средний SSIM тайлов варианта относительно fp32
+- QUANT_CALIBRATION_DIR: каталог калибровочных изображений
+- QUANT_CALIBRATION_TILES: число тайлов калибровки
+"""
+
+import copy
+import glob
+import logging
+import os
+from typing import Optional
+
+import cv2
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+FP32, BF16, INT8 = "fp32", "bf16", "int8"
+PRECISIONS = (FP32, BF16, INT8)
+
+UPSCALE_PRECISION = os.getenv("UPSCALE_PRECISION", FP32)
+PRECISION_MIN_PSNR = float(os.getenv("PRECISION_MIN_PSNR", "32"))
+PRECISION_MIN_SSIM = float(os.getenv("PRECISION_MIN_SSIM", "0.95"))
+QUANT_CALIBRATION_DIR = os.getenv("QUANT_CALIBRATION_DIR", os.path.join("weights", "calibration"))
+QUANT_CALIBRATION_TILES = int(os.getenv("QUANT_CALIBRATION_TILES", "32"))
+
+CALIBRATION_TILE = 64
+# Доля тайлов, отложенных для проверки точности
+CHECK_SHARE = 0.25
+
+
+def resolve_precision(precision: Optional[str]) -> str:
+    """
+    Точность по значению параметра запроса
+
+    Raises:
+        ValueError: если точность неизвестна
+    """
+    if precision in (None, "", "auto"):
+        precision = UPSCALE_PRECISION
+    precision = precision.lower()
+    if precision not in PRECISIONS:
+        raise ValueError(f"Неизвестная точность: {precision} (доступны: {', '.join(PRECISIONS)})")
+    return precision
+
+
+def bf16_supported() -> bool:
+    """Аппаратная поддержка bfloat16 (иначе bf16 на CPU эмулируется)"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def psnr(reference: np.ndarray, test: np.ndarray) -> float:
+    """PSNR изображений uint8 в дБ (inf - совпадают)"""
+    mse = np.mean((reference.astype(np.float64) - test.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def ssim(reference: np.ndarray, test: np.ndarray) -> float:
+    """SSIM изображений uint8 (по яркости, окно Гаусса 11x11, sigma 1.5)"""
+    if reference.ndim == 3:
+        reference = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY)
+        test = cv2.cvtColor(test, cv2.COLOR_BGR2GRAY)
+    a = reference.astype(np.float64)
+    b = test.astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+
+    def blur(x: np.ndarray) -> np.ndarray:
+        return cv2.GaussianBlur(x, (11, 11), 1.5)
+
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / (
+        (mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2)
+    )
+    return float(ssim_map.mean())
+
+
+def _synthetic_image(rng: np.random.Generator, side: int = 256) -> np.ndarray:
+    """Градиенты, пятна, контуры и шум - разброс активаций как у фото и рисунков"""
+    y, x = np.mgrid[0:side, 0:side].astype(np.float32)
+    img = np.stack([
+        127 + 100 * np.sin(x / rng.uniform(10, 60) + rng.uniform(0, 6)),
+        127 + 100 * np.cos(y / rng.uniform(10, 60) + rng.uniform(0, 6)),
+        127 + 100 * np.sin((x + y) / rng.uniform(10, 60))
+    ], axis=-1)
+    for _ in range(6):
+        center = tuple(int(v) for v in rng.integers(0, side, 2))
+        color = rng.uniform(0, 255, 3).tolist()
+        cv2.circle(img, center, int(rng.integers(8, side // 3)), color, -1)
+        cv2.circle(img, center, int(rng.integers(8, side // 3)), (20, 20, 20), 2)
+    img += rng.normal(0, rng.uniform(0, 12), img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def calibration_tiles(count: int = QUANT_CALIBRATION_TILES, seed: int = 0) -> torch.Tensor:
+    """
+    Тайлы калибровки (N, 3, T, T), RGB в диапазоне 0-1
+
+    Случайные вырезки из QUANT_CALIBRATION_DIR, без изображений там -
+    из синтетических.
+    """
+    rng = np.random.default_rng(seed)
+    paths = sorted(
+        path for pattern in ("*.jpg", "*.jpeg", "*.png", "*.webp")
+        for path in glob.glob(os.path.join(QUANT_CALIBRATION_DIR, pattern))
+    )
+    images = [img for img in (cv2.imread(path, cv2.IMREAD_COLOR) for path in paths) if img is not None]
+    images = [img for img in images if min(img.shape[:2]) >= CALIBRATION_TILE]
+    if not images:
+        images = [_synthetic_image(rng) for _ in range(4)]
+
+    tiles = []
+    for i in range(count):
+        img = images[i % len(images)]
+        y = int(rng.integers(0, img.shape[0] - CALIBRATION_TILE + 1))
+        x = int(rng.integers(0, img.shape[1] - CALIBRATION_TILE + 1))
+        tile = cv2.cvtColor(img[y:y + CALIBRATION_TILE, x:x + CALIBRATION_TILE], cv2.COLOR_BGR2RGB)
+        tiles.append(torch.from_numpy(tile).permute(2, 0, 1))
+    return torch.stack(tiles).float().div_(255.0)
+
+
+def _to_bf16(model: torch.nn.Module, tiles: torch.Tensor) -> torch.nn.Module:
+    return copy.deepcopy(model).to(torch.bfloat16).eval()
+
+
+def _to_int8(model: torch.nn.Module, tiles: torch.Tensor) -> torch.nn.Module:
+    """Статическое квантование FX с калибровкой диапазонов активаций на тайлах"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = "x86"
+    float_model = copy.deepcopy(model).eval()
+    # Квантованный leaky_relu не работает на месте (и предупреждает на каждом вызове)
+    for module in float_model.modules():
+        if isinstance(module, (torch.nn.LeakyReLU, torch.nn.ReLU)):
+            module.inplace = False
+
+    prepared = prepare_fx(float_model, get_default_qconfig_mapping("x86"), (tiles[:1],))
+    with torch.no_grad():
+        for start in range(0, len(tiles), 4):
+            prepared(tiles[start:start + 4])
+    return convert_fx(prepared).eval()
+
+
+_BUILDERS = {BF16: _to_bf16, INT8: _to_int8}
+
+
+def _run(model: torch.nn.Module, tiles: torch.Tensor, dtype: torch.dtype) -> np.ndarray:
+    with torch.no_grad():
+        output = model(tiles.to(dtype)).float().clamp_(0, 1)
+    return output.mul_(255.0).round_().byte().permute(0, 2, 3, 1).numpy()
+
+
+def build_variant(model: torch.nn.Module, precision: str) -> torch.nn.Module:
+    """
+    Вариант сети с пониженной точностью, проверенный по PSNR и SSIM относительно fp32
+
+    Args:
+        model: Исходная сеть fp32 на CPU
+        precision: fp32, bf16 или int8
+
+    Returns:
+        Новая сеть или исходная, если вариант недоступен или слишком неточен
+    """
+    if precision == FP32:
+        return model
+    if precision == BF16 and not bf16_supported():
+        logger.warning("CPU без аппаратной поддержки bf16 - используется fp32")
+        return model
+
+    tiles = calibration_tiles()
+    split = max(1, int(len(tiles) * CHECK_SHARE))
+    calibration, check = tiles[split:], tiles[:split]
+
+    try:
+        variant = _BUILDERS[precision](model, calibration)
+        dtype = torch.bfloat16 if precision == BF16 else torch.float32
+        reference, result = _run(model, check, torch.float32), _run(variant, check, dtype)
+        score = psnr(reference, result)
+        # SSIM считается по каждому тайлу: PSNR не видит потерю мелкой структуры
+        similarity = float(np.mean([ssim(a, b) for a, b in zip(reference, result)]))
+    except Exception as e:
+        logger.error(f"Не удалось собрать вариант {precision}: {e}")
+        return model
+
+    if score < PRECISION_MIN_PSNR or similarity < PRECISION_MIN_SSIM:
+        logger.warning(
+            f"Вариант {precision} отклонён: PSNR {score:.1f} дБ (минимум {PRECISION_MIN_PSNR}), "
+            f"SSIM {similarity:.4f} (минимум {PRECISION_MIN_SSIM}) - используется fp32"
+        )
+        return model
+    logger.info(f"Вариант {precision} готов: PSNR {score:.1f} дБ, SSIM {similarity:.4f} относительно fp32")
+    return variant
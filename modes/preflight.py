@@ -0,0 +1,215 @@
+"""
+Предварительная проверка изображений до декодирования
+
+Из заголовка файла (Pillow читает только его, пиксели не декодируются)
+берутся размеры, формат и EXIF-ориентация. Слишком большие файлы,
+неподдерживаемые форматы и "бомбы декомпрессии" (маленький файл с
+огромным разрешением) отклоняются до cv2.imdecode и инференса.
+
+Для апскейла строится план:
+- изображение уже не меньше целевого размера - апскейл пропускается
+- сеть увеличивает сильнее, чем нужно (x4 при запрошенном x2 или при
+  ограничении UPSCALE_TARGET_SIDE) - вход сначала уменьшается, чтобы
+  после сети получился ровно нужный размер, а не x4 с последующим
+  уменьшением
+
+Используется и API (api/api.py), и ботом (bot.py).
+
+Настройка через переменные окружения:
+- PREFLIGHT_MAX_MB: максимальный размер файла
+- PREFLIGHT_MAX_MEGAPIXELS: максимальное разрешение входа
+- PREFLIGHT_MAX_SIDE: максимальная сторона входа, px
+- UPSCALE_TARGET_SIDE: максимальная длинная сторона результата апскейла, px
+"""
+
+import io
+import logging
+import os
+import warnings
+from typing import Optional, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+MAX_INPUT_BYTES = int(float(os.getenv("PREFLIGHT_MAX_MB", "25")) * 1024 * 1024)
+MAX_INPUT_PIXELS = int(float(os.getenv("PREFLIGHT_MAX_MEGAPIXELS", "40")) * 1_000_000)
+MAX_INPUT_SIDE = int(os.getenv("PREFLIGHT_MAX_SIDE", "10000"))
+UPSCALE_TARGET_SIDE = int(os.getenv("UPSCALE_TARGET_SIDE", "4096"))
+
+# Форматы, которые декодирует cv2.imdecode
+SUPPORTED_FORMATS = {"JPEG", "PNG", "WEBP", "BMP", "TIFF"}
+
+# Тег EXIF Orientation; значения 5-8 - поворот на 90/270 градусов
+EXIF_ORIENTATION = 0x0112
+# Меньше этого уменьшать вход не имеет смысла - экономия копеечная
+MIN_PRE_SCALE_GAIN = 0.9
+
+
+class PreflightError(ValueError):
+    """Изображение отклонено до декодирования"""
+
+    def __init__(self, message: str, status: int = 422):
+        super().__init__(message)
+        # HTTP-статус для API: 413 - слишком большое, 415 - формат, 422 - остальное
+        self.status = status
+
+
+class ImageInfo:
+    """Сведения из заголовка изображения"""
+
+    def __init__(self, width: int, height: int, format: str, orientation: int = 1, size_bytes: int = 0):
+        self.raw_width = width
+        self.raw_height = height
+        self.format = format
+        self.orientation = orientation
+        self.size_bytes = size_bytes
+
+    @property
+    def width(self) -> int:
+        """Ширина с учётом EXIF-ориентации (как после cv2.imdecode)"""
+        return self.raw_height if self.orientation in (5, 6, 7, 8) else self.raw_width
+
+    @property
+    def height(self) -> int:
+        return self.raw_width if self.orientation in (5, 6, 7, 8) else self.raw_height
+
+    @property
+    def pixels(self) -> int:
+        return self.raw_width * self.raw_height
+
+    def as_dict(self) -> dict:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "format": self.format,
+            "orientation": self.orientation,
+            "size_bytes": self.size_bytes
+        }
+
+
+class UpscalePlan:
+    """План апскейла: пропуск или предварительное уменьшение"""
+
+    def __init__(self, skip: bool, pre_scale: float, outscale: float, target: Tuple[int, int]):
+        """
+        Args:
+            skip: Апскейл не нужен, вход уже не меньше цели
+            pre_scale: Во сколько раз уменьшить вход перед сетью (1 - не уменьшать)
+            outscale: Масштаб для сети после уменьшения
+            target: Итоговый размер (ширина, высота)
+        """
+        self.skip = skip
+        self.pre_scale = pre_scale
+        self.outscale = outscale
+        self.target = target
+
+    def as_dict(self) -> dict:
+        return {
+            "skip": self.skip,
+            "pre_scale": round(self.pre_scale, 4),
+            "outscale": round(self.outscale, 4),
+            "target": list(self.target)
+        }
+
+
+def _probe(source, size_bytes: int) -> ImageInfo:
+    try:
+        with warnings.catch_warnings():
+            # Свой лимит разрешения строже встроенного в Pillow
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            with Image.open(source) as img:
+                width, height = img.size
+                format = img.format or "UNKNOWN"
+                try:
+                    orientation = int(img.getexif().get(EXIF_ORIENTATION, 1))
+                except Exception:
+                    orientation = 1
+    except Image.DecompressionBombError:
+        raise PreflightError("Разрешение изображения слишком большое", status=413)
+    except Exception as e:
+        logger.debug(f"Ошибка чтения заголовка: {e}")
+        raise PreflightError("Не удалось прочитать заголовок изображения")
+
+    return ImageInfo(width, height, format, orientation, size_bytes)
+
+
+def validate(info: ImageInfo) -> ImageInfo:
+    """
+    Проверка лимитов по заголовку
+
+    Raises:
+        PreflightError: если изображение нельзя обрабатывать
+    """
+    if info.format not in SUPPORTED_FORMATS:
+        raise PreflightError(f"Неподдерживаемый формат: {info.format}", status=415)
+    if info.size_bytes > MAX_INPUT_BYTES:
+        raise PreflightError(
+            f"Файл слишком большой (максимум {MAX_INPUT_BYTES // (1024 * 1024)} МБ)", status=413
+        )
+    if max(info.raw_width, info.raw_height) > MAX_INPUT_SIDE or info.pixels > MAX_INPUT_PIXELS:
+        raise PreflightError(
+            f"Разрешение {info.raw_width}x{info.raw_height} больше допустимого", status=413
+        )
+    if min(info.raw_width, info.raw_height) < 1:
+        raise PreflightError("Пустое изображение")
+    return info
+
+
+def probe_bytes(data: bytes) -> ImageInfo:
+    """Заголовок изображения в памяти с проверкой лимитов"""
+    if len(data) > MAX_INPUT_BYTES:
+        raise PreflightError(
+            f"Файл слишком большой (максимум {MAX_INPUT_BYTES // (1024 * 1024)} МБ)", status=413
+        )
+    return validate(_probe(io.BytesIO(data), len(data)))
+
+
+def probe_file(path: str) -> ImageInfo:
+    """Заголовок файла изображения с проверкой лимитов (читается только начало файла)"""
+    size = os.path.getsize(path)
+    if size > MAX_INPUT_BYTES:
+        raise PreflightError(
+            f"Файл слишком большой (максимум {MAX_INPUT_BYTES // (1024 * 1024)} МБ)", status=413
+        )
+    return validate(_probe(path, size))
+
+
+def plan_upscale(
+    width: int,
+    height: int,
+    scale: float = 4,
+    model_scale: int = 4,
+    target_side: Optional[int] = None
+) -> UpscalePlan:
+    """
+    План апскейла под запрошенный размер
+
+    Args:
+        width: Ширина входа (после EXIF-ориентации)
+        height: Высота входа
+        scale: Запрошенный масштаб
+        model_scale: Собственный масштаб сети
+        target_side: Ограничение длинной стороны результата (None - UPSCALE_TARGET_SIDE)
+
+    Returns:
+        UpscalePlan
+    """
+    target_side = UPSCALE_TARGET_SIDE if target_side is None else target_side
+    long_side = max(width, height)
+
+    factor = scale
+    if target_side > 0:
+        factor = min(factor, target_side / long_side)
+    # Округление как у TileEngine, чтобы не делать лишний resize
+    target = (max(int(width * factor), 1), max(int(height * factor), 1))
+
+    if factor <= 1:
+        return UpscalePlan(True, 1.0, 1.0, (width, height))
+
+    # Сеть всегда увеличивает в model_scale раз: если нужно меньше,
+    # дешевле уменьшить вход, чем считать лишние пиксели и потом ужимать
+    pre_scale = factor / model_scale
+    if pre_scale < MIN_PRE_SCALE_GAIN:
+        return UpscalePlan(False, pre_scale, model_scale, target)
+    return UpscalePlan(False, 1.0, factor, target)
@@ -0,0 +1,126 @@
+"""
+Реестр прогретых моделей
+
+Каждая модель загружается один раз на процесс (воркер uvicorn) и дальше
+переиспользуется всеми запросами. Загрузка выполняется под блокировкой
+конкретной модели, поэтому параллельные запросы не грузят веса дважды.
+
+При SHARED_WEIGHTS=1 веса загруженной сети (nn.Module) заменяются
+отображением общего файла (modes/shared_weights.py) - воркеры делят одну
+копию. Обёртки (GFPGANer, движки, батчеры) ссылаются на уже
+зарегистрированные сети и не разбираются.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from modes import shared_weights
+from modes.metrics import MODEL_LOAD_SECONDS, MODEL_LOADS, module_memory_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def _is_module(model: Any) -> bool:
+    try:
+        from torch import nn
+    except ImportError:
+        return False
+    return isinstance(model, nn.Module)
+
+
+class ModelRegistry:
+    """Потокобезопасный реестр загруженных моделей"""
+
+    def __init__(self):
+        self._models: Dict[str, Any] = {}
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._inference_locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+        # Байт весов модели в общих файлах (SHARED_WEIGHTS)
+        self.shared_bytes: Dict[str, int] = {}
+
+    def _lock_for(self, locks: Dict[str, threading.Lock], name: str) -> threading.Lock:
+        with self._guard:
+            if name not in locks:
+                locks[name] = threading.Lock()
+            return locks[name]
+
+    def get(self, name: str, loader: Callable[[], Any]) -> Any:
+        """
+        Получение модели с ленивой загрузкой при первом обращении
+
+        Args:
+            name: Ключ модели в реестре
+            loader: Синхронная функция, возвращающая готовую модель
+
+        Returns:
+            Загруженная модель
+        """
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._lock_for(self._load_locks, name):
+            # Повторная проверка: модель могли загрузить, пока мы ждали
+            model = self._models.get(name)
+            if model is not None:
+                return model
+
+            logger.info(f"Загрузка модели {name}...")
+            start = time.perf_counter()
+            model = loader()
+            if model is None:
+                raise RuntimeError(f"Загрузчик модели {name} вернул None")
+            if shared_weights.SHARED_WEIGHTS and _is_module(model):
+                self.shared_bytes[name] = shared_weights.share_weights(name, model)
+            MODEL_LOADS.labels(name).inc()
+            MODEL_LOAD_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+            with self._guard:
+                self._models[name] = model
+            logger.info(f"Модель {name} загружена")
+            return model
+
+    async def aget(self, name: str, loader: Callable[[], Any]) -> Any:
+        """Асинхронная версия get: загрузка весов идёт вне event loop"""
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        return await asyncio.to_thread(self.get, name, loader)
+
+    def inference_lock(self, name: str) -> threading.Lock:
+        """
+        Блокировка для инференса модели
+
+        Объекты вроде FaceRestoreHelper хранят промежуточное состояние в
+        self, поэтому один экземпляр нельзя вызывать из нескольких потоков сразу.
+        """
+        return self._lock_for(self._inference_locks, name)
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def memory_bytes(self) -> Dict[str, int]:
+        """Память весов загруженных моделей (общие сети считаются один раз)"""
+        seen: set = set()
+        with self._guard:
+            models = dict(self._models)
+        return {name: module_memory_bytes(model, seen) for name, model in models.items()}
+
+
+# Глобальный реестр процесса (ленивый синглтон)
+_global_registry: Optional[ModelRegistry] = None
+_registry_guard = threading.Lock()
+
+
+def get_registry() -> ModelRegistry:
+    """Получение реестра моделей текущего процесса"""
+    global _global_registry
+    if _global_registry is None:
+        with _registry_guard:
+            if _global_registry is None:
+                _global_registry = ModelRegistry()
+    return _global_registry
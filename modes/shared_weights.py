@@ -0,0 +1,257 @@
+"""
+Общие веса моделей для нескольких воркеров uvicorn
+
+uvicorn --workers запускает воркеры через spawn, а не fork, поэтому
+загруженные до старта веса копией при записи не делятся: каждый воркер
+держал бы свою копию обеих сетей Real-ESRGAN и GFPGAN.
+
+Вместо этого веса каждой сети один раз сохраняются в отдельный файл
+(weights/shared/*.pt), а воркеры отображают его в память (torch.load
+с mmap=True) и подставляют тензоры в модуль без копирования
+(load_state_dict с assign=True). Страницы весов лежат в page cache ядра
+и общие для всех процессов; на инференсе веса только читаются, поэтому
+копии при записи не возникает.
+
+Файл подписан отпечатком весов (формы и выборка значений), поэтому
+после замены .pth он пересоздаётся сам. Экспорт можно выполнить до старта
+воркеров - тогда они только отображают готовые файлы:
+
+    python -m modes.shared_weights && uvicorn api.api:app --workers 2
+
+Настройка через переменные окружения:
+- SHARED_WEIGHTS: 1 - отображать веса из общих файлов
+- SHARED_WEIGHTS_DIR: каталог общих файлов весов
+"""
+
+import asyncio
+import ctypes
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+SHARED_WEIGHTS = os.getenv("SHARED_WEIGHTS", "0") == "1"
+SHARED_WEIGHTS_DIR = os.getenv("SHARED_WEIGHTS_DIR", os.path.join("weights", "shared"))
+
+# Элементов каждого тензора в отпечатке
+FINGERPRINT_SAMPLES = 64
+
+# Модули, уже отображённые в этом процессе (общая сеть в нескольких обёртках)
+_shared_modules: Dict[int, Any] = {}
+_guard = threading.Lock()
+
+
+def _find_modules(obj: Any, path: str, seen: set, depth: int = 3) -> Iterator[Tuple[str, Any]]:
+    """torch-модули объекта и путь к ним по атрибутам (как в module_memory_bytes)"""
+    from torch import nn
+
+    if id(obj) in seen or depth < 0:
+        return
+    seen.add(id(obj))
+
+    if isinstance(obj, nn.Module):
+        yield path, obj
+        return
+
+    attributes = getattr(obj, "__dict__", None) or {}
+    for name, value in attributes.items():
+        if isinstance(value, nn.Module) or hasattr(value, "__dict__"):
+            yield from _find_modules(value, f"{path}.{name}" if path else name, seen, depth - 1)
+
+
+def fingerprint(state: Dict[str, Any]) -> str:
+    """Отпечаток весов: имена, формы, типы и выборка значений каждого тензора"""
+    digest = hashlib.sha1()
+    for name, tensor in state.items():
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype};".encode())
+        flat = tensor.detach().reshape(-1)
+        step = max(1, flat.numel() // FINGERPRINT_SAMPLES)
+        # numpy не знает bfloat16 - выборка в float32 (тип уже учтён выше)
+        digest.update(flat[::step][:FINGERPRINT_SAMPLES].float().cpu().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+@contextmanager
+def export_lock(path: str) -> Iterator[None]:
+    """
+    Межпроцессная блокировка экспорта: воркеры, стартующие одновременно,
+    иначе записали бы каждый свой файл и отобразили разные копии
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _export(state: Dict[str, Any], path: str) -> None:
+    """Запись весов в файл атомарно: воркеры не увидят недописанный файл"""
+    import torch
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        torch.save({name: tensor.detach().cpu().contiguous() for name, tensor in state.items()}, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # Файлы прежних весов той же сети больше не нужны. Имя сверяется целиком:
+    # ключ другой сети может начинаться так же (model.net и model.net.body)
+    directory, name = os.path.split(path)
+    prefix = name.rsplit("-", 1)[0]
+    pattern = re.compile(rf"{re.escape(prefix)}-[0-9a-f]{{16}}\.pt(\.lock)?")
+    for stale in os.listdir(directory or "."):
+        if pattern.fullmatch(stale) and not stale.startswith(name):
+            try:
+                os.remove(os.path.join(directory, stale))
+            except OSError:
+                pass
+
+
+def share_module(module: Any, key: str) -> int:
+    """
+    Подмена весов модуля отображением общего файла
+
+    Args:
+        module: torch-модуль на CPU
+        key: Имя файла весов (без отпечатка)
+
+    Returns:
+        Размер отображённых весов в байтах (0 - модуль не подходит)
+    """
+    import torch
+
+    state = module.state_dict()
+    if not state or any(
+        # Квантованные веса (int8) не отображаются - остаются в памяти процесса
+        not isinstance(tensor, torch.Tensor) or tensor.is_quantized or tensor.device.type != "cpu"
+        for tensor in state.values()
+    ):
+        return 0
+
+    path = os.path.join(SHARED_WEIGHTS_DIR, f"{key}-{fingerprint(state)}.pt")
+    if not os.path.exists(path):
+        with export_lock(path):
+            if not os.path.exists(path):
+                logger.info(f"Экспорт общих весов: {path}")
+                _export(state, path)
+
+    mapped = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    module.load_state_dict(mapped, assign=True)
+    return sum(tensor.numel() * tensor.element_size() for tensor in mapped.values())
+
+
+def share_weights(name: str, model: Any) -> int:
+    """
+    Отображение весов загруженной сети (реестр передаёт только nn.Module;
+    вложенные сети обёртки нашлись бы по атрибутам)
+
+    Args:
+        name: Ключ модели в реестре
+        model: Загруженная модель
+
+    Returns:
+        Байт весов в общих файлах
+    """
+    safe_name = re.sub(r"[^\w.-]+", "_", name)
+    total = 0
+    for path, module in _find_modules(model, "", set()):
+        with _guard:
+            if id(module) in _shared_modules:
+                continue
+            _shared_modules[id(module)] = module
+        key = f"{safe_name}.{path}" if path else safe_name
+        try:
+            total += share_module(module, key)
+        except Exception as e:
+            # Без общих весов модель работает как раньше, только с личной копией
+            logger.warning(f"Веса {key} остались в памяти процесса: {e}")
+
+    if total:
+        _release_heap()
+        logger.info(f"Модель {name}: {total / 2 ** 20:.1f} МБ весов в общей памяти")
+    return total
+
+
+def _release_heap() -> None:
+    """Возврат освобождённых личных копий весов системе (glibc)"""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def process_memory() -> Dict[str, int]:
+    """
+    Память процесса из /proc/self/smaps_rollup, байты
+
+    uss - только этого процесса, shared - страницы, общие с другими
+    процессами (в том числе отображённые веса), pss - доля процесса
+    с учётом общих страниц (сумма pss воркеров - их реальная стоимость)
+    """
+    fields = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3 and parts[0].endswith(":") and parts[2] == "kB":
+                    fields[parts[0][:-1]] = int(parts[1]) * 1024
+    except (OSError, ValueError):
+        return {}
+
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)
+    }
+
+
+def memory_report() -> str:
+    memory = process_memory()
+    if not memory:
+        return "нет данных о памяти"
+    return (
+        f"уникальная {memory['uss'] / 2 ** 20:.0f} МБ, общая {memory['shared'] / 2 ** 20:.0f} МБ, "
+        f"PSS {memory['pss'] / 2 ** 20:.0f} МБ, RSS {memory['rss'] / 2 ** 20:.0f} МБ"
+    )
+
+
+async def export_all() -> List[str]:
+    """Загрузка всех моделей с экспортом общих весов (до старта воркеров)"""
+    from modes.face_restore import get_face_restorer
+    from modes.upscale import get_upscaler
+
+    failed = []
+    for warmup in (get_upscaler, get_face_restorer):
+        try:
+            await warmup()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки моделей: {e}")
+            failed.append(warmup.__name__)
+    return failed
+
+
+def main() -> int:
+    global SHARED_WEIGHTS
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    SHARED_WEIGHTS = True
+    failed = asyncio.run(export_all())
+    if failed:
+        # Не мешаем старту воркеров: модели догрузятся лениво, с личной копией
+        logger.error(f"Общие веса подготовлены не для всех моделей: {', '.join(failed)}")
+    logger.info(f"Общие веса в {SHARED_WEIGHTS_DIR}; память процесса: {memory_report()}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,382 @@
+"""
+Тайловый движок для Real-ESRGAN
+
+Изображение режется на тайлы одинакового размера с перекрытием, несколько
+тайлов прогоняются через сеть одним батчем, а перекрытия склеиваются с
+плавными весами, чтобы не было швов. Результат собирается полосами по
+рядам тайлов, поэтому во float-буферах живут только 1-2 ряда тайлов,
+а не всё увеличенное изображение.
+
+Размер тайла и батча по умолчанию подбираются по размеру изображения и
+доступной памяти (с учётом лимита cgroup контейнера).
+
+Несколько изображений (пакетная обработка) режутся на тайлы одного
+размера, и тайлы разных изображений идут через сеть общими батчами.
+"""
+
+import logging
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import torch
+
+from modes.metrics import report_stage
+
+logger = logging.getLogger(__name__)
+
+# Оценка памяти активаций RRDBNet (fp32) на один входной пиксель тайла
+ACTIVATION_BYTES_PER_PIXEL = 12 * 1024
+# Какую долю свободной памяти можно отдать под активации
+MEMORY_FRACTION = 0.5
+# Изображения не больше этого размера обрабатываются одним проходом
+MAX_WHOLE_IMAGE_SIDE = 512
+TILE_SIZES = (512, 384, 256, 192, 128, 96, 64)
+MAX_BATCH_SIZE = 8
+# Фиксированный тайл при микробатчинге: тайлы разных запросов одного размера
+BATCHED_TILE_SIZE = 128
+
+
+def available_memory_bytes() -> int:
+    """Свободная память с учётом лимита cgroup (Render, Docker)"""
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            with open("/sys/fs/cgroup/memory.current") as f:
+                used = int(f.read().strip())
+            return max(int(limit) - used, 0)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return 1024 * 1024 * 1024
+
+
+def plan_tiles(
+    height: int,
+    width: int,
+    tile_pad: int = 10,
+    memory_bytes: Optional[int] = None
+) -> Tuple[int, int]:
+    """
+    Автоматический выбор размера тайла и батча
+
+    Args:
+        height: Высота входного изображения
+        width: Ширина входного изображения
+        tile_pad: Отступ вокруг тайла (перекрытие = 2 * tile_pad)
+        memory_bytes: Доступная память (по умолчанию - определяется)
+
+    Returns:
+        (размер тайла, размер батча); размер тайла 0 - без тайлинга
+    """
+    budget = (memory_bytes or available_memory_bytes()) * MEMORY_FRACTION
+
+    if (max(height, width) <= MAX_WHOLE_IMAGE_SIDE
+            and height * width * ACTIVATION_BYTES_PER_PIXEL <= budget):
+        return 0, 1
+
+    tile_size = TILE_SIZES[-1]
+    for size in TILE_SIZES:
+        if size * size * ACTIVATION_BYTES_PER_PIXEL <= budget and size > 2 * tile_pad:
+            tile_size = size
+            break
+
+    per_tile = tile_size * tile_size * ACTIVATION_BYTES_PER_PIXEL
+    stride = max(tile_size - 2 * tile_pad, 1)
+    tiles = _count_tiles(height, tile_size, stride) * _count_tiles(width, tile_size, stride)
+    batch_size = int(max(1, min(budget // per_tile, MAX_BATCH_SIZE, tiles)))
+    return tile_size, batch_size
+
+
+def _count_tiles(length: int, tile: int, stride: int) -> int:
+    return len(_tile_starts(length, tile, stride))
+
+
+def _tile_starts(length: int, tile: int, stride: int) -> List[int]:
+    """Начала тайлов вдоль оси; последний тайл прижат к краю"""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def _feather(length: int, ramp: int) -> np.ndarray:
+    """Одномерные веса тайла: линейный спад к краям на ширине перекрытия"""
+    weights = np.ones(length, dtype=np.float32)
+    ramp = min(ramp, length // 2)
+    if ramp > 0:
+        edge = np.arange(1, ramp + 1, dtype=np.float32) / (ramp + 1)
+        weights[:ramp] = edge
+        weights[length - ramp:] = edge[::-1]
+    return weights
+
+
+def _to_tensor(img: np.ndarray) -> torch.Tensor:
+    """BGR uint8 (H, W, 3) -> RGB uint8 (3, H, W)"""
+    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return torch.from_numpy(rgb).permute(2, 0, 1).contiguous()
+
+
+class _BandAssembler:
+    """Сборка результата полосами по рядам тайлов"""
+
+    def __init__(self, height: int, width: int, tile_h: int, tile_w: int, overlap: int, scale: int):
+        s = scale
+        self.scale = s
+        self.tile_h = tile_h
+        self.tile_w = tile_w
+        self.ys = _tile_starts(height, tile_h, max(tile_h - overlap, 1))
+        self.xs = _tile_starts(width, tile_w, max(tile_w - overlap, 1))
+        self.weight = torch.from_numpy(np.outer(
+            _feather(tile_h * s, overlap * s),
+            _feather(tile_w * s, overlap * s)
+        ))
+        self.output = np.empty((height * s, width * s, 3), dtype=np.uint8)
+        self.acc = torch.zeros(3, tile_h * s, width * s)
+        self.wsum = torch.zeros(1, tile_h * s, width * s)
+        self.row = 0
+        # Последний тайл: после него изображение можно дописывать и отдавать
+        self.last = (self.ys[-1], self.xs[-1])
+
+    @property
+    def tiles(self) -> List[Tuple[int, int]]:
+        """Тайлы в порядке строк - в этом порядке их нужно передавать в add"""
+        return [(y, x) for y in self.ys for x in self.xs]
+
+    def _flush(self) -> None:
+        """Запись готовой части полосы и сдвиг буфера к следующему ряду"""
+        s, ys, row = self.scale, self.ys, self.row
+        y0 = ys[row]
+        y1 = ys[row + 1] if row + 1 < len(ys) else y0 + self.tile_h
+        done = (y1 - y0) * s
+
+        band = (self.acc[:, :done] / self.wsum[:, :done].clamp(min=1e-8)).mul_(255.0).round_()
+        self.output[y0 * s:y1 * s] = band.byte().permute(1, 2, 0).numpy()[:, :, ::-1]
+
+        # Невыведенный хвост полосы - перекрытие со следующим рядом
+        next_acc = torch.zeros_like(self.acc)
+        next_wsum = torch.zeros_like(self.wsum)
+        rest = self.tile_h * s - done
+        if rest > 0:
+            next_acc[:, :rest] = self.acc[:, done:]
+            next_wsum[:, :rest] = self.wsum[:, done:]
+        self.acc, self.wsum = next_acc, next_wsum
+
+    def add(self, y: int, x: int, out: torch.Tensor) -> None:
+        while self.ys[self.row] != y:
+            self._flush()
+            self.row += 1
+
+        x0 = x * self.scale
+        x1 = x0 + self.tile_w * self.scale
+        self.acc[:, :, x0:x1] += out * self.weight
+        self.wsum[:, :, x0:x1] += self.weight
+
+    def finish(self) -> np.ndarray:
+        self._flush()
+        return self.output
+
+
+class TileEngine:
+    """Батчевый тайловый апскейл поверх загруженной сети"""
+
+    def __init__(self, model: torch.nn.Module, scale: int, device="cpu"):
+        """
+        Args:
+            model: Сеть апскейла (например, RRDBNet)
+            scale: Собственный масштаб сети
+            device: Устройство, на котором находится сеть
+        """
+        self.model = model
+        self.scale = scale
+        self.device = torch.device(device)
+        # У квантованной сети нет float-параметров - вход остаётся fp32
+        parameter = next(model.parameters(), None)
+        self.dtype = parameter.dtype if parameter is not None and parameter.is_floating_point() else torch.float32
+        # MicroBatcher, общий для параллельных запросов (None - без батчинга)
+        self.batcher = None
+
+    def enhance(
+        self,
+        img: np.ndarray,
+        outscale: float = 4,
+        tile_size: Optional[int] = None,
+        tile_pad: int = 10,
+        batch_size: Optional[int] = None
+    ) -> np.ndarray:
+        """
+        Апскейл изображения BGR uint8
+
+        Args:
+            img: Изображение BGR
+            outscale: Итоговый масштаб
+            tile_size: Размер тайла (None - авто, 0 - без тайлинга)
+            tile_pad: Отступ вокруг тайла, перекрытие соседних тайлов = 2 * tile_pad
+            batch_size: Тайлов за один проход сети (None - авто)
+
+        Returns:
+            Увеличенное изображение BGR uint8
+        """
+        height, width = img.shape[:2]
+
+        if self.batcher is not None and tile_size is None:
+            # Одинаковые тайлы у всех запросов - общий батч без дополнения
+            tile_size = BATCHED_TILE_SIZE
+
+        if tile_size is None or batch_size is None:
+            auto_tile, auto_batch = plan_tiles(height, width, tile_pad)
+            tile_size = auto_tile if tile_size is None else tile_size
+            batch_size = auto_batch if batch_size is None else batch_size
+
+        tile_h = min(tile_size or height, height)
+        tile_w = min(tile_size or width, width)
+        overlap = min(2 * tile_pad, tile_h - 1, tile_w - 1)
+        overlap = max(overlap, 0)
+
+        output = self._upscale_tiles(_to_tensor(img), tile_h, tile_w, overlap, max(batch_size, 1))
+        return self._rescale(output, width, height, outscale)
+
+    def enhance_many(
+        self,
+        images: Sequence[np.ndarray],
+        outscales: Sequence[float],
+        tile_size: Optional[int] = None,
+        tile_pad: int = 10,
+        batch_size: Optional[int] = None
+    ) -> List[np.ndarray]:
+        """
+        Апскейл нескольких изображений общими батчами тайлов
+
+        Все изображения режутся на тайлы одного размера, поэтому последние
+        тайлы одного изображения и первые следующего попадают в один проход
+        сети. Изображения меньше тайла дают тайлы своего размера и
+        батчатся с изображениями той же формы.
+
+        Args:
+            images: Изображения BGR uint8
+            outscales: Итоговый масштаб каждого изображения
+            tile_size: Размер тайла (None - BATCHED_TILE_SIZE, 0 - изображение целиком)
+            tile_pad: Отступ вокруг тайла
+            batch_size: Тайлов за один проход сети (None - по памяти)
+
+        Returns:
+            Увеличенные изображения в порядке images
+        """
+        if tile_size is None:
+            tile_size = BATCHED_TILE_SIZE
+        if batch_size is None:
+            per_tile = max(tile_size, 1) ** 2 * ACTIVATION_BYTES_PER_PIXEL
+            budget = available_memory_bytes() * MEMORY_FRACTION
+            batch_size = int(max(1, min(budget // per_tile, MAX_BATCH_SIZE)))
+
+        # Изображения с одинаковой формой тайла - одна очередь тайлов
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        plans = []
+        for index, img in enumerate(images):
+            height, width = img.shape[:2]
+            tile_h = min(tile_size or height, height)
+            tile_w = min(tile_size or width, width)
+            overlap = max(min(2 * tile_pad, tile_h - 1, tile_w - 1), 0)
+            plans.append((tile_h, tile_w, overlap))
+            groups.setdefault((tile_h, tile_w), []).append(index)
+
+        stride = lambda tile: max(tile - overlap, 1)
+        total = sum(
+            _count_tiles(img.shape[0], tile_h, stride(tile_h)) * _count_tiles(img.shape[1], tile_w, stride(tile_w))
+            for img, (tile_h, tile_w, overlap) in zip(images, plans)
+        )
+        done = 0
+
+        results: List[Optional[np.ndarray]] = [None] * len(images)
+        for (tile_h, tile_w), indices in groups.items():
+            assemblers = {
+                i: _BandAssembler(*images[i].shape[:2], tile_h, tile_w, plans[i][2], self.scale)
+                for i in indices
+            }
+            tiles = [(i, y, x) for i in indices for y, x in assemblers[i].tiles]
+            tensors = {}
+
+            for start in range(0, len(tiles), batch_size):
+                chunk = tiles[start:start + batch_size]
+                for i, _, _ in chunk:
+                    if i not in tensors:
+                        tensors[i] = _to_tensor(images[i])
+
+                batch = torch.stack([
+                    tensors[i][:, y:y + tile_h, x:x + tile_w] for i, y, x in chunk
+                ]).to(self.device, self.dtype).div_(255.0)
+                with torch.no_grad():
+                    output = self._forward(batch).float().clamp_(0, 1).cpu()
+
+                done += len(chunk)
+                report_stage("inference", done / max(total, 1))
+                for (i, y, x), out in zip(chunk, output):
+                    assemblers[i].add(y, x, out)
+                    if (y, x) == assemblers[i].last:
+                        # Изображение собрано - освобождаем буферы до конца группы
+                        height, width = images[i].shape[:2]
+                        results[i] = self._rescale(assemblers.pop(i).finish(), width, height, outscales[i])
+                        del tensors[i]
+
+        return results
+
+    def _rescale(self, output: np.ndarray, width: int, height: int, outscale: float) -> np.ndarray:
+        if outscale != self.scale:
+            output = cv2.resize(
+                output,
+                (int(width * outscale), int(height * outscale)),
+                interpolation=cv2.INTER_LANCZOS4
+            )
+        return output
+
+    def _run_batches(
+        self,
+        tensor: torch.Tensor,
+        tiles: List[Tuple[int, int]],
+        tile_h: int,
+        tile_w: int,
+        batch_size: int
+    ) -> Iterator[Tuple[int, int, torch.Tensor]]:
+        """Прогон тайлов через сеть батчами, в порядке строк"""
+        with torch.no_grad():
+            for i in range(0, len(tiles), batch_size):
+                chunk = tiles[i:i + batch_size]
+                batch = torch.stack([
+                    tensor[:, y:y + tile_h, x:x + tile_w] for y, x in chunk
+                ]).to(self.device, self.dtype).div_(255.0)
+
+                result = self._forward(batch).float().clamp_(0, 1).cpu()
+                for (y, x), out in zip(chunk, result):
+                    yield y, x, out
+
+    def _forward(self, batch: torch.Tensor) -> torch.Tensor:
+        if self.batcher is not None:
+            return self.batcher.infer(batch)
+        return self.model(batch)
+
+    def _upscale_tiles(
+        self,
+        tensor: torch.Tensor,
+        tile_h: int,
+        tile_w: int,
+        overlap: int,
+        batch_size: int
+    ) -> np.ndarray:
+        """Сборка результата полосами по рядам тайлов"""
+        _, height, width = tensor.shape
+        assembler = _BandAssembler(height, width, tile_h, tile_w, overlap, self.scale)
+        tiles = assembler.tiles
+        for done, (y, x, out) in enumerate(self._run_batches(tensor, tiles, tile_h, tile_w, batch_size), 1):
+            assembler.add(y, x, out)
+            report_stage("inference", done / len(tiles))
+        return assembler.finish()
@@ -1,14 +1,92 @@
+import asyncio
 import cv2
 import numpy as np
 import os
 import logging
-from typing import Optional, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 from datetime import datetime
-from realesrgan import RealESRGANer
+from basicsr.archs.rrdbnet_arch import RRDBNet
+import torch
+from modes.backends import backend_of, compile_model
+from modes.batching import MicroBatcher
+from modes.classifier import ANIME, PHOTO, get_classifier
+from modes.encoding import EncodeOptions
+from modes.executor import ExecutorBusy, get_executor
+from modes.metrics import count_error, stage_timer, track_job
+from modes.precision import FP32, build_variant, resolve_precision
+from modes.preflight import PreflightError, UpscalePlan, plan_upscale, probe_bytes
+from modes.registry import get_registry
+from modes.tiling import TileEngine
 from modes.utils import ImageUtils, Logger, ModelLoader
 
 logger = logging.getLogger(__name__)
 
+# Микробатчинг параллельных запросов к одной модели (0 мс - отключён).
+# Включается, только если MODE_CONCURRENCY разрешает несколько апскейлов сразу
+# (по умолчанию upscale=2, см. modes/executor.py)
+UPSCALE_MAX_BATCH = int(os.getenv("UPSCALE_MAX_BATCH", "8"))
+UPSCALE_MAX_WAIT_MS = float(os.getenv("UPSCALE_MAX_WAIT_MS", "20"))
+
+MODELS = {
+    "RealESRGAN_x4plus": {
+        "url": "https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth",
+        "scale": 4,
+        "num_block": 23
+    },
+    "RealESRGAN_x4plus_anime_6B": {
+        "url": "https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.0/RealESRGAN_x4plus_anime_6B.pth",
+        "scale": 4,
+        "num_block": 6
+    }
+}
+
+# Модель для каждого стиля изображения (и допустимые значения model=...)
+STYLE_MODELS = {
+    ANIME: "RealESRGAN_x4plus_anime_6B",
+    PHOTO: "RealESRGAN_x4plus"
+}
+
+def resolve_model(model: Optional[str]) -> Optional[str]:
+    """
+    Имя модели по значению параметра model
+
+    Args:
+        model: None или auto - автовыбор, anime / photo или имя модели из MODELS
+
+    Returns:
+        Имя модели или None для автовыбора
+
+    Raises:
+        ValueError: если модель неизвестна
+    """
+    if model in (None, "", "auto"):
+        return None
+    if model in STYLE_MODELS:
+        return STYLE_MODELS[model]
+    if model in MODELS:
+        return model
+    raise ValueError(f"Неизвестная модель: {model}")
+
+def _build_network(model_path: str, config: dict, device: str) -> RRDBNet:
+    """
+    Сеть RRDB с весами Real-ESRGAN
+
+    Инференс идёт через TileEngine, поэтому обёртка RealESRGANer не нужна:
+    веса загружаются так же, как в ней (params_ema, если есть)
+    """
+    model = RRDBNet(
+        num_in_ch=3,
+        num_out_ch=3,
+        num_feat=64,
+        num_block=config["num_block"],
+        num_grow_ch=32,
+        scale=config["scale"]
+    )
+    state = torch.load(model_path, map_location="cpu", weights_only=True)
+    key = "params_ema" if "params_ema" in state else "params"
+    model.load_state_dict(state[key] if key in state else state, strict=True)
+    return model.eval().to(device)
+
 class ImageUpscaler:
     """Класс для апскейла изображений с Real-ESRGAN"""
 
@@ -17,60 +95,140 @@ class ImageUpscaler:
         self.logger = Logger()
         self.models_dir = models_dir
         self.device = device
-        self.upsamplers = {}
+        # Исходные сети PyTorch (движки могут работать через скомпилированный граф)
+        self.networks = {}
+        self.engines = {}
+        # Движки вариантов точности по ключу реестра их сети
+        self.variant_engines = {}
         self.temp_files = []
 
     async def initialize_models(self):
-        """Предварительная загрузка моделей"""
+        """Предварительная загрузка моделей (один раз на процесс)"""
         try:
             os.makedirs(self.models_dir, exist_ok=True)
-            
-            models = {
-                "RealESRGAN_x4plus": {
-                    "url": "https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth",
-                    "scale": 4
-                },
-                "RealESRGAN_x4plus_anime_6B": {
-                    "url": "https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.0/RealESRGAN_x4plus_anime_6B.pth",
-                    "scale": 4
-                }
-            }
+            registry = get_registry()
 
-            for model_name, config in models.items():
+            for model_name, config in MODELS.items():
                 model_path = os.path.join(self.models_dir, f"{model_name}.pth")
-                if not os.path.exists(model_path):
+                key = self._registry_key(model_name)
+                if not registry.is_loaded(key) and not os.path.exists(model_path):
                     await ModelLoader.download_model(config["url"], model_path)
-                
-                self.upsamplers[model_name] = RealESRGANer(
-                    scale=config["scale"],
-                    model_path=model_path,
-                    device=self.device
+
+                network = await registry.aget(
+                    key,
+                    lambda path=model_path, cfg=config: _build_network(path, cfg, self.device)
+                )
+                self.networks[model_name] = network
+                # Скомпилированный граф (TorchScript / ONNX Runtime) или сама сеть
+                compiled = await registry.aget(
+                    f"{key}:compiled",
+                    lambda net=network, name=model_name: compile_model(net, name)
                 )
+                engine = TileEngine(compiled, config["scale"], self.device)
+                self._attach_batcher(engine, key)
+                self.engines[model_name] = engine
 
-            logger.info("Модели Real-ESRGAN инициализированы")
+            # Вариант точности по умолчанию собирается заранее (калибровка int8 - секунды)
+            precision = resolve_precision(None)
+            if precision != FP32:
+                for model_name in MODELS:
+                    await registry.aget(*self._variant(model_name, precision))
+
+            logger.info(
+                "Модели Real-ESRGAN инициализированы: "
+                + ", ".join(f"{name} ({backend})" for name, backend in self.backends().items())
+            )
             return True
         except Exception as e:
             logger.error(f"Ошибка инициализации моделей: {e}")
             return False
 
-    def _is_anime_image(self, img: np.ndarray) -> bool:
-        """Определение аниме-стиля изображения"""
+    def _registry_key(self, model_name: str) -> str:
+        return f"realesrgan:{model_name}:{self.device}"
+
+    def _attach_batcher(self, engine: TileEngine, key: str) -> None:
+        """MicroBatcher для сети движка, если пул разрешает несколько апскейлов сразу"""
+        if UPSCALE_MAX_WAIT_MS > 0 and get_executor().limit("upscale") > 1:
+            engine.batcher = get_registry().get(
+                f"batcher:{key}",
+                lambda: MicroBatcher(
+                    engine.model,
+                    scale=engine.scale,
+                    max_batch=UPSCALE_MAX_BATCH,
+                    max_wait_ms=UPSCALE_MAX_WAIT_MS
+                )
+            )
+
+    def backends(self) -> Dict[str, str]:
+        """Бэкенд инференса каждой загруженной модели (eager, torchscript, onnx)"""
+        return {name: backend_of(engine.model) for name, engine in self.engines.items()}
+
+    def _eager_model(self, model_name: str):
+        """Исходная сеть PyTorch модели (движок может работать через скомпилированный граф)"""
+        network = self.networks.get(model_name)
+        return network if network is not None else self.engines[model_name].model
+
+    def _variant(self, model_name: str, precision: str) -> Tuple[str, Callable[[], torch.nn.Module]]:
+        """
+        Ключ реестра и загрузчик сети модели в пониженной точности
+
+        В реестре хранится сама сеть, а не движок: при SHARED_WEIGHTS веса
+        bf16 отображаются из общего файла, как и fp32
+        """
+        key = f"{self._registry_key(model_name)}:{precision}"
+        # Квантование и bf16 - по исходной сети, не по скомпилированному графу
+        return key, lambda: build_variant(self._eager_model(model_name), precision)
+
+    def _engine(self, model_name: str, precision: str = FP32) -> TileEngine:
+        """Движок модели в заданной точности (вариант собирается при первом обращении)"""
+        if precision == FP32:
+            return self.engines[model_name]
+
+        key, load = self._variant(model_name, precision)
+        model = get_registry().get(key, load)
+        engine = self.variant_engines.get(key)
+        if engine is None or engine.model is not model:
+            base = self.engines[model_name]
+            if model is self._eager_model(model_name):
+                # Вариант отклонён проверкой точности - работает fp32
+                engine = base
+            else:
+                engine = TileEngine(model, base.scale, self.device)
+                self._attach_batcher(engine, key)
+            self.variant_engines[key] = engine
+        return engine
+
+    def _select_model(self, img: np.ndarray, model: Optional[str] = None) -> Tuple[str, float]:
+        """
+        Выбор модели по стилю изображения
+
+        Args:
+            img: Изображение BGR
+            model: Принудительная модель (см. resolve_model)
+
+        Returns:
+            (имя модели, уверенность классификатора; 1.0 для принудительной)
+        """
+        forced = resolve_model(model)
+        if forced is not None:
+            return forced, 1.0
+
         try:
-            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            saturation = np.mean(hsv[:, :, 1])
-            value = np.mean(hsv[:, :, 2])
-            return saturation > 100 and value > 130
+            style, confidence = get_classifier().classify(img)
         except Exception as e:
             logger.warning(f"Ошибка определения стиля: {e}")
-            return False
+            style, confidence = PHOTO, 0.5
+        return STYLE_MODELS[style], confidence
 
     async def upscale_image(
         self,
         input_path: str,
         output_path: str,
         scale: int = 4,
-        tile_size: int = 400,
-        tile_pad: int = 10
+        tile_size: Optional[int] = None,
+        tile_pad: int = 10,
+        model: Optional[str] = None,
+        precision: Optional[str] = None
     ) -> bool:
         """
         Апскейл изображения с автоматическим выбором модели
@@ -79,80 +237,360 @@ class ImageUpscaler:
             input_path: Путь к исходному изображению
             output_path: Путь для сохранения результата
             scale: Масштаб увеличения
-            tile_size: Размер тайлов для обработки
+            tile_size: Размер тайлов (None - авто по размеру и памяти, 0 - без тайлов)
             tile_pad: Отступы вокруг тайлов
+            model: Принудительная модель (None - автовыбор по стилю)
+            precision: Точность сети: fp32, bf16, int8 (None - UPSCALE_PRECISION)
             
         Returns:
             bool: Успешность операции
         """
-        # Валидация входного файла
-        is_valid, img = await self.utils.validate_image(input_path)
-        if not is_valid:
-            return False
+        with track_job("upscale"):
+            # Валидация входного файла
+            with stage_timer("upscale", "decode"):
+                is_valid, img = await self.utils.validate_image(input_path)
+            if not is_valid:
+                count_error("upscale", "decode")
+                return False
 
-        try:
-            # Выбор модели
-            model_name = "RealESRGAN_x4plus_anime_6B" if self._is_anime_image(img) else "RealESRGAN_x4plus"
-            
-            if model_name not in self.upsamplers:
-                raise ValueError(f"Модель {model_name} не загружена")
+            result = await self.upscale_array(
+                img, scale, tile_size, tile_pad, source=input_path, model=model, precision=precision
+            )
+            if result is None:
+                return False
 
-            logger.info(f"Начало апскейла (модель: {model_name}, scale: {scale})...")
+            with stage_timer("upscale", "encode"):
+                return await self.utils.save_image(result, output_path)
 
-            # Обработка с настройкой тайлов
-            upsampler = self.upsamplers[model_name]
-            result, _ = upsampler.enhance(
-                img,
-                outscale=scale,
-                tile_size=tile_size,
-                tile_pad=tile_pad
+    async def upscale_bytes(
+        self,
+        data: bytes,
+        scale: int = 4,
+        tile_size: Optional[int] = None,
+        tile_pad: int = 10,
+        model: Optional[str] = None,
+        encoding: Optional[EncodeOptions] = None,
+        precision: Optional[str] = None
+    ) -> Optional[bytes]:
+        """
+        Апскейл изображения целиком в памяти, без файлов
+
+        Args:
+            data: Закодированное изображение (JPG/PNG)
+            scale: Масштаб увеличения
+            tile_size: Размер тайлов (None - авто по размеру и памяти, 0 - без тайлов)
+            tile_pad: Отступы вокруг тайлов
+            model: Принудительная модель (None - автовыбор по стилю)
+            encoding: Параметры кодирования результата (None - по умолчанию)
+            precision: Точность сети: fp32, bf16, int8 (None - UPSCALE_PRECISION)
+
+        Returns:
+            Закодированный результат или None при ошибке
+        """
+        with track_job("upscale"):
+            # Лимиты проверяются по заголовку, до декодирования
+            try:
+                probe_bytes(data)
+            except PreflightError as e:
+                logger.warning(f"Изображение отклонено: {e}")
+                count_error("upscale", "preflight")
+                return None
+
+            with stage_timer("upscale", "decode"):
+                is_valid, img = await self.utils.decode_image(data)
+            if not is_valid:
+                count_error("upscale", "decode")
+                return None
+
+            result = await self.upscale_array(img, scale, tile_size, tile_pad, model=model, precision=precision)
+            if result is None:
+                return None
+
+            with stage_timer("upscale", "encode"):
+                return await self.utils.encode_image(result, options=encoding)
+
+    async def upscale_array(
+        self,
+        img: np.ndarray,
+        scale: int = 4,
+        tile_size: Optional[int] = None,
+        tile_pad: int = 10,
+        source: str = "memory",
+        model: Optional[str] = None,
+        precision: Optional[str] = None
+    ) -> Optional[np.ndarray]:
+        """
+        Апскейл декодированного изображения
+
+        Args:
+            img: Изображение BGR
+            scale: Масштаб увеличения
+            tile_size: Размер тайлов (None - авто по размеру и памяти, 0 - без тайлов)
+            tile_pad: Отступы вокруг тайлов
+            source: Источник изображения для лога
+            model: Принудительная модель (None - автовыбор по стилю)
+            precision: Точность сети: fp32, bf16, int8 (None - UPSCALE_PRECISION)
+
+        Returns:
+            Результат апскейла или None при ошибке
+        """
+        try:
+            precision = resolve_precision(precision)
+            # Выбор модели и инференс - в общем пуле, вне event loop
+            model_name, confidence, result, plan = await get_executor().run(
+                "upscale", self._upscale_sync, img, scale, tile_size, tile_pad, model, precision
             )
 
-            # Сохранение результата
-            if not await self.utils.save_image(result, output_path):
-                return False
-                
-            self.temp_files.append(output_path)
-            
             # Логирование
             self.logger.log_event({
                 "operation": "upscale",
-                "input": input_path,
-                "output": output_path,
+                "input": source,
                 "model": model_name,
+                "model_forced": resolve_model(model) is not None,
+                "precision": precision,
+                "style_confidence": round(confidence, 3),
                 "params": {
                     "scale": scale,
                     "tile_size": tile_size,
                     "tile_pad": tile_pad
                 },
+                "plan": plan.as_dict(),
                 "status": "success",
                 "timestamp": datetime.utcnow().isoformat()
             })
             
-            return True
-            
+            return result
+
+        except ExecutorBusy:
+            raise
         except Exception as e:
             logger.error(f"Ошибка апскейла: {e}")
+            count_error("upscale", e)
             self.logger.log_event({
                 "operation": "upscale",
-                "input": input_path,
+                "input": source,
                 "status": "failed",
                 "error": str(e),
                 "timestamp": datetime.utcnow().isoformat()
             })
-            return False
+            return None
+
+    async def upscale_many(
+        self,
+        images: Sequence[np.ndarray],
+        scale: int = 4,
+        model: Optional[str] = None,
+        source: str = "batch",
+        precision: Optional[str] = None
+    ) -> List[Optional[np.ndarray]]:
+        """
+        Апскейл нескольких декодированных изображений одним заданием пула
+
+        Тайлы изображений, попавших на одну модель, идут через сеть общими
+        батчами (TileEngine.enhance_many).
+
+        Args:
+            images: Изображения BGR
+            scale: Масштаб увеличения
+            model: Принудительная модель (None - автовыбор по стилю каждого изображения)
+            source: Источник изображений для лога
+            precision: Точность сети: fp32, bf16, int8 (None - UPSCALE_PRECISION)
+
+        Returns:
+            Результаты в порядке images; при ошибке - список из None
+        """
+        try:
+            precision = resolve_precision(precision)
+            results = await get_executor().run(
+                "upscale", self._upscale_many_sync, list(images), scale, model, precision
+            )
+
+            self.logger.log_event({
+                "operation": "upscale_batch",
+                "input": source,
+                "images": len(images),
+                "models": [model_name for model_name, _, _, _ in results],
+                "model_forced": resolve_model(model) is not None,
+                "precision": precision,
+                "params": {"scale": scale},
+                "plans": [plan.as_dict() for _, _, _, plan in results],
+                "status": "success",
+                "timestamp": datetime.utcnow().isoformat()
+            })
+
+            return [result for _, _, result, _ in results]
+
+        except ExecutorBusy:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка пакетного апскейла: {e}")
+            count_error("upscale", e)
+            self.logger.log_event({
+                "operation": "upscale_batch",
+                "input": source,
+                "images": len(images),
+                "status": "failed",
+                "error": str(e),
+                "timestamp": datetime.utcnow().isoformat()
+            })
+            return [None] * len(images)
+
+    def _prepare(
+        self,
+        img: np.ndarray,
+        scale: int,
+        model: Optional[str] = None
+    ) -> Tuple[UpscalePlan, np.ndarray, Optional[str], float]:
+        """
+        План, уменьшенный под план вход и выбранная модель
+
+        Returns:
+            (план, вход для сети, имя модели или None при пропуске, уверенность)
+        """
+        height, width = img.shape[:2]
+        model_scale = next(iter(self.engines.values())).scale if self.engines else 4
+        plan = plan_upscale(width, height, scale, model_scale)
+
+        if plan.skip:
+            # Вход уже не меньше целевого размера - сеть не запускаем
+            logger.info(f"Апскейл пропущен: {width}x{height} не меньше цели")
+            return plan, img, None, 1.0
+
+        if plan.pre_scale < 1:
+            # Сеть увеличит в model_scale раз - уменьшаем вход под итоговый размер
+            img = cv2.resize(
+                img,
+                (max(round(plan.target[0] / model_scale), 1), max(round(plan.target[1] / model_scale), 1)),
+                interpolation=cv2.INTER_AREA
+            )
+
+        # Стиль определяется по миниатюре - стоимость не зависит от размера
+        with stage_timer("upscale", "select"):
+            model_name, confidence = self._select_model(img, model)
+
+        if model_name not in self.engines:
+            raise ValueError(f"Модель {model_name} не загружена")
+        return plan, img, model_name, confidence
+
+    def _upscale_sync(
+        self,
+        img: np.ndarray,
+        scale: int,
+        tile_size: Optional[int],
+        tile_pad: int,
+        model: Optional[str] = None,
+        precision: str = FP32
+    ) -> Tuple[Optional[str], float, np.ndarray, UpscalePlan]:
+        """Выбор модели и апскейл (блокирующая часть, выполняется в пуле)"""
+        plan, img, model_name, confidence = self._prepare(img, scale, model)
+        if model_name is None:
+            return None, 1.0, img, plan
+
+        logger.info(
+            f"Начало апскейла (модель: {model_name}, {precision}, уверенность: {confidence:.2f}, scale: {scale})..."
+        )
+        engine = self._engine(model_name, precision)
+
+        # Тайлы идут через сеть батчами, а состояние запроса не хранится
+        # в общем объекте, поэтому блокировка модели не нужна
+        with stage_timer("upscale", "inference"):
+            result = engine.enhance(
+                img,
+                outscale=plan.outscale,
+                tile_size=tile_size,
+                tile_pad=tile_pad
+            )
+
+        return model_name, confidence, _fit(result, plan), plan
+
+    def _upscale_many_sync(
+        self,
+        images: List[np.ndarray],
+        scale: int,
+        model: Optional[str] = None,
+        precision: str = FP32
+    ) -> List[Tuple[Optional[str], float, np.ndarray, UpscalePlan]]:
+        """Пакетный апскейл: изображения группируются по модели (блокирующая часть)"""
+        prepared = [self._prepare(img, scale, model) for img in images]
+        results: List[Optional[Tuple[Optional[str], float, np.ndarray, UpscalePlan]]] = [None] * len(images)
+
+        groups = {}
+        for index, (plan, img, model_name, confidence) in enumerate(prepared):
+            if model_name is None:
+                results[index] = (None, 1.0, img, plan)
+            else:
+                groups.setdefault(model_name, []).append(index)
+
+        for model_name, indices in groups.items():
+            logger.info(f"Пакетный апскейл: {len(indices)} изображений, модель {model_name}, {precision}")
+            engine = self._engine(model_name, precision)
+            with stage_timer("upscale", "inference"):
+                outputs = engine.enhance_many(
+                    [prepared[i][1] for i in indices],
+                    [prepared[i][0].outscale for i in indices]
+                )
+            for i, output in zip(indices, outputs):
+                plan, _, _, confidence = prepared[i]
+                results[i] = (model_name, confidence, _fit(output, plan), plan)
+
+        return results
 
     async def cleanup(self):
         """Очистка временных файлов"""
         removed = self.utils.safe_remove(self.temp_files)
         logger.info(f"Очищено временных файлов: {removed}/{len(self.temp_files)}")
 
+def _fit(result: np.ndarray, plan: UpscalePlan) -> np.ndarray:
+    """Точный размер из плана (сеть могла округлить стороны)"""
+    if (result.shape[1], result.shape[0]) != plan.target:
+        result = cv2.resize(result, plan.target, interpolation=cv2.INTER_AREA)
+    return result
+
+# Общий апскейлер воркера (ленивый синглтон)
+_shared_upscaler: Optional[ImageUpscaler] = None
+# Параллельные первые запросы ждут одну инициализацию, а не запускают свою
+_upscaler_lock = asyncio.Lock()
+
+async def get_upscaler() -> ImageUpscaler:
+    """Получение прогретого апскейлера, общего для всех запросов"""
+    global _shared_upscaler
+    if _shared_upscaler is None:
+        async with _upscaler_lock:
+            if _shared_upscaler is None:
+                upscaler = ImageUpscaler()
+                if not await upscaler.initialize_models():
+                    raise RuntimeError("Модели Real-ESRGAN не загружены")
+                _shared_upscaler = upscaler
+    return _shared_upscaler
+
+def loaded_backends() -> Dict[str, str]:
+    """Бэкенды моделей общего апскейлера (пусто, пока модели не загружены)"""
+    if _shared_upscaler is None:
+        return {}
+    return _shared_upscaler.backends()
+
 # Адаптер для совместимости
 async def process_upscale(input_path: str, output_path: str, scale: int = 4) -> bool:
-    upscaler = ImageUpscaler()
-    if not await upscaler.initialize_models():
+    try:
+        upscaler = await get_upscaler()
+    except RuntimeError as e:
+        logger.error(str(e))
         return False
-        
-    result = await upscaler.upscale_image(input_path, output_path, scale)
-    await upscaler.cleanup()
-    return result
\ No newline at end of file
+
+    return await upscaler.upscale_image(input_path, output_path, scale)
+
+async def process_upscale_bytes(
+    data: bytes,
+    scale: int = 4,
+    model: Optional[str] = None,
+    encoding: Optional[EncodeOptions] = None,
+    precision: Optional[str] = None
+) -> Optional[bytes]:
+    """Апскейл в памяти: байты загрузки -> закодированный результат"""
+    try:
+        upscaler = await get_upscaler()
+    except RuntimeError as e:
+        logger.error(str(e))
+        return None
+
+    return await upscaler.upscale_bytes(data, scale, model=model, encoding=encoding, precision=precision)
@@ -1,10 +1,20 @@
 import os
 import hashlib
 import json
+import asyncio
+import atexit
+import queue
+import threading
+import uuid
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 import logging
 
+import cv2
+import numpy as np
+
+from modes.encoding import EncodeOptions, encode
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -40,6 +50,20 @@ class FileUtils:
             logger.error(f"Ошибка хеширования файла {path}: {e}")
             return None
 
+    @staticmethod
+    def hash_bytes(data: bytes, algorithm: str = "sha256") -> str:
+        """
+        Вычисляет хеш данных в памяти
+
+        Args:
+            data: Данные (например, загруженное изображение)
+            algorithm: Алгоритм хеширования (md5, sha1, sha256)
+
+        Returns:
+            Хеш-сумма
+        """
+        return hashlib.new(algorithm, data).hexdigest()
+
     @staticmethod
     def safe_remove(files: List[str]) -> int:
         """
@@ -62,35 +86,383 @@ class FileUtils:
                 logger.error(f"Ошибка удаления файла {path}: {e}")
         return success
 
+class ImageUtils(FileUtils):
+    """Утилиты чтения и записи изображений"""
+
+    @staticmethod
+    def read_image(path: str) -> Tuple[bool, Optional[np.ndarray]]:
+        """
+        Загрузка изображения с диска
+
+        Args:
+            path: Путь к изображению
+
+        Returns:
+            (успешность, изображение BGR или None)
+        """
+        if not os.path.exists(path):
+            logger.error(f"Файл не найден: {path}")
+            return False, None
+
+        try:
+            img = cv2.imread(path)
+            if img is None:
+                raise ValueError("Не удалось загрузить изображение")
+            return True, img
+        except Exception as e:
+            logger.error(f"Ошибка загрузки изображения: {e}")
+            return False, None
+
+    @staticmethod
+    def write_image(image: np.ndarray, path: str, options: Optional[EncodeOptions] = None) -> bool:
+        """
+        Сохранение изображения на диск
+
+        Args:
+            image: Изображение BGR
+            path: Путь к файлу
+            options: Параметры кодирования (None - по расширению файла)
+        """
+        try:
+            options = options or EncodeOptions.for_extension(os.path.splitext(path)[1] or ".jpg")
+            data = encode(image, options).data
+            with open(path, "wb") as f:
+                f.write(data)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения: {e}")
+            return False
+
+    @staticmethod
+    def decode_bytes(data: bytes) -> Tuple[bool, Optional[np.ndarray]]:
+        """
+        Декодирование изображения из памяти
+
+        Args:
+            data: Закодированное изображение (JPG/PNG/...)
+
+        Returns:
+            (успешность, изображение BGR или None)
+        """
+        try:
+            img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError("Не удалось декодировать изображение")
+            return True, img
+        except Exception as e:
+            logger.error(f"Ошибка декодирования изображения: {e}")
+            return False, None
+
+    @staticmethod
+    def encode_bytes(
+        image: np.ndarray, ext: str = ".jpg", options: Optional[EncodeOptions] = None
+    ) -> Optional[bytes]:
+        """
+        Кодирование изображения в память
+
+        Args:
+            image: Изображение BGR
+            ext: Формат по расширению, если options не заданы
+            options: Параметры кодирования (формат, качество, лимит размера)
+        """
+        try:
+            return encode(image, options or EncodeOptions.for_extension(ext)).data
+        except Exception as e:
+            logger.error(f"Ошибка кодирования: {e}")
+            return None
+
+    async def decode_image(self, data: bytes) -> Tuple[bool, Optional[np.ndarray]]:
+        """Декодирование изображения вне event loop"""
+        return await asyncio.to_thread(self.decode_bytes, data)
+
+    async def encode_image(
+        self, image: np.ndarray, ext: str = ".jpg", options: Optional[EncodeOptions] = None
+    ) -> Optional[bytes]:
+        """Кодирование изображения вне event loop"""
+        return await asyncio.to_thread(self.encode_bytes, image, ext, options)
+
+    async def validate_image(self, path: str) -> Tuple[bool, Optional[np.ndarray]]:
+        """Загрузка и проверка изображения вне event loop"""
+        return await asyncio.to_thread(self.read_image, path)
+
+    async def save_image(
+        self, image: np.ndarray, path: str, options: Optional[EncodeOptions] = None
+    ) -> bool:
+        """Сохранение изображения вне event loop"""
+        return await asyncio.to_thread(self.write_image, image, path, options)
+
+class ModelLoader:
+    """Загрузка весов и создание моделей"""
+
+    MODEL_URLS = {
+        "GFPGAN": "https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth",
+    }
+
+    @staticmethod
+    async def download_model(url: str, path: str, chunk_size: int = 1024 * 1024) -> bool:
+        """
+        Потоковая загрузка файла весов
+
+        Args:
+            url: Адрес файла весов
+            path: Путь для сохранения
+            chunk_size: Размер блока при записи
+
+        Returns:
+            True если файл загружен
+        """
+        import httpx
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Свой временный файл у каждой загрузки: параллельные загрузки (другой
+        # воркер uvicorn) не пишут в один файл, а os.replace атомарен
+        tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.part"
+        try:
+            async with httpx.AsyncClient(follow_redirects=True, timeout=None) as client:
+                async with client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    with open(tmp_path, "wb") as f:
+                        async for chunk in response.aiter_bytes(chunk_size):
+                            f.write(chunk)
+            os.replace(tmp_path, path)
+            logger.info(f"Загружены веса: {path}")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка загрузки весов {url}: {e}")
+            FileUtils.safe_remove([tmp_path])
+            return False
+
+    @staticmethod
+    def load_model(name: str, device: str = "cpu", models_dir: str = "weights") -> Any:
+        """
+        Создание модели восстановления лиц
+
+        Args:
+            name: Название модели (GFPGAN)
+            device: Устройство для обработки (cpu/cuda)
+            models_dir: Каталог с весами
+
+        Returns:
+            Готовый к работе экземпляр модели
+        """
+        if name == "GFPGAN":
+            from gfpgan import GFPGANer
+
+            model_path = os.path.join(models_dir, "GFPGANv1.4.pth")
+            if not os.path.exists(model_path):
+                # GFPGANer сам скачает веса по URL
+                model_path = ModelLoader.MODEL_URLS["GFPGAN"]
+
+            return GFPGANer(
+                model_path=model_path,
+                upscale=1,
+                arch="clean",
+                channel_multiplier=2,
+                bg_upsampler=None,
+                device=device
+            )
+
+        raise ValueError(f"Неподдерживаемая модель: {name}")
+
+class EventWriter(threading.Thread):
+    """
+    Фоновая запись событий в JSONL
+
+    Обработчики только кладут готовую строку в ограниченную очередь, а
+    поток пишет их пачками, держит файлы открытыми и сам ротирует их по
+    размеру. При переполнении очереди события отбрасываются, а в лог
+    попадает строка с количеством потерянных событий.
+
+    В один каталог могут писать несколько процессов (воркеры uvicorn): перед
+    каждой пачкой поток сверяет inode открытого файла с файлом на диске и,
+    если файл ротировал другой процесс, открывает новый, а размер для
+    ротации берёт по файлу, а не по своему счётчику.
+    """
+
+    def __init__(
+        self,
+        log_dir: str,
+        max_queue: int = 10000,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 3,
+        flush_interval: float = 0.5
+    ):
+        super().__init__(name=f"event-writer:{log_dir}", daemon=True)
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=max_queue)
+        self._files: Dict[str, Any] = {}
+        self._sizes: Dict[str, int] = {}
+        os.makedirs(log_dir, exist_ok=True)
+
+    def submit(self, log_file: str, line: str) -> bool:
+        """Постановка строки в очередь без ожидания"""
+        try:
+            self._queue.put_nowait((log_file, line))
+            return True
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+            return False
+
+    def run(self) -> None:
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = [item]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            self._write_batch([entry for entry in batch if entry is not None])
+            if stop:
+                self._close_all()
+                return
+
+    def _write_batch(self, batch: List[tuple]) -> None:
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            batch.append(("events.log", json.dumps({
+                "timestamp": datetime.utcnow().isoformat(),
+                "event": "log_events_dropped",
+                "count": dropped
+            }) + "\n"))
+
+        for log_file in {log_file for log_file, _ in batch}:
+            try:
+                self._reopen_if_rotated(log_file)
+            except Exception as e:
+                logger.error(f"Ошибка записи лога: {e}")
+
+        touched = set()
+        for log_file, line in batch:
+            try:
+                f = self._open(log_file)
+                data = line.encode("utf-8")
+                f.write(data)
+                self._sizes[log_file] += len(data)
+                touched.add(log_file)
+                if self._sizes[log_file] > self.max_bytes:
+                    self._rotate(log_file)
+                    touched.discard(log_file)
+            except Exception as e:
+                logger.error(f"Ошибка записи лога: {e}")
+
+        for log_file in touched:
+            try:
+                self._files[log_file].flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи лога: {e}")
+
+    def _open(self, log_file: str):
+        f = self._files.get(log_file)
+        if f is None:
+            path = os.path.join(self.log_dir, log_file)
+            f = open(path, "ab")
+            self._files[log_file] = f
+            self._sizes[log_file] = f.tell()
+        return f
+
+    def _reopen_if_rotated(self, log_file: str) -> None:
+        """Переоткрытие файла, который переименовал или удалил другой процесс"""
+        f = self._files.get(log_file)
+        if f is None:
+            return
+        try:
+            on_disk = os.stat(os.path.join(self.log_dir, log_file)).st_ino
+        except FileNotFoundError:
+            on_disk = None
+        if on_disk != os.fstat(f.fileno()).st_ino:
+            self._files.pop(log_file).close()
+            self._open(log_file)
+        else:
+            # Учитываем и записи других процессов в тот же файл
+            self._sizes[log_file] = os.fstat(f.fileno()).st_size
+
+    def _rotate(self, log_file: str) -> None:
+        f = self._files.pop(log_file)
+        f.close()
+        Logger._perform_rotation(os.path.join(self.log_dir, log_file), self.backup_count)
+
+    def set_rotation(self, max_bytes: int, backup_count: int) -> None:
+        """Новые лимиты ротации (применяются при следующей записи)"""
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def _close_all(self) -> None:
+        for f in self._files.values():
+            try:
+                f.close()
+            except Exception:
+                pass
+        self._files.clear()
+
+    def close(self, timeout: float = 2.0) -> None:
+        """Дописать очередь и остановить поток"""
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+_writers: Dict[str, EventWriter] = {}
+_writers_guard = threading.Lock()
+
+def get_event_writer(log_dir: str = "logs") -> EventWriter:
+    """Общий фоновый писатель для каталога логов"""
+    writer = _writers.get(log_dir)
+    if writer is None:
+        with _writers_guard:
+            writer = _writers.get(log_dir)
+            if writer is None:
+                writer = EventWriter(
+                    log_dir,
+                    max_queue=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+                    max_bytes=int(os.getenv("LOG_MAX_MB", "10")) * 1024 * 1024,
+                    backup_count=int(os.getenv("LOG_BACKUP_COUNT", "3"))
+                )
+                writer.start()
+                atexit.register(writer.close)
+                _writers[log_dir] = writer
+    return writer
+
 class Logger:
     """Усовершенствованная система логирования"""
     
     def __init__(self, log_dir: str = "logs"):
         self.log_dir = log_dir
-        os.makedirs(log_dir, exist_ok=True)
+        # Писатель общий для всех Logger с тем же каталогом
+        self._writer = get_event_writer(log_dir)
         
     def log_event(self, event_data: Dict[str, Any], log_file: str = "events.log") -> bool:
         """
-        Логирование события в JSONL формате
+        Логирование события в JSONL формате (без ожидания записи на диск)
         
         Args:
             event_data: Данные для логирования
             log_file: Имя файла лога
             
         Returns:
-            True если запись успешна
+            True если событие принято, False если очередь переполнена
         """
         try:
             entry = {
                 "timestamp": datetime.utcnow().isoformat(),
                 **event_data
             }
-            log_path = os.path.join(self.log_dir, log_file)
-            
-            with open(log_path, "a", encoding="utf-8") as f:
-                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-                
-            return True
+            return self._writer.submit(log_file, json.dumps(entry, ensure_ascii=False) + "\n")
         except Exception as e:
             logger.error(f"Ошибка записи лога: {e}")
             return False
@@ -98,17 +470,18 @@ class Logger:
     def rotate_logs(self, max_size_mb: int = 10, backup_count: int = 3) -> None:
         """
         Ротация лог-файлов при превышении размера
+
+        Ротацию выполняет фоновый писатель при записи, метод только
+        задаёт лимиты.
         
         Args:
             max_size_mb: Максимальный размер файла в MB
             backup_count: Количество бэкапов
         """
-        for log_name in os.listdir(self.log_dir):
-            log_path = os.path.join(self.log_dir, log_name)
-            if os.path.getsize(log_path) > max_size_mb * 1024 * 1024:
-                self._perform_rotation(log_path, backup_count)
+        self._writer.set_rotation(max_size_mb * 1024 * 1024, backup_count)
 
-    def _perform_rotation(self, log_path: str, backup_count: int) -> None:
+    @staticmethod
+    def _perform_rotation(log_path: str, backup_count: int) -> None:
         """Внутренний метод для ротации логов"""
         try:
             for i in range(backup_count - 1, 0, -1):
@@ -0,0 +1,527 @@
+"""
+Клиент внешних API улучшения изображений
+
+Один общий httpx-клиент на все сервисы: пул соединений с keep-alive
+(HTTP/2, если установлен пакет h2), раздельные таймауты на подключение
+и чтение ответа.
+
+Поверх клиента:
+- повторы с экспоненциальной задержкой при 5xx, 429 и сетевых ошибках
+  (заголовок Retry-After учитывается)
+- хеджирование: если выбранный сервис не ответил за PROVIDER_HEDGE_AFTER
+  секунд, параллельно отправляется запрос в следующий сервис с ключом,
+  используется первый успешный ответ, остальные запросы отменяются
+- маршрутизация "авто": ProviderRouter ведёт EWMA задержки и доли ошибок
+  каждого сервиса и автоматический выключатель (circuit breaker); запрос
+  уходит в самый быстрый здоровый сервис, открытые выключатели
+  пропускаются, восстановление проверяется фоновой пробой
+
+Настройка через переменные окружения:
+- PROVIDER_CONNECT_TIMEOUT: таймаут подключения, сек
+- PROVIDER_READ_TIMEOUT: таймаут ожидания ответа, сек
+- PROVIDER_MAX_CONNECTIONS: размер пула соединений
+- PROVIDER_MAX_KEEPALIVE: сколько соединений держать открытыми
+- PROVIDER_HTTP2: 1 - HTTP/2, 0 - только HTTP/1.1
+- PROVIDER_RETRIES: число повторов после первой попытки
+- PROVIDER_BACKOFF: начальная задержка между повторами, сек
+- PROVIDER_MAX_BACKOFF: максимальная задержка между повторами, сек
+- PROVIDER_HEDGE_AFTER: через сколько секунд хеджировать запрос (0 - выключено)
+- PROVIDER_EWMA_ALPHA: вес нового замера в EWMA
+- PROVIDER_BREAKER_FAILURES: сколько ошибок подряд открывают выключатель
+- PROVIDER_BREAKER_COOLDOWN: через сколько секунд пробовать восстановление
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ProviderError(Exception):
+    """Сервис не вернул результат"""
+
+    def __init__(self, provider: str, message: str, status: Optional[int] = None):
+        super().__init__(f"{provider}: {message}")
+        self.provider = provider
+        self.status = status
+
+
+class ProviderClient:
+    """Пул соединений, повторы и хеджирование запросов к внешним сервисам"""
+
+    def __init__(
+        self,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 60.0,
+        max_connections: int = 20,
+        max_keepalive: int = 10,
+        http2: bool = True,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        hedge_after: float = 0.0
+    ):
+        """
+        Args:
+            connect_timeout: Таймаут подключения (и ожидания соединения из пула)
+            read_timeout: Таймаут отправки файла и ожидания ответа
+            max_connections: Размер пула соединений
+            max_keepalive: Сколько простаивающих соединений держать открытыми
+            http2: Использовать HTTP/2 (если установлен h2)
+            retries: Число повторов после первой попытки
+            backoff: Начальная задержка между повторами
+            max_backoff: Верхняя граница задержки
+            hedge_after: Порог хеджирования, сек (0 - без хеджирования)
+        """
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("Пакет h2 не установлен, используется HTTP/1.1")
+            http2 = False
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(
+                read_timeout,
+                connect=connect_timeout,
+                pool=connect_timeout
+            ),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=30.0
+            )
+        )
+
+    @classmethod
+    def from_env(cls) -> "ProviderClient":
+        """Создание клиента по переменным окружения"""
+        return cls(
+            connect_timeout=float(os.getenv("PROVIDER_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(os.getenv("PROVIDER_READ_TIMEOUT", "60")),
+            max_connections=int(os.getenv("PROVIDER_MAX_CONNECTIONS", "20")),
+            max_keepalive=int(os.getenv("PROVIDER_MAX_KEEPALIVE", "10")),
+            http2=os.getenv("PROVIDER_HTTP2", "1") == "1",
+            retries=int(os.getenv("PROVIDER_RETRIES", "2")),
+            backoff=float(os.getenv("PROVIDER_BACKOFF", "0.5")),
+            max_backoff=float(os.getenv("PROVIDER_MAX_BACKOFF", "8")),
+            hedge_after=float(os.getenv("PROVIDER_HEDGE_AFTER", "0"))
+        )
+
+    def _delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """Задержка перед повтором: Retry-After или экспонента с джиттером"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), self.max_backoff)
+        delay = min(self.backoff * (2 ** attempt), self.max_backoff)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _request(
+        self,
+        method: str,
+        provider: str,
+        url: str,
+        consume: Callable[[httpx.Response], Awaitable[Any]],
+        accept: Optional[str] = None,
+        **kwargs
+    ) -> Any:
+        """
+        Потоковый запрос с повторами при временных ошибках
+
+        Тело успешного ответа не читается целиком: его по частям забирает
+        consume. Файлы multipart передаются открытыми файлами, httpx читает
+        их блоками и перематывает перед каждой попыткой. Если задан accept,
+        успешный ответ другого Content-Type считается ошибкой сервиса.
+        """
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with self.client.stream(method, url, **kwargs) as response:
+                    if response.is_success:
+                        content_type = response.headers.get("content-type", "")
+                        if accept and not content_type.startswith(accept):
+                            body = (await response.aread())[:200]
+                            raise ProviderError(provider, f"ответ {content_type}: {body!r}")
+                        return await consume(response)
+                    status = response.status_code
+            except httpx.TransportError as e:
+                if last:
+                    raise ProviderError(provider, f"ошибка соединения: {e!r}")
+                delay = self._delay(attempt)
+                logger.warning(f"{provider}: {e!r}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+
+            if status not in RETRY_STATUSES or last:
+                raise ProviderError(provider, f"ответ {status}", status)
+
+            delay = self._delay(attempt, response)
+            logger.warning(f"{provider}: ответ {status}, повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+        raise ProviderError(provider, "попытки исчерпаны")
+
+    async def post(
+        self,
+        provider: str,
+        url: str,
+        files: Optional[Dict] = None,
+        data: Optional[Dict] = None,
+        headers: Optional[Dict] = None
+    ) -> bytes:
+        """
+        POST с повторами, тело ответа целиком в памяти
+
+        Args:
+            provider: Имя сервиса (для логов и ошибок)
+            url: Адрес API
+            files: Файлы multipart
+            data: Поля формы
+            headers: Заголовки
+
+        Returns:
+            Тело успешного ответа
+
+        Raises:
+            ProviderError: если сервис так и не вернул 200
+        """
+        return await self._request(
+            "POST", provider, url, lambda response: response.aread(),
+            files=files, data=data, headers=headers
+        )
+
+    async def post_to_file(
+        self,
+        provider: str,
+        url: str,
+        dest: str,
+        files: Optional[Dict] = None,
+        data: Optional[Dict] = None,
+        headers: Optional[Dict] = None,
+        accept: Optional[str] = None
+    ) -> int:
+        """
+        POST с повторами, тело ответа пишется в файл по частям
+
+        Returns:
+            Размер записанного ответа в байтах
+
+        Raises:
+            ProviderError: если сервис так и не вернул 200
+        """
+        return await self._request(
+            "POST", provider, url, lambda response: self._save(response, dest), accept,
+            files=files, data=data, headers=headers
+        )
+
+    async def get(self, provider: str, url: str, headers: Optional[Dict] = None) -> bytes:
+        """GET с повторами, тело ответа целиком в памяти"""
+        return await self._request(
+            "GET", provider, url, lambda response: response.aread(), headers=headers
+        )
+
+    async def download(
+        self,
+        url: str,
+        dest: str,
+        provider: str = "download",
+        headers: Optional[Dict] = None,
+        accept: Optional[str] = None
+    ) -> int:
+        """Потоковая загрузка файла по GET с повторами"""
+        return await self._request(
+            "GET", provider, url, lambda response: self._save(response, dest), accept,
+            headers=headers
+        )
+
+    @staticmethod
+    async def _save(response: httpx.Response, dest: str, chunk_size: int = 64 * 1024) -> int:
+        size = 0
+        with open(dest, "wb") as f:
+            async for chunk in response.aiter_bytes(chunk_size):
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    async def hedge(
+        self,
+        calls: List[Tuple[str, Callable[[], Awaitable[Any]]]],
+        hedge_after: Optional[float] = None
+    ) -> Tuple[str, Any]:
+        """
+        Запрос с хеджированием по нескольким сервисам
+
+        Первый вызов стартует сразу. Каждый следующий - если ни один из
+        запущенных не ответил за hedge_after секунд или все запущенные
+        завершились ошибкой.
+
+        Args:
+            calls: Пары (имя сервиса, корутина запроса) в порядке приоритета
+            hedge_after: Порог хеджирования (None - из настроек клиента)
+
+        Returns:
+            (имя ответившего сервиса, результат его корутины)
+
+        Raises:
+            ProviderError: если ни один сервис не вернул результат
+        """
+        delay = self.hedge_after if hedge_after is None else hedge_after
+        waiting = list(calls)
+        pending: Dict[asyncio.Task, str] = {}
+        # Ошибки вместе с именем сервиса: завершаются они не в порядке запуска
+        errors: List[Tuple[str, BaseException]] = []
+
+        def launch() -> None:
+            name, call = waiting.pop(0)
+            pending[asyncio.create_task(call())] = name
+
+        launch()
+        try:
+            while pending:
+                timeout = delay if waiting and delay > 0 else None
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+
+                if not done:
+                    logger.info(
+                        f"{', '.join(pending.values())}: нет ответа за {delay:.1f} с, "
+                        f"хеджирование в {waiting[0][0]}"
+                    )
+                    launch()
+                    continue
+
+                for task in done:
+                    name = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        return name, task.result()
+                    errors.append((name, error))
+
+                if not pending and waiting:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if len(errors) == 1:
+            raise errors[0][1]
+        raise ProviderError(
+            ", ".join(name for name, _ in errors),
+            "; ".join(str(error) for _, error in errors) or "нет ответа"
+        )
+
+    async def probe(
+        self,
+        url: str,
+        headers: Optional[Dict] = None,
+        ok_statuses: Iterable[int] = ()
+    ) -> bool:
+        """
+        Дешёвая проверка доступности
+
+        Args:
+            url: Адрес проверки
+            headers: Заголовки
+            ok_statuses: Статусы помимо 2xx, означающие, что сервис жив
+                (например, 405 на GET к адресу, принимающему только POST)
+        """
+        try:
+            response = await self.client.get(url, headers=headers)
+        except httpx.TransportError:
+            return False
+        return response.is_success or response.status_code in ok_statuses
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+# Оценка задержки сервиса, который ещё ни разу не ответил успешно
+UNKNOWN_LATENCY = 10.0
+
+
+class ProviderHealth:
+    """Скользящая статистика одного сервиса"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "latency_ewma": round(self.latency, 3) if self.latency is not None else None,
+            "error_rate_ewma": round(self.error_rate, 3),
+            "requests": self.requests,
+            "failures": self.failures
+        }
+
+
+class ProviderRouter:
+    """Выбор самого быстрого здорового сервиса по EWMA и circuit breaker"""
+
+    def __init__(
+        self,
+        alpha: float = 0.3,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        probe: Optional[Callable[[str], Awaitable[bool]]] = None
+    ):
+        """
+        Args:
+            alpha: Вес нового замера в EWMA
+            failure_threshold: Ошибок подряд до открытия выключателя
+            cooldown: Пауза перед пробой открытого выключателя, сек
+            probe: Корутина проверки сервиса по имени (None - пробой
+                служит первый реальный запрос после паузы)
+        """
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.probe = probe
+        self.health: Dict[str, ProviderHealth] = {}
+        self._probe_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, probe: Optional[Callable[[str], Awaitable[bool]]] = None) -> "ProviderRouter":
+        return cls(
+            alpha=float(os.getenv("PROVIDER_EWMA_ALPHA", "0.3")),
+            failure_threshold=int(os.getenv("PROVIDER_BREAKER_FAILURES", "3")),
+            cooldown=float(os.getenv("PROVIDER_BREAKER_COOLDOWN", "30")),
+            probe=probe
+        )
+
+    def _health(self, name: str) -> ProviderHealth:
+        if name not in self.health:
+            self.health[name] = ProviderHealth(name)
+        return self.health[name]
+
+    def available(self, name: str) -> bool:
+        """Можно ли отправлять запрос в сервис"""
+        health = self._health(name)
+        if health.state != OPEN:
+            return True
+        if self.probe is None and time.monotonic() - health.opened_at >= self.cooldown:
+            # Без фоновой пробы следующий запрос проверяет восстановление
+            health.state = HALF_OPEN
+            return True
+        return False
+
+    def score(self, name: str) -> float:
+        """Ожидаемая цена запроса: задержка с поправкой на долю ошибок"""
+        health = self._health(name)
+        if health.requests == 0:
+            # Ещё не было запросов - пробуем в первую очередь
+            return 0.0
+        latency = health.latency if health.latency is not None else UNKNOWN_LATENCY
+        return latency / max(1.0 - health.error_rate, 0.05)
+
+    def rank(self, names: Iterable[str]) -> List[str]:
+        """Сервисы с закрытым выключателем, от лучшего к худшему"""
+        return sorted((name for name in names if self.available(name)), key=self.score)
+
+    def record(self, name: str, latency: float, ok: bool) -> None:
+        """Учёт результата запроса к сервису"""
+        health = self._health(name)
+        health.requests += 1
+        health.error_rate += self.alpha * ((0.0 if ok else 1.0) - health.error_rate)
+
+        if ok:
+            health.latency = (
+                latency if health.latency is None
+                else health.latency + self.alpha * (latency - health.latency)
+            )
+            health.consecutive_failures = 0
+            if health.state != CLOSED:
+                logger.info(f"{name}: сервис восстановлен")
+            health.state = CLOSED
+            return
+
+        health.failures += 1
+        health.consecutive_failures += 1
+        if health.state == HALF_OPEN or health.consecutive_failures >= self.failure_threshold:
+            if health.state != OPEN:
+                logger.warning(f"{name}: выключатель открыт после {health.consecutive_failures} ошибок")
+            health.state = OPEN
+            health.opened_at = time.monotonic()
+            self._ensure_probe()
+
+    async def track(self, name: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполнение запроса с учётом задержки и ошибок"""
+        start = time.monotonic()
+        try:
+            result = await call()
+        except ProviderError as e:
+            # 4xx (кроме 429) - ошибка запроса, а не сервиса
+            if e.status is None or e.status in RETRY_STATUSES:
+                self.record(name, time.monotonic() - start, ok=False)
+            raise
+        self.record(name, time.monotonic() - start, ok=True)
+        return result
+
+    def _ensure_probe(self) -> None:
+        if self.probe is None or (self._probe_task and not self._probe_task.done()):
+            return
+        try:
+            self._probe_task = asyncio.get_running_loop().create_task(self._probe_loop())
+        except RuntimeError:
+            pass
+
+    async def _probe_loop(self) -> None:
+        """Фоновая проба открытых выключателей; завершается, когда все закрыты"""
+        while True:
+            opened = [h for h in self.health.values() if h.state == OPEN]
+            if not opened:
+                return
+
+            now = time.monotonic()
+            for health in opened:
+                if now - health.opened_at < self.cooldown:
+                    continue
+                try:
+                    ok = await self.probe(health.name)
+                except Exception as e:
+                    logger.warning(f"{health.name}: ошибка пробы: {e!r}")
+                    ok = False
+                if ok:
+                    logger.info(f"{health.name}: проба успешна, выключатель закрыт")
+                    health.state = CLOSED
+                    health.consecutive_failures = 0
+                else:
+                    health.opened_at = time.monotonic()
+
+            await asyncio.sleep(max(min(self.cooldown, 5.0), 0.1))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: health.as_dict() for name, health in self.health.items()}
+
+    async def close(self) -> None:
+        if self._probe_task and not self._probe_task.done():
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
@@ -0,0 +1,222 @@
+"""
+Планировщик заданий бота
+
+Обработка апдейтов в боте параллельная, но число одновременно
+выполняемых заданий ограничено. Ожидающие задания лежат в очередях
+пользователей, слоты раздаются по кругу (round-robin), причём первым
+идёт пользователь с наименьшим числом заданий в работе: пользователь с
+десятью фото в очереди не задерживает остальных больше, чем на одно
+своё задание за круг.
+
+Переполнение проверяется до скачивания фото: задание сверх лимита
+пользователя или общей очереди сразу отклоняется с SchedulerFull.
+
+Настройка через переменные окружения:
+- BOT_MAX_IN_FLIGHT: сколько заданий выполняется одновременно
+- BOT_MAX_PER_USER: сколько заданий (в очереди и в работе) может быть у одного пользователя
+- BOT_MAX_QUEUED: сколько заданий всего может ждать в очереди
+"""
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerFull(Exception):
+    """Задание не принято: превышен лимит пользователя или очереди"""
+
+    def __init__(self, message: str, per_user: bool):
+        super().__init__(message)
+        self.per_user = per_user
+
+
+class _Ticket:
+    """Место задания в очереди пользователя"""
+
+    def __init__(self, on_position: Optional[Callable[[int], Awaitable[Any]]]):
+        self.granted = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position: Optional[int] = None
+
+
+class FairScheduler:
+    """Ограничение параллельных заданий и справедливая очередь по пользователям"""
+
+    def __init__(self, max_in_flight: int = 4, max_per_user: int = 2, max_queued: int = 50):
+        """
+        Args:
+            max_in_flight: Одновременно выполняемых заданий
+            max_per_user: Заданий одного пользователя в очереди и в работе
+            max_queued: Всего ожидающих заданий
+        """
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self.in_flight = 0
+        self._running: Dict[int, int] = {}
+        # Номер последней выдачи слота пользователю (для очерёдности по кругу)
+        self._served: Dict[int, int] = {}
+        self._serial = 0
+        # Очереди ожидающих заданий по пользователям
+        self._queues: "OrderedDict[int, Deque[_Ticket]]" = OrderedDict()
+        # Ссылки на задачи уведомлений: цикл событий хранит только слабые
+        self._notifications: Set[asyncio.Task] = set()
+
+    @classmethod
+    def from_env(cls) -> "FairScheduler":
+        return cls(
+            max_in_flight=int(os.getenv("BOT_MAX_IN_FLIGHT", "4")),
+            max_per_user=int(os.getenv("BOT_MAX_PER_USER", "2")),
+            max_queued=int(os.getenv("BOT_MAX_QUEUED", "50"))
+        )
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def user_jobs(self, user_id: int) -> int:
+        """Задания пользователя в очереди и в работе"""
+        return self._running.get(user_id, 0) + len(self._queues.get(user_id, ()))
+
+    def check(self, user_id: int) -> None:
+        """
+        Проверка, что задание пользователя будет принято
+
+        Raises:
+            SchedulerFull: если лимит пользователя или очереди исчерпан
+        """
+        if self.user_jobs(user_id) >= self.max_per_user:
+            raise SchedulerFull(
+                f"У вас уже {self.user_jobs(user_id)} задания в обработке, дождитесь результата",
+                per_user=True
+            )
+        if self.in_flight >= self.max_in_flight and self.queued >= self.max_queued:
+            raise SchedulerFull("Бот перегружен, попробуйте через пару минут", per_user=False)
+
+    async def run(
+        self,
+        user_id: int,
+        job: Callable[[], Awaitable[Any]],
+        on_position: Optional[Callable[[int], Awaitable[Any]]] = None
+    ) -> Any:
+        """
+        Выполнение задания в свою очередь
+
+        Args:
+            user_id: Пользователь Telegram
+            job: Корутина-фабрика задания
+            on_position: Уведомление о месте в очереди (1 - следующее)
+
+        Raises:
+            SchedulerFull: если лимит пользователя или очереди исчерпан
+        """
+        self.check(user_id)
+
+        ticket = _Ticket(on_position)
+        self._queues.setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+
+        try:
+            await ticket.granted
+        except asyncio.CancelledError:
+            self._remove(user_id, ticket)
+            raise
+
+        try:
+            return await job()
+        finally:
+            self.in_flight -= 1
+            self._running[user_id] -= 1
+            if not self._running[user_id]:
+                del self._running[user_id]
+            self._dispatch()
+
+    def _remove(self, user_id: int, ticket: _Ticket) -> None:
+        queue = self._queues.get(user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[user_id]
+            self._notify_positions()
+        elif ticket.granted.done() and not ticket.granted.cancelled():
+            # Слот уже выдан, но задание отменено до старта
+            self.in_flight -= 1
+            self._running[user_id] -= 1
+            if not self._running[user_id]:
+                del self._running[user_id]
+            self._dispatch()
+
+    @staticmethod
+    def _pop_next(
+        queues: "OrderedDict[int, Deque[_Ticket]]",
+        running: Dict[int, int],
+        served: Dict[int, int],
+        serial: int
+    ) -> _Ticket:
+        """
+        Следующее задание: пользователь с наименьшим числом заданий в работе,
+        при равенстве - тот, кого дольше всех не обслуживали
+        """
+        user_id = min(queues, key=lambda user: (running.get(user, 0), served.get(user, -1)))
+        queue = queues[user_id]
+        ticket = queue.popleft()
+        if not queue:
+            del queues[user_id]
+        running[user_id] = running.get(user_id, 0) + 1
+        served[user_id] = serial
+        return ticket
+
+    def _dispatch(self) -> None:
+        """Выдача свободных слотов"""
+        while self.in_flight < self.max_in_flight and self._queues:
+            self._serial += 1
+            ticket = self._pop_next(self._queues, self._running, self._served, self._serial)
+            self.in_flight += 1
+            ticket.granted.set_result(True)
+
+        # Забываем очерёдность пользователей без заданий
+        for user_id in list(self._served):
+            if user_id not in self._running and user_id not in self._queues:
+                del self._served[user_id]
+
+        self._notify_positions()
+
+    def _order(self) -> List[_Ticket]:
+        """Порядок, в котором ожидающие задания получат слоты"""
+        queues = OrderedDict((user, deque(queue)) for user, queue in self._queues.items())
+        running = dict(self._running)
+        served = dict(self._served)
+        order = []
+        serial = self._serial
+        while queues:
+            serial += 1
+            order.append(self._pop_next(queues, running, served, serial))
+        return order
+
+    def _notify_positions(self) -> None:
+        for position, ticket in enumerate(self._order(), start=1):
+            if ticket.position == position:
+                continue
+            ticket.position = position
+            if ticket.on_position is not None:
+                task = asyncio.create_task(self._safe_notify(ticket.on_position, position))
+                self._notifications.add(task)
+                task.add_done_callback(self._notifications.discard)
+
+    @staticmethod
+    async def _safe_notify(callback: Callable[[int], Awaitable[Any]], position: int) -> None:
+        try:
+            await callback(position)
+        except Exception as e:
+            logger.warning(f"Ошибка уведомления о позиции в очереди: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "users_waiting": len(self._queues)
+        }
@@ -0,0 +1,47 @@
+import torch
+from torch import nn
+
+import modes.backends as backends
+from modes import shared_weights
+from modes.backends import AUTO, TORCHSCRIPT, backend_of, compile_model
+
+
+def _net() -> nn.Module:
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 8, 3, padding=1), nn.LeakyReLU(0.2), nn.Conv2d(8, 3, 3, padding=1)).eval()
+
+
+def _setup(tmp_path, monkeypatch, shared: bool):
+    monkeypatch.setattr(backends, "COMPILED_DIR", str(tmp_path))
+    monkeypatch.setattr(shared_weights, "SHARED_WEIGHTS", shared)
+    measured = []
+    monkeypatch.setattr(backends, "measure", lambda model, key, names=None: measured.append(key) or {})
+    return measured
+
+
+def test_auto_stays_eager_with_shared_weights(tmp_path, monkeypatch):
+    measured = _setup(tmp_path, monkeypatch, shared=True)
+    net = _net()
+    assert compile_model(net, "net", AUTO) is net
+    assert measured == []
+
+
+def test_workers_do_not_measure_without_a_recorded_choice(tmp_path, monkeypatch):
+    measured = _setup(tmp_path, monkeypatch, shared=False)
+    net = _net()
+    assert compile_model(net, "net", AUTO) is net
+    assert measured == []
+
+
+def test_recorded_choice_is_used(tmp_path, monkeypatch):
+    measured = _setup(tmp_path, monkeypatch, shared=False)
+    net = _net()
+    fingerprint = shared_weights.fingerprint(net.state_dict())
+    backends._write_choice(backends._choice_key("net", fingerprint), TORCHSCRIPT)
+
+    compiled = compile_model(net, "net", AUTO)
+    assert backend_of(compiled) == TORCHSCRIPT
+    assert measured == []
+    x = torch.rand(1, 3, 16, 16)
+    with torch.no_grad():
+        assert torch.allclose(compiled(x), net(x), atol=1e-4)
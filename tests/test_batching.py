@@ -0,0 +1,66 @@
+import threading
+
+import numpy as np
+import torch
+from torch import nn
+
+from modes.batching import MicroBatcher
+from modes.tiling import TileEngine
+
+
+def _network(scale: int = 2) -> nn.Module:
+    # Свёртка после апсемплинга: край тайла зависит от соседних пикселей
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Upsample(scale_factor=scale), nn.Conv2d(3, 3, 5, padding=2))
+    return net.eval()
+
+
+def _image(height: int, width: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def _concurrently(*calls):
+    results = [None] * len(calls)
+    barrier = threading.Barrier(len(calls))
+
+    def run(index, call):
+        barrier.wait()
+        results[index] = call()
+
+    threads = [threading.Thread(target=run, args=(i, call)) for i, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_requests_share_a_batch():
+    net = _network()
+    engine = TileEngine(net, scale=2)
+    engine.batcher = MicroBatcher(net, scale=2, max_batch=8, max_wait_ms=200)
+
+    first, second = _image(64, 64, seed=1), _image(64, 64, seed=2)
+    results = _concurrently(lambda: engine.enhance(first, outscale=2), lambda: engine.enhance(second, outscale=2))
+
+    # Каждое изображение - один тайл; оба прошли через сеть одним проходом
+    assert engine.batcher.stats == {"batches": 1, "tiles": 2}
+    assert all(result.shape == (128, 128, 3) for result in results)
+
+
+def test_batched_result_does_not_depend_on_neighbours():
+    net = _network()
+    batcher = MicroBatcher(net, scale=2, max_batch=8, max_wait_ms=200)
+    engine = TileEngine(net, scale=2)
+    engine.batcher = batcher
+
+    # Тайл 100x128 дополняется до корзины 128x128 - и один, и в компании
+    img = _image(100, 130)
+    alone = engine.enhance(img, outscale=2)
+    together, _ = _concurrently(
+        lambda: engine.enhance(img, outscale=2),
+        lambda: engine.enhance(_image(128, 128, seed=3), outscale=2)
+    )
+
+    assert batcher.stats["batches"] >= 2
+    assert np.array_equal(alone, together)
@@ -0,0 +1,41 @@
+import asyncio
+
+import bot
+from bot import ApiService, ImageProcessor
+
+
+def test_items_failed_in_local_batch_fall_back_one_by_one(tmp_path, monkeypatch):
+    processor = ImageProcessor()
+    services = [ApiService.LOCAL_UPSCALE, ApiService.UPSCALE_MEDIA]
+    monkeypatch.setattr(processor, "available_services", lambda: services)
+    monkeypatch.setattr(processor, "_candidates", lambda api_service: services)
+    monkeypatch.setattr(bot, "get_result_cache", lambda: bot.ResultCache(max_memory_bytes=0))
+
+    sources, dests = [], []
+    for i in range(3):
+        source = tmp_path / f"{i}.jpg"
+        source.write_bytes(b"photo %d" % i)
+        sources.append(str(source))
+        dests.append(str(tmp_path / f"{i}.out.jpg"))
+
+    async def run_batch(service, batch_sources, batch_dests):
+        # Второе фото сервер обработать не смог
+        done = [source != sources[1] for source in batch_sources]
+        for dest, ok in zip(batch_dests, done):
+            if ok:
+                with open(dest, "wb") as f:
+                    f.write(b"result")
+        return done
+
+    retried = []
+
+    async def enhance_image(source, dest, api_service=None, on_progress=None):
+        retried.append(source)
+        return ApiService.UPSCALE_MEDIA
+
+    monkeypatch.setattr(processor, "_run_batch", run_batch)
+    monkeypatch.setattr(processor, "enhance_image", enhance_image)
+
+    used = asyncio.run(processor.enhance_album(sources, dests))
+    assert used == [ApiService.LOCAL_UPSCALE, ApiService.UPSCALE_MEDIA, ApiService.LOCAL_UPSCALE]
+    assert retried == [sources[1]]
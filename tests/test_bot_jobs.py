@@ -0,0 +1,36 @@
+import asyncio
+import json
+
+import pytest
+
+import bot
+from bot import ApiService, ImageProcessor
+from providers import ProviderError
+
+
+def test_job_that_never_finishes_times_out(tmp_path, monkeypatch):
+    processor = ImageProcessor()
+    monkeypatch.setattr(bot, "BACKEND_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(bot, "BACKEND_JOB_TIMEOUT", 0.05)
+    polls = []
+
+    async def post(name, url, **kwargs):
+        return json.dumps({"job_id": "stuck"}).encode()
+
+    async def get(name, url, **kwargs):
+        polls.append(url)
+        return json.dumps({"status": "running", "stage": "inference", "progress": 0.5}).encode()
+
+    async def download(*args, **kwargs):
+        raise AssertionError("результат не должен скачиваться")
+
+    monkeypatch.setattr(processor.client, "post", post)
+    monkeypatch.setattr(processor.client, "get", get)
+    monkeypatch.setattr(processor.client, "download", download)
+
+    config = ApiService.LOCAL_UPSCALE.value
+    with pytest.raises(ProviderError) as error:
+        asyncio.run(processor._run_job(config, b"photo", str(tmp_path / "out.part")))
+
+    assert error.value.provider == config['name']
+    assert 1 <= len(polls) <= 10
@@ -0,0 +1,75 @@
+import asyncio
+
+import bot
+from bot import ApiService, ImageProcessor
+from modes.cache import ResultCache
+
+
+def test_key_depends_on_every_part():
+    base = ResultCache.make_key("digest", "upscale", "photo", {"encoding": "jpeg:q92", "precision": None})
+    variants = [
+        ResultCache.make_key("other", "upscale", "photo", {"encoding": "jpeg:q92", "precision": None}),
+        ResultCache.make_key("digest", "face_restore", "photo", {"encoding": "jpeg:q92", "precision": None}),
+        ResultCache.make_key("digest", "upscale", "anime", {"encoding": "jpeg:q92", "precision": None}),
+        ResultCache.make_key("digest", "upscale", "photo", {"encoding": "webp:q92", "precision": None}),
+        ResultCache.make_key("digest", "upscale", "photo", {"encoding": "jpeg:q92", "precision": "int8"}),
+    ]
+    assert base not in variants
+    assert len(set(variants)) == len(variants)
+
+
+def test_key_ignores_param_order():
+    first = ResultCache.make_key("digest", "upscale", params={"a": 1, "b": 2})
+    second = ResultCache.make_key("digest", "upscale", params={"b": 2, "a": 1})
+    assert first == second
+    assert ResultCache.make_key("digest", "upscale") == ResultCache.make_key("digest", "upscale", "auto", {})
+
+
+def test_memory_level_evicts_least_recently_used():
+    cache = ResultCache(max_memory_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+    # "b" дольше не запрашивали - вытесняется он
+    cache.put("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234" and cache.get("c") == b"1234"
+
+
+def test_disk_level_survives_memory_eviction(tmp_path):
+    cache = ResultCache(max_memory_bytes=4, disk_dir=str(tmp_path))
+    cache.put("a", b"1234")
+    cache.put("b", b"5678")
+    assert cache.get("a") == b"1234"
+    assert cache.stats_counters["disk_hits"] == 1
+
+
+def test_auto_hit_returns_the_service_that_produced_the_result(tmp_path, monkeypatch):
+    processor = ImageProcessor()
+    ranking = [ApiService.UPSCALE_MEDIA, ApiService.DEEP_IMAGE]
+    monkeypatch.setattr(processor, "available_services", lambda: ranking)
+    monkeypatch.setattr(processor, "_candidates", lambda api_service: list(ranking))
+    cache = ResultCache()
+    monkeypatch.setattr(bot, "get_result_cache", lambda: cache)
+
+    calls = []
+
+    async def hedge(attempts):
+        name = ApiService.DEEP_IMAGE.value['name']
+        calls.append(name)
+        part = tmp_path / "result.part"
+        part.write_bytes(b"result")
+        return name, str(part)
+
+    monkeypatch.setattr(processor.client, "hedge", hedge)
+    source = tmp_path / "photo.jpg"
+    source.write_bytes(b"photo")
+
+    first = asyncio.run(processor.enhance_image(str(source), str(tmp_path / "first.jpg")))
+    # Рейтинг сервисов изменился - повтор всё равно берётся из кеша
+    ranking.reverse()
+    second = asyncio.run(processor.enhance_image(str(source), str(tmp_path / "second.jpg")))
+
+    assert first == second == ApiService.DEEP_IMAGE
+    assert len(calls) == 1
+    assert (tmp_path / "second.jpg").read_bytes() == b"result"
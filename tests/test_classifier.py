@@ -0,0 +1,53 @@
+import numpy as np
+
+from modes.classifier import ANIME, PHOTO, STRIDE_SIDE, StyleClassifier, thumbnail
+
+
+def _photo(seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+
+
+def _flat():
+    img = np.zeros((300, 400, 3), dtype=np.uint8)
+    img[:, :200] = (40, 180, 240)
+    img[:, 200:] = (200, 60, 90)
+    return img
+
+
+def test_thumbnail_is_bounded_for_any_input():
+    for shape in ((5000, 3000, 3), (64, 48, 3), (STRIDE_SIDE * 3, 7, 3)):
+        thumb = thumbnail(np.zeros(shape, dtype=np.uint8))
+        assert max(thumb.shape[:2]) <= 128
+        assert thumb.flags["C_CONTIGUOUS"]
+
+
+def test_flat_fills_and_noise_get_different_styles():
+    classifier = StyleClassifier()
+    style, confidence = classifier.classify(_flat())
+    assert style == ANIME and 0.5 <= confidence <= 1.0
+    assert classifier.classify(_photo())[0] == PHOTO
+
+
+def test_decisions_are_cached_by_thumbnail_or_key():
+    classifier = StyleClassifier()
+    img = _photo()
+    first = classifier.classify(img)
+    assert classifier.classify(img.copy()) == first
+    assert classifier.stats == {"hits": 1, "misses": 1}
+
+    # Переданный ключ важнее содержимого: решение берётся из кеша
+    classifier.classify(_flat(), key="file")
+    assert classifier.classify(_photo(), key="file")[0] == ANIME
+
+
+def test_cache_evicts_least_recently_used():
+    classifier = StyleClassifier(max_entries=2)
+    for key in ("a", "b"):
+        classifier.classify(_photo(), key=key)
+    classifier.classify(_photo(), key="a")
+    classifier.classify(_photo(), key="c")
+
+    assert list(classifier._cache) == ["a", "c"]
+    classifier.classify(_photo(), key="b")
+    assert classifier.stats["misses"] == 4
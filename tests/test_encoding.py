@@ -0,0 +1,49 @@
+import numpy as np
+
+from modes.encoding import MAX_ATTEMPTS, MAX_DOWNSCALES, EncodeOptions, encode
+
+
+def _photo(height: int = 384, width: int = 512) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:height, 0:width]
+    base = np.stack([yy % 256, xx % 256, (yy * xx) % 256], axis=-1).astype(int)
+    return np.clip(base + rng.integers(-40, 41, base.shape), 0, 255).astype(np.uint8)
+
+
+def test_fits_by_lowering_quality():
+    img = _photo()
+    full = encode(img, EncodeOptions(format="jpeg", quality=95))
+    budget = len(full.data) // 2
+    fitted = encode(img, EncodeOptions(format="jpeg", quality=95, max_bytes=budget))
+
+    assert len(fitted.data) <= budget
+    assert fitted.scale == 1.0
+    assert 40 <= fitted.quality < 95
+    assert fitted.attempts <= MAX_ATTEMPTS
+
+
+def test_search_keeps_the_highest_fitting_quality():
+    img = _photo()
+    budget = len(encode(img, EncodeOptions(format="webp", quality=90)).data) // 2
+    options = EncodeOptions(format="webp", quality=90, max_bytes=budget)
+    fitted = encode(img, options)
+    assert len(fitted.data) <= options.max_bytes
+    # На единицу качества выше лимит уже не выполняется (иначе поиск остановился рано)
+    above = encode(img, EncodeOptions(format="webp", quality=fitted.quality + 1))
+    assert len(above.data) > options.max_bytes or fitted.attempts >= MAX_ATTEMPTS
+
+
+def test_unlimited_and_loose_limits_encode_once():
+    img = _photo()
+    assert encode(img, EncodeOptions(format="jpeg", quality=92)).attempts == 1
+    loose = encode(img, EncodeOptions(format="jpeg", quality=92, max_bytes=10 ** 8))
+    assert loose.attempts == 1 and loose.quality == 92
+
+
+def test_lossless_format_is_downscaled_to_fit():
+    img = _photo()
+    budget = len(encode(img, EncodeOptions(format="png")).data) // 4
+    fitted = encode(img, EncodeOptions(format="png", max_bytes=budget))
+    assert len(fitted.data) <= budget
+    assert fitted.scale < 1.0
+    assert fitted.attempts <= 1 + MAX_DOWNSCALES + 1
@@ -0,0 +1,45 @@
+import time
+
+from modes.utils import EventWriter
+
+
+def _flushed(writer: EventWriter) -> None:
+    for _ in range(200):
+        if writer._queue.empty():
+            break
+        time.sleep(0.01)
+    # Очередь пуста - ждём, пока поток допишет взятую пачку
+    time.sleep(writer.flush_interval + 0.1)
+
+
+def test_writer_follows_rotation_by_another_process(tmp_path):
+    first = EventWriter(str(tmp_path), max_bytes=64, flush_interval=0.05)
+    second = EventWriter(str(tmp_path), max_bytes=10 ** 6, flush_interval=0.05)
+    first.start()
+    second.start()
+
+    second.submit("events.log", "second-before\n")
+    _flushed(second)
+    # Первый воркер переполняет файл и ротирует его
+    first.submit("events.log", "x" * 80 + "\n")
+    _flushed(first)
+    second.submit("events.log", "second-after\n")
+
+    first.close()
+    second.close()
+    current = (tmp_path / "events.log").read_text()
+    rotated = (tmp_path / "events.log.1").read_text()
+    assert "second-before" in rotated
+    assert "second-after" in current and "second-after" not in rotated
+
+
+def test_dropped_events_are_reported(tmp_path):
+    writer = EventWriter(str(tmp_path), max_queue=1)
+    assert writer.submit("events.log", "kept\n")
+    assert not writer.submit("events.log", "dropped\n")
+    writer.start()
+    writer.close()
+
+    lines = (tmp_path / "events.log").read_text().splitlines()
+    assert lines[0] == "kept"
+    assert '"count": 1' in lines[1]
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+import pytest
+
+from modes.executor import ExecutorBusy, InferenceExecutor, _parse_limits
+from modes.metrics import watch_stages
+
+
+def test_parse_limits_skips_invalid_entries():
+    assert _parse_limits("upscale=2, face_restore=0,broken=x,") == {"upscale": 2, "face_restore": 1}
+
+
+def test_mode_limit_bounds_parallel_runs():
+    executor = InferenceExecutor(max_workers=4, concurrency={"upscale": 1})
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        threading.Event().wait(0.02)
+        with lock:
+            active.pop()
+        return threading.current_thread().name
+
+    async def scenario():
+        return await asyncio.gather(*[executor.run("upscale", work) for _ in range(3)])
+
+    try:
+        names = asyncio.run(scenario())
+    finally:
+        executor.shutdown()
+
+    assert max(peak) == 1
+    assert all(name.startswith("inference") for name in names)
+
+
+def test_full_queue_is_rejected():
+    executor = InferenceExecutor(max_workers=2, concurrency={"upscale": 1}, queue_limit=1)
+    release = threading.Event()
+
+    async def scenario():
+        first = asyncio.ensure_future(executor.run("upscale", release.wait))
+        second = asyncio.ensure_future(executor.run("upscale", release.wait))
+        await asyncio.sleep(0.05)
+        assert executor.is_saturated("upscale")
+        with pytest.raises(ExecutorBusy) as error:
+            await executor.run("upscale", release.wait)
+        release.set()
+        await asyncio.gather(first, second)
+        return error.value
+
+    try:
+        error = asyncio.run(scenario())
+    finally:
+        release.set()
+        executor.shutdown()
+
+    assert error.mode == "upscale"
+    assert executor.stats()["upscale"] == {"pending": 0, "running": 0, "limit": 1}
+
+
+def test_waiting_for_a_slot_is_reported_as_queue_stage():
+    executor = InferenceExecutor(max_workers=2, concurrency={"upscale": 1})
+    release = threading.Event()
+    stages = []
+
+    async def scenario():
+        first = asyncio.ensure_future(executor.run("upscale", release.wait))
+        await asyncio.sleep(0.02)
+        with watch_stages(lambda stage, progress=None: stages.append(stage)):
+            second = asyncio.ensure_future(executor.run("upscale", lambda: None))
+            await asyncio.sleep(0.02)
+            release.set()
+            await asyncio.gather(first, second)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        release.set()
+        executor.shutdown()
+
+    assert stages[0] == "queue"
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from modes.face_restore import FACE_TEMPLATE, FaceRestorer
+
+
+def test_face_with_degenerate_landmarks_is_skipped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    restorer = FaceRestorer()
+    img = np.full((256, 256, 3), 100, dtype=np.uint8)
+    good = FACE_TEMPLATE / 4 + 20
+    # Все пять точек в одном месте - аффинное преобразование не определено
+    degenerate = np.full_like(FACE_TEMPLATE, 50.0)
+
+    pasted = []
+    monkeypatch.setattr(restorer, "_detect_faces", lambda image: [degenerate, good])
+    monkeypatch.setattr(restorer, "_restore_faces", lambda crops, fidelity: crops)
+    monkeypatch.setattr(restorer, "_face_masks", lambda faces: [np.ones(face.shape[:2], np.float32) for face in faces])
+    monkeypatch.setattr(restorer, "_paste_face", lambda canvas, face, mask, affine, upscale: pasted.append(affine))
+
+    (result, count), = restorer._restore_many_sync([img], fidelity=0.5, upscale=1)
+    assert count == 1
+    assert len(pasted) == 1 and np.isfinite(pasted[0]).all()
+    assert result.shape == img.shape
+
+
+def test_unsupported_model_is_rejected_up_front():
+    with pytest.raises(ValueError, match="CodeFormer"):
+        FaceRestorer(model_type="CodeFormer")
@@ -0,0 +1,111 @@
+import asyncio
+import contextvars
+import time
+
+from api.jobs import DONE, QUEUED, JobManager, MemoryJobStore, SQLiteJobStore
+from modes.metrics import report_stage
+
+
+def _runner(seen):
+    async def runner(mode, data, **options):
+        def work():
+            report_stage("decode")
+            for done in range(1, 5):
+                report_stage("inference", done / 4)
+            return data[::-1]
+
+        seen.append(options)
+        # Так же, как InferenceExecutor: контекст со слушателем уходит в поток
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, work)
+    return runner
+
+
+async def _wait(store, job_id, status=DONE):
+    for _ in range(100):
+        job = await store.get(job_id)
+        if job["status"] == status:
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Задание не перешло в {status}: {job}")
+
+
+def test_stages_reach_store_and_result_is_kept():
+    async def scenario():
+        updates = []
+        store = MemoryJobStore()
+        update = store.update
+
+        async def spy(job_id, **fields):
+            updates.append(fields)
+            await update(job_id, **fields)
+
+        store.update = spy
+        manager = JobManager(_runner([]), store, workers=1)
+        await manager.start()
+        job = await manager.submit("upscale", b"abc")
+        done = await _wait(store, job["id"])
+        await manager.stop()
+        return updates, done, await store.get_result(job["id"])
+
+    updates, done, result = asyncio.run(scenario())
+    stages = [(fields["stage"], fields["progress"]) for fields in updates if "stage" in fields]
+    # Промежуточные стадии могут схлопнуться, последняя перед завершением - всегда
+    assert stages[-2:] == [("inference", 1.0), (None, 1.0)]
+    assert result == b"cba"
+    assert done["progress"] == 1.0 and done["stage"] is None
+
+
+def test_sqlite_requeues_queued_jobs_after_restart(tmp_path):
+    path = str(tmp_path / "jobs.db")
+
+    async def scenario():
+        seen = []
+        # Воркер принял задание и перезапустился, не успев его взять
+        before = JobManager(_runner(seen), SQLiteJobStore(path), workers=0)
+        await before.start()
+        job = await before.submit("upscale", b"xyz", model="photo", encoding={"format": "png"})
+        # Второе задание воркер взял и упал посреди обработки
+        orphan = await before.submit("upscale", b"abc")
+        assert await before.store.claim(orphan["id"])
+        await before.store.update(orphan["id"], stage="inference", progress=0.5)
+        await before.stop()
+        assert (await before.store.get(job["id"]))["status"] == QUEUED
+
+        after = JobManager(_runner(seen), SQLiteJobStore(path), workers=1, lease=0)
+        await after.start()
+        await _wait(after.store, job["id"])
+        await _wait(after.store, orphan["id"])
+        results = [await after.store.get_result(job_id) for job_id in (job["id"], orphan["id"])]
+        await after.stop()
+        return seen, results
+
+    seen, results = asyncio.run(scenario())
+    assert results == [b"zyx", b"cba"]
+    assert seen == [{"model": "photo", "encoding": {"format": "png"}}, {}]
+
+
+def test_recover_keeps_jobs_within_lease():
+    async def scenario():
+        store = MemoryJobStore()
+        job = {"id": "a", "mode": "upscale", "status": QUEUED, "created_at": 0.0, "updated_at": 0.0}
+        await store.create(job, b"", {})
+        await store.claim("a")
+        fresh = await store.recover(time.time() - 60)
+        stale = await store.recover(time.time() + 1)
+        return fresh, stale, await store.get("a")
+
+    fresh, stale, job = asyncio.run(scenario())
+    assert (fresh, stale) == (0, 1)
+    assert job["status"] == QUEUED
+
+
+def test_claim_is_exclusive(tmp_path):
+    async def scenario():
+        first = SQLiteJobStore(str(tmp_path / "jobs.db"))
+        second = SQLiteJobStore(str(tmp_path / "jobs.db"))
+        job = {"id": "a", "mode": "upscale", "status": QUEUED, "created_at": 0.0, "updated_at": 0.0}
+        await first.create(job, b"", {})
+        return await first.claim("a"), await second.claim("a")
+
+    assert asyncio.run(scenario()) == (True, False)
@@ -0,0 +1,34 @@
+import torch
+from torch import nn
+
+import modes.precision as precision
+from modes.precision import INT8, build_variant
+
+
+class _Shift(nn.Module):
+    """Сеть-заменитель: вход плюс постоянный сдвиг"""
+
+    def __init__(self, shift: float):
+        super().__init__()
+        self.shift = nn.Parameter(torch.tensor(shift))
+
+    def forward(self, x):
+        return x + self.shift
+
+
+def test_variant_is_gated_on_psnr_and_ssim(monkeypatch):
+    model = _Shift(0.0)
+    close = _Shift(0.002)
+    monkeypatch.setitem(precision._BUILDERS, INT8, lambda net, tiles: close)
+
+    monkeypatch.setattr(precision, "PRECISION_MIN_PSNR", 30.0)
+    monkeypatch.setattr(precision, "PRECISION_MIN_SSIM", 0.9)
+    assert build_variant(model, INT8) is close
+
+    # PSNR проходит, SSIM нет - остаётся fp32
+    monkeypatch.setattr(precision, "PRECISION_MIN_SSIM", 1.01)
+    assert build_variant(model, INT8) is model
+
+    monkeypatch.setattr(precision, "PRECISION_MIN_SSIM", 0.9)
+    monkeypatch.setattr(precision, "PRECISION_MIN_PSNR", 200.0)
+    assert build_variant(model, INT8) is model
@@ -0,0 +1,83 @@
+import io
+
+import pytest
+from PIL import Image
+
+from modes import preflight
+from modes.preflight import ImageInfo, PreflightError, plan_upscale, probe_bytes, validate
+
+
+def _jpeg(width, height, orientation=None):
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[preflight.EXIF_ORIENTATION] = orientation
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height)).save(buffer, "JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def test_input_at_target_size_is_skipped():
+    plan = plan_upscale(4096, 2048, scale=4, target_side=4096)
+    assert plan.skip
+    assert plan.target == (4096, 2048)
+
+
+def test_smaller_request_pre_scales_the_input():
+    plan = plan_upscale(1000, 500, scale=2, model_scale=4, target_side=0)
+    assert not plan.skip
+    assert plan.pre_scale == 0.5 and plan.outscale == 4
+    assert plan.target == (2000, 1000)
+
+
+def test_target_side_limits_the_result():
+    plan = plan_upscale(1000, 800, scale=4, model_scale=4, target_side=3000)
+    assert plan.target == (3000, 2400)
+    assert plan.pre_scale == 0.75 and plan.outscale == 4
+    # Почти полный масштаб сети - вход не уменьшается
+    near = plan_upscale(1000, 800, scale=4, model_scale=4, target_side=3800)
+    assert near.pre_scale == 1.0 and near.outscale == 3.8
+
+
+@pytest.mark.parametrize("orientation", [5, 6, 7, 8])
+def test_rotating_orientations_swap_width_and_height(orientation):
+    info = probe_bytes(_jpeg(40, 20, orientation))
+    assert info.orientation == orientation
+    assert (info.width, info.height) == (20, 40)
+    assert info.pixels == 800
+
+
+@pytest.mark.parametrize("orientation", [None, 1, 3])
+def test_other_orientations_keep_the_size(orientation):
+    info = probe_bytes(_jpeg(40, 20, orientation))
+    assert (info.width, info.height) == (40, 20)
+
+
+def test_unsupported_format_is_415():
+    with pytest.raises(PreflightError) as error:
+        validate(ImageInfo(10, 10, "GIF"))
+    assert error.value.status == 415
+
+
+def test_oversized_inputs_are_413(monkeypatch):
+    monkeypatch.setattr(preflight, "MAX_INPUT_SIDE", 100)
+    monkeypatch.setattr(preflight, "MAX_INPUT_PIXELS", 5000)
+    monkeypatch.setattr(preflight, "MAX_INPUT_BYTES", 1000)
+
+    for info in (
+        ImageInfo(101, 10, "JPEG"),
+        ImageInfo(80, 80, "PNG"),
+        ImageInfo(10, 10, "JPEG", size_bytes=1001)
+    ):
+        with pytest.raises(PreflightError) as error:
+            validate(info)
+        assert error.value.status == 413
+
+    with pytest.raises(PreflightError) as error:
+        probe_bytes(b"\0" * 1001)
+    assert error.value.status == 413
+
+
+def test_unreadable_header_is_422():
+    with pytest.raises(PreflightError) as error:
+        probe_bytes(b"not an image")
+    assert error.value.status == 422
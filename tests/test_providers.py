@@ -0,0 +1,140 @@
+import asyncio
+
+import httpx
+import pytest
+
+from providers import CLOSED, OPEN, ProviderClient, ProviderError, ProviderRouter
+
+
+def _client(handler, **kwargs) -> ProviderClient:
+    """Клиент без сети: ответы сервисов отдаёт handler(request)"""
+    client = ProviderClient(http2=False, backoff=0.01, **kwargs)
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def _services(delays, statuses=None):
+    """Обработчик: задержка и статус по хосту запроса (fast.test, slow.test, ...)"""
+    statuses = statuses or {}
+    calls = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        calls.append(host)
+        await asyncio.sleep(delays.get(host, 0))
+        status = statuses.get(host, 200)
+        return httpx.Response(status, content=host.encode(), headers={"content-type": "image/jpeg"})
+
+    return handler, calls
+
+
+def test_router_prefers_the_faster_service():
+    async def scenario():
+        handler, _ = _services({"fast.test": 0.01, "slow.test": 0.08})
+        client = _client(handler, retries=0)
+        router = ProviderRouter(alpha=0.5)
+        for _ in range(3):
+            for name in ("slow", "fast"):
+                await router.track(name, lambda name=name: client.post(name, f"http://{name}.test/"))
+        await client.close()
+        return router
+
+    router = asyncio.run(scenario())
+    assert router.rank(["slow", "fast"]) == ["fast", "slow"]
+    assert router.stats()["fast"]["latency_ewma"] < router.stats()["slow"]["latency_ewma"]
+
+
+def test_breaker_opens_on_5xx_and_probe_closes_it():
+    async def scenario():
+        statuses = {"down.test": 503}
+        handler, _ = _services({}, statuses)
+        client = _client(handler, retries=0)
+        router = ProviderRouter(
+            failure_threshold=2,
+            cooldown=0.05,
+            probe=lambda name: client.probe(f"http://{name}.test/ping")
+        )
+
+        for _ in range(2):
+            with pytest.raises(ProviderError):
+                await router.track("down", lambda: client.post("down", "http://down.test/"))
+        opened = router.health["down"].state
+        ranked = router.rank(["down", "up"])
+
+        # Сервис поднялся - фоновая проба закрывает выключатель
+        statuses["down.test"] = 200
+        for _ in range(50):
+            if router.health["down"].state == CLOSED:
+                break
+            await asyncio.sleep(0.02)
+        await router.close()
+        await client.close()
+        return opened, ranked, router.health["down"].state
+
+    opened, ranked, state = asyncio.run(scenario())
+    assert opened == OPEN
+    assert ranked == ["up"]
+    assert state == CLOSED
+
+
+def test_client_errors_do_not_open_the_breaker():
+    async def scenario():
+        handler, _ = _services({}, {"bad.test": 400})
+        client = _client(handler, retries=2)
+        router = ProviderRouter(failure_threshold=1)
+        with pytest.raises(ProviderError) as error:
+            await router.track("bad", lambda: client.post("bad", "http://bad.test/"))
+        await client.close()
+        return error.value.status, router.available("bad")
+
+    assert asyncio.run(scenario()) == (400, True)
+
+
+def test_hedge_returns_the_first_successful_response():
+    async def scenario():
+        handler, calls = _services({"slow.test": 1.0, "fast.test": 0.01})
+        client = _client(handler, retries=0, hedge_after=0.05)
+        result = await client.hedge([
+            ("slow", lambda: client.post("slow", "http://slow.test/")),
+            ("fast", lambda: client.post("fast", "http://fast.test/")),
+        ])
+        await client.close()
+        return result, calls
+
+    (name, body), calls = asyncio.run(scenario())
+    assert (name, body) == ("fast", b"fast.test")
+    assert calls == ["slow.test", "fast.test"]
+
+
+def test_hedge_names_providers_in_failure_order():
+    async def scenario():
+        # Первый сервис падает позже второго, запущенного хеджированием
+        handler, _ = _services({"first.test": 0.2}, {"first.test": 502, "second.test": 503})
+        client = _client(handler, retries=0, hedge_after=0.05)
+        with pytest.raises(ProviderError) as error:
+            await client.hedge([
+                ("first", lambda: client.post("first", "http://first.test/")),
+                ("second", lambda: client.post("second", "http://second.test/")),
+            ])
+        await client.close()
+        return error.value
+
+    error = asyncio.run(scenario())
+    assert error.provider == "second, first"
+    assert str(error).startswith("second, first: second: ответ 503")
+
+
+def test_probe_requires_2xx_unless_status_is_allowed():
+    async def scenario():
+        handler, _ = _services({}, {"post-only.test": 405, "missing.test": 404})
+        client = _client(handler)
+        results = (
+            await client.probe("http://ok.test/ping"),
+            await client.probe("http://post-only.test/"),
+            await client.probe("http://post-only.test/", ok_statuses=(405,)),
+            await client.probe("http://missing.test/", ok_statuses=(405,)),
+        )
+        await client.close()
+        return results
+
+    assert asyncio.run(scenario()) == (True, False, True, False)
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from torch import nn
+
+import modes.face_restore as face_restore
+from modes import shared_weights
+from modes.registry import ModelRegistry
+
+
+def test_concurrent_get_loads_once():
+    registry = ModelRegistry()
+    calls = []
+
+    def loader():
+        calls.append(threading.current_thread().name)
+        time.sleep(0.05)
+        return object()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("model", loader))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len({id(model) for model in results}) == 1
+    assert registry.is_loaded("model")
+
+
+def test_loader_returning_none_is_not_cached():
+    registry = ModelRegistry()
+    with pytest.raises(RuntimeError):
+        registry.get("broken", lambda: None)
+    assert not registry.is_loaded("broken")
+    assert registry.get("broken", lambda: "ok") == "ok"
+
+
+def test_only_modules_are_shared(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_weights, "SHARED_WEIGHTS", True)
+    monkeypatch.setattr(shared_weights, "SHARED_WEIGHTS_DIR", str(tmp_path))
+    registry = ModelRegistry()
+
+    registry.get("wrapper", lambda: {"net": nn.Linear(2, 2)})
+    registry.get("net", lambda: nn.Linear(2, 2))
+
+    assert "wrapper" not in registry.shared_bytes
+    assert registry.shared_bytes["net"] > 0
+
+
+def test_cold_singleton_is_initialised_once(monkeypatch):
+    calls = []
+
+    async def initialize(self):
+        calls.append(self)
+        await asyncio.sleep(0.05)
+        return True
+
+    monkeypatch.setattr(face_restore, "_shared_restorer", None)
+    monkeypatch.setattr(face_restore.FaceRestorer, "initialize", initialize)
+
+    async def scenario():
+        return await asyncio.gather(*[face_restore.get_face_restorer() for _ in range(3)])
+
+    restorers = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(restorer is calls[0] for restorer in restorers)
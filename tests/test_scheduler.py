@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from scheduler import FairScheduler, SchedulerFull
+
+
+def test_round_robin_lets_other_users_through():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_per_user=5, max_queued=10)
+        order = []
+        release = asyncio.Event()
+
+        def job(name, wait=False):
+            async def run():
+                order.append(name)
+                if wait:
+                    await release.wait()
+            return run
+
+        tasks = [asyncio.create_task(scheduler.run(1, job("a1", wait=True)))]
+        await asyncio.sleep(0)
+        # Пока a1 занимает слот, пользователь 1 ставит ещё два задания, а 2 - одно
+        tasks += [asyncio.create_task(scheduler.run(1, job(name))) for name in ("a2", "a3")]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(scheduler.run(2, job("b1"))))
+        await asyncio.sleep(0)
+        assert scheduler.stats() == {"in_flight": 1, "queued": 3, "users_waiting": 2}
+
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["a1", "b1", "a2", "a3"]
+
+
+def test_positions_follow_dispatch_order():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_per_user=5, max_queued=10)
+        release = asyncio.Event()
+        positions = {}
+
+        def notify(name):
+            async def callback(position):
+                positions[name] = position
+            return callback
+
+        async def hold():
+            await release.wait()
+
+        tasks = [asyncio.create_task(scheduler.run(1, hold))]
+        await asyncio.sleep(0)
+        for user, name in ((1, "a2"), (1, "a3"), (2, "b1")):
+            tasks.append(asyncio.create_task(scheduler.run(user, hold, notify(name))))
+            await asyncio.sleep(0)
+        # Задачи уведомлений держит планировщик, пока они не завершатся
+        assert scheduler._notifications
+        await asyncio.sleep(0)
+        snapshot = dict(positions)
+        release.set()
+        await asyncio.gather(*tasks)
+        await asyncio.sleep(0)
+        assert not scheduler._notifications
+        return snapshot
+
+    assert asyncio.run(scenario()) == {"b1": 1, "a2": 2, "a3": 3}
+
+
+def test_per_user_limit_is_checked_before_queueing():
+    async def scenario():
+        scheduler = FairScheduler(max_in_flight=1, max_per_user=1, max_queued=10)
+        release = asyncio.Event()
+
+        async def hold():
+            await release.wait()
+
+        task = asyncio.create_task(scheduler.run(1, hold))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerFull) as error:
+            scheduler.check(1)
+        scheduler.check(2)
+        release.set()
+        await task
+        return error.value.per_user
+
+    assert asyncio.run(scenario()) is True
@@ -0,0 +1,39 @@
+import torch
+from torch import nn
+
+from modes import shared_weights
+
+
+def test_shared_module_maps_the_exported_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_weights, "SHARED_WEIGHTS_DIR", str(tmp_path))
+    module = nn.Linear(4, 4)
+    expected = module(torch.ones(1, 4))
+
+    size = shared_weights.share_module(module, "net")
+
+    files = [path.name for path in tmp_path.glob("*.pt")]
+    assert files == [f"net-{shared_weights.fingerprint(module.state_dict())}.pt"]
+    assert size == sum(t.numel() * t.element_size() for t in module.state_dict().values())
+    assert torch.equal(module(torch.ones(1, 4)), expected)
+
+
+def test_fingerprint_follows_the_weights():
+    module = nn.Linear(4, 4)
+    before = shared_weights.fingerprint(module.state_dict())
+    with torch.no_grad():
+        module.weight.add_(1)
+    assert shared_weights.fingerprint(module.state_dict()) != before
+    assert len(before) == 16
+
+
+def test_export_removes_only_stale_files_of_the_same_key(tmp_path):
+    stale = ["net-0123456789abcdef.pt", "net-0123456789abcdef.pt.lock"]
+    # Другие сети с тем же началом ключа и посторонние файлы не трогаются
+    kept = ["net.body-0123456789abcdef.pt", "net-backup.pt", "net-old-0123456789abcdef.pt"]
+    for name in stale + kept:
+        (tmp_path / name).write_bytes(b"")
+
+    path = tmp_path / "net-fedcba9876543210.pt"
+    shared_weights._export(nn.Linear(2, 2).state_dict(), str(path))
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(kept + [path.name])
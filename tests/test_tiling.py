@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+from torch import nn
+
+from modes.tiling import TileEngine
+
+
+def _image(height: int, width: int, seed: int = 0) -> np.ndarray:
+    # Плавный градиент с шумом: шов между тайлами был бы заметен
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    base = np.stack([yy * 255 // max(height - 1, 1), xx * 255 // max(width - 1, 1), (yy + xx) % 256], axis=-1)
+    return np.clip(base + rng.integers(-8, 9, base.shape), 0, 255).astype(np.uint8)
+
+
+def _engine(conv: bool) -> TileEngine:
+    torch.manual_seed(0)
+    layers = [nn.Upsample(scale_factor=2)]
+    if conv:
+        conv_layer = nn.Conv2d(3, 3, 3, padding=1, bias=False)
+        # Сглаживание, близкое к тождественному: веса неотрицательные, сумма по каналу 1
+        weight = torch.full((3, 3, 3, 3), 0.02)
+        for c in range(3):
+            weight[c, c, 1, 1] = 1.0 - 0.02 * 26
+        conv_layer.weight.data = weight
+        layers.append(conv_layer)
+    return TileEngine(nn.Sequential(*layers).eval(), scale=2)
+
+
+def test_tiles_blend_without_seams_for_pointwise_network():
+    engine = _engine(conv=False)
+    img = _image(150, 190)
+    whole = engine.enhance(img, outscale=2, tile_size=0)
+    tiled = engine.enhance(img, outscale=2, tile_size=64, tile_pad=8, batch_size=3)
+    assert tiled.shape == whole.shape == (300, 380, 3)
+    assert np.array_equal(tiled, whole)
+
+
+def test_tile_borders_stay_close_to_whole_image():
+    engine = _engine(conv=True)
+    img = _image(150, 190)
+    whole = engine.enhance(img, outscale=2, tile_size=0).astype(int)
+    tiled = engine.enhance(img, outscale=2, tile_size=64, tile_pad=8, batch_size=3).astype(int)
+    # Нулевое дополнение свёртки на краю тайла гасится весами перекрытия
+    assert np.abs(tiled - whole).max() <= 2
+
+
+def test_enhance_many_matches_single_images():
+    engine = _engine(conv=False)
+    images = [_image(150, 190, seed=1), _image(64, 48, seed=2), _image(100, 130, seed=3)]
+    batched = engine.enhance_many(images, [2, 2, 2], tile_size=64, tile_pad=8, batch_size=4)
+    for img, result in zip(images, batched):
+        assert np.array_equal(result, engine.enhance(img, outscale=2, tile_size=64, tile_pad=8, batch_size=1))